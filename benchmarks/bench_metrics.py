@@ -0,0 +1,257 @@
+"""Benchmarks the keyword extraction, source relevance, every retrieval metric and
+generate_metrics end to end on synthetic corpora, and saves the timings as JSON to
+compare commits.
+
+    python -m benchmarks.bench_metrics --sizes 1000 10000 100000 1000000
+    python -m benchmarks.bench_metrics --compare benchmarks/results/<commit>.json
+
+The synthetic sources follow the chunk lengths and the vocabulary of the sample
+policy-chat responses in data/retrieved_sources.json, mixed with words of the sample
+queries so that some sources are relevant. The rows draw their sources from a pool of
+distinct chunks that grows with the number of rows (`--pool-size` to fix it), so the
+chunk interner of generate_metrics is not timed on hits only. generate_metrics is also
+timed without interning.
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+from rag_evaluation.calculate_retrieval_metrics import (
+    average_precision_from_vector, batch_metrics, cumulative_gain,
+    generate_metrics, get_keywords, get_relevance_vector, get_source_relevance,
+    normalized_discounted_cg, precision_from_vector,
+    reciprocal_rank_from_vector)
+from rag_evaluation.tokenizers import TOKENIZERS
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# the fewest distinct synthetic chunks the rows draw from, one more per row above it
+POOL_SIZE = 2000
+QUERY_WORD_RATE = 0.1
+
+
+def load_samples():
+    """Returns the sample queries, the word counts of the sample chunks and their words."""
+    with open(os.path.join(DATA_DIR, "queries.csv"), newline="") as f_in:
+        queries = [row[0] for row in csv.reader(f_in) if row]
+    with open(os.path.join(DATA_DIR, "retrieved_sources.json")) as f_in:
+        chunks = [
+            json.loads(source["page_content"]).get("text", "")
+            for response in json.load(f_in)
+            for source in response["response"]["source_documents"]
+        ]
+    lengths = [len(chunk.split()) for chunk in chunks]
+    words = [word for chunk in chunks for word in chunk.split()]
+    return queries, lengths, words
+
+
+def synthetic_corpus(n_rows: int, k: int = 5, seed: int = 0, pool_size: int = None):
+    """Lazily yields n_rows rows of a retrieved sources csv: the query, k sources and
+    k + 1 human relevances from 0 to 4. The sources are drawn from pool_size distinct
+    chunks, by default max(POOL_SIZE, n_rows).
+    """
+    rng = random.Random(seed)
+    queries, lengths, words = load_samples()
+    query_words = [word for query in queries for word in query.split()]
+    pool = [
+        " ".join(
+            (
+                rng.choice(query_words)
+                if rng.random() < QUERY_WORD_RATE
+                else rng.choice(words)
+            )
+            for _ in range(rng.choice(lengths))
+        )
+        for _ in range(pool_size or max(POOL_SIZE, n_rows))
+    ]
+    for _ in range(n_rows):
+        yield (
+            [rng.choice(queries)]
+            + rng.choices(pool, k=k)
+            + [str(rng.randint(0, 4)) for _ in range(k + 1)]
+        )
+
+
+def best_time(function, repeat: int) -> float:
+    """Returns the best wall time of `repeat` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(
+    n_rows: int,
+    k: int,
+    tokenizer: str,
+    repeat: int,
+    end_to_end: bool,
+    pool_size: int = None,
+) -> dict:
+    """Returns the best time in seconds of every benchmark on n_rows synthetic rows."""
+    rows = list(synthetic_corpus(n_rows, k, pool_size=pool_size))
+    queries = [row[0] for row in rows]
+    keywords = [get_keywords(query, tokenizer) for query in queries]
+    relevances = [
+        get_relevance_vector(row[1 : k + 1], row_keywords, tokenizer)
+        for row, row_keywords in zip(rows, keywords)
+    ]
+    gains = [row[k + 1 :] for row in rows]
+
+    def source_relevances():
+        for row, row_keywords in zip(rows, keywords):
+            for source in row[1 : k + 1]:
+                get_source_relevance(source, row_keywords, tokenizer)
+
+    benchmarks = {
+        "get_keywords": lambda: [get_keywords(query, tokenizer) for query in queries],
+        "get_source_relevance": source_relevances,
+        "precision at k": lambda: [precision_from_vector(r, k) for r in relevances],
+        "average precision": lambda: [
+            average_precision_from_vector(r, k) for r in relevances
+        ],
+        "mean reciprocal rank": lambda: [
+            reciprocal_rank_from_vector(r) for r in relevances
+        ],
+        "cumulative gain": lambda: [cumulative_gain(g) for g in gains],
+        "normalized discounted cumulative gain": lambda: [
+            normalized_discounted_cg(g) for g in gains
+        ],
+        "batch_metrics": lambda: batch_metrics(relevances, k, gains, query_slot=True),
+    }
+    results = {
+        name: best_time(function, repeat) for name, function in benchmarks.items()
+    }
+
+    if end_to_end:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_f = os.path.join(tmp_dir, "retrieved_sources.csv")
+            with open(input_f, mode="w", newline="") as f_out:
+                writer = csv.writer(f_out)
+                writer.writerow(["prompt"] + [f"source{i}" for i in range(1, k + 1)])
+                writer.writerows(rows)
+            output_f = os.path.join(tmp_dir, "metrics.csv")
+            results["generate_metrics"] = best_time(
+                lambda: generate_metrics(input_f, output_f, k, tokenizer=tokenizer),
+                repeat,
+            )
+            results["generate_metrics without interning"] = best_time(
+                lambda: generate_metrics(
+                    input_f, output_f, k, tokenizer=tokenizer, intern_max_chunks=0
+                ),
+                repeat,
+            )
+    return results
+
+
+def git_commit() -> str:
+    """Returns the current commit, or "unknown" outside of a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: list, baseline_f: str):
+    """Prints the speedup of every benchmark over the results of an earlier run."""
+    with open(baseline_f) as f_in:
+        baseline = {
+            (result["benchmark"], result["rows"]): result["seconds"]
+            for result in json.load(f_in)["results"]
+        }
+    for result in results:
+        before = baseline.get((result["benchmark"], result["rows"]))
+        if before:
+            print(
+                f"{result['benchmark']:>40} {result['rows']:>8}: "
+                f"{before / result['seconds']:6.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="numbers of rows, add 1000000 for the full sweep (slow with nltk)",
+    )
+    parser.add_argument("-k", type=int, default=5, help="number of sources")
+    parser.add_argument("--tokenizer", choices=sorted(TOKENIZERS), default="regex")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--max-end-to-end",
+        type=int,
+        default=100000,
+        help="largest size to run generate_metrics on (1M rows is a ~5 GB csv)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        help=f"distinct chunks the rows draw from, max({POOL_SIZE}, rows) by default",
+    )
+    parser.add_argument("--output", help="defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = []
+    for n_rows in args.sizes:
+        timings = run(
+            n_rows,
+            args.k,
+            args.tokenizer,
+            # one run is enough to time the largest corpora
+            args.repeat if n_rows < 1000000 else 1,
+            n_rows <= args.max_end_to_end,
+            args.pool_size,
+        )
+        for name, seconds in timings.items():
+            print(f"{name:>40} {n_rows:>8}: {seconds:9.3f} s")
+            results.append(
+                {
+                    "benchmark": name,
+                    "rows": n_rows,
+                    "seconds": seconds,
+                    "rows per second": n_rows / seconds if seconds else None,
+                }
+            )
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, mode="w") as f_out:
+        json.dump(
+            {
+                "commit": commit,
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "tokenizer": args.tokenizer,
+                "k": args.k,
+                "pool size": args.pool_size,
+                "results": results,
+            },
+            f_out,
+            indent=2,
+        )
+    print(output)
+    if args.compare:
+        compare(results, args.compare)
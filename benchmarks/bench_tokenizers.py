@@ -0,0 +1,65 @@
+"""Benchmarks the tokenizer backends on the sample queries and retrieved sources and
+checks that they produce the same keywords and relevances.
+
+    python -m benchmarks.bench_tokenizers
+"""
+
+import csv
+import json
+import os
+import time
+
+from rag_evaluation.calculate_retrieval_metrics import (get_keywords,
+                                                        get_source_relevance)
+from rag_evaluation.tokenizers import TOKENIZERS
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def load_data():
+    """Returns the queries and the (query, source texts) pairs of the sample data."""
+    with open(os.path.join(DATA_DIR, "queries.csv"), newline="") as f_in:
+        queries = [row[0] for row in csv.reader(f_in) if row]
+    with open(os.path.join(DATA_DIR, "retrieved_sources.json")) as f_in:
+        retrieved = [
+            (
+                response["query"],
+                [
+                    json.loads(source["page_content"]).get("text", "")
+                    for source in response["response"]["source_documents"]
+                ],
+            )
+            for response in json.load(f_in)
+        ]
+    return queries, retrieved
+
+
+def run(tokenizer: str, queries: list, retrieved: list, repeat: int = 5):
+    """Returns the best time of `repeat` runs, the keywords and the relevances."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        keywords = [get_keywords(query, tokenizer) for query in queries]
+        relevances = []
+        for query, sources in retrieved:
+            query_keywords = get_keywords(query, tokenizer)
+            relevances.append(
+                [
+                    get_source_relevance(source, query_keywords, tokenizer)
+                    for source in sources
+                ]
+            )
+        best = min(best, time.perf_counter() - start)
+    return best, keywords, relevances
+
+
+if __name__ == "__main__":
+    queries, retrieved = load_data()
+    results = {name: run(name, queries, retrieved) for name in TOKENIZERS}
+    reference = results["nltk"]
+    for name, (seconds, keywords, relevances) in results.items():
+        identical = keywords == reference[1] and relevances == reference[2]
+        print(
+            f"{name:>6}: {seconds * 1000:8.1f} ms  "
+            f"({reference[0] / seconds:5.1f}x)  identical to nltk: {identical}"
+        )
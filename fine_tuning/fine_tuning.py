@@ -1,96 +1,324 @@
 """Script to fine tune model.
 """
-import pandas as pd
+
+import argparse
+import hashlib
+import math
+import os
+
 import numpy as np
-from sklearn.model_selection import train_test_split
-from sentence_transformers import SentenceTransformer, InputExample, losses
-from torch.utils.data import DataLoader
+import pandas as pd
 from scipy.stats import spearmanr
-import os
-from tqdm import tqdm
 from sklearn.metrics import mean_squared_error
-import torch
-from google.colab import drive
 
-drive.mount('/content/drive')
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Using device: {device}")
+try:
+    # the base of PairDataset, the pairs can be read without torch installed
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset, get_worker_info = object, lambda: None
+
+
+def get_device():
+    """Returns the GPU if there is one, otherwise the CPU."""
+    import torch  # heavy, only imported to train or encode
+
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _input_example(texts, label):
+    from sentence_transformers import InputExample
+
+    return InputExample(texts=texts, label=label)
+
+
+def _name_question(df):
+    """Names the unnamed index column of the question "question", in memory only."""
+    return df.rename(columns={"Unnamed: 0": "question"})
+
+
+def load_and_preprocess_data(file_path, chunksize=None):
+    """Reads the csv of judged pairs without modifying it. With a chunksize, lazily
+    yields data frames of at most chunksize rows instead.
+    """
+    if chunksize is None:
+        return _name_question(pd.read_csv(file_path))
+    return (
+        _name_question(chunk) for chunk in pd.read_csv(file_path, chunksize=chunksize)
+    )
+
 
+def long_pairs(df, k=5):
+    """Reshapes the wide rows (question, source1..k, relevance1..k) to one row per
+    judged pair: the lowercase question and source, and the relevance scaled to
+    [0, 1]. Unrated (-1 or empty) pairs and repeated pairs are dropped.
+    """
+    questions = np.repeat(df["question"].astype(str).to_numpy(), k)
+    sources = df[[f"source{i}" for i in range(1, k + 1)]].astype(str).to_numpy()
+    relevances = df[[f"relevance{i}" for i in range(1, k + 1)]].to_numpy(
+        dtype=np.float64
+    )
+    rated = ~np.isnan(relevances) & (relevances != -1)
+    pairs = pd.DataFrame(
+        {
+            "question": questions[rated.ravel()],
+            "source": sources[rated],
+            "label": relevances[rated] / 4.0,
+        }
+    )
+    pairs["question"] = pairs["question"].str.lower().str.strip()
+    pairs["source"] = pairs["source"].str.lower().str.strip()
+    return pairs.drop_duplicates(["question", "source"], ignore_index=True)
 
-data_file = '/content/drive/MyDrive/embeddings/responses.csv'
-model_name = 'all-MiniLM-L6-v2'
-epochs = 3
-batch_size = 16
-output_dir = '/content/drive/MyDrive/embeddings/fine_tuned_model'
 
+def pair_hashes(pairs):
+    """Returns a stable 64 bit hash of every (question, source) pair."""
+    return pd.util.hash_pandas_object(pairs[["question", "source"]], index=False)
 
-def load_and_preprocess_data(file_path):
-    df = pd.read_csv(file_path)
-    if 'Unnamed: 0' in df.columns:
-        df.rename(columns={'Unnamed: 0': 'question'}, inplace=True)
-        df.to_csv(file_path, index=False)
-    return df
 
-def prepare_training_data(df):
+def prepare_training_data(df, example=_input_example):
     return [
-        InputExample(texts=[str(row['question']).lower().strip(),
-                            str(row[f'source{i}']).lower().strip()],
-                     label=float(row[f'relevance{i}']) / 4.0)
-        for _, row in df.iterrows()
-        for i in range(1, 6)
-        if not pd.isna(row[f'relevance{i}']) and row[f'relevance{i}'] != -1
+        example([question, source], label)
+        for question, source, label in long_pairs(df).itertuples(index=False)
     ]
 
-def fine_tune_model(training_examples, model_name='all-MiniLM-L6-v2', epochs=3, batch_size=16):
+
+def _shuffled(examples, buffer_size, rng):
+    """Yields the examples in a random order within a window of buffer_size."""
+    buffer = []
+    for example in examples:
+        if len(buffer) < buffer_size:
+            buffer.append(example)
+            continue
+        i = rng.integers(buffer_size)
+        yield buffer[i]
+        buffer[i] = example
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class PairDataset(IterableDataset):
+    """Lazily reads the judged pairs of a csv file, chunksize rows at a time, and
+    yields them as InputExamples (or what `example` makes of the texts and the label),
+    so the pairs are never all in memory.
+
+    `split` keeps the "train" or "test" pairs: a pair is a test pair when its hash
+    falls in the first `test_size` of the hash range, so both splits are stable
+    across runs and workers. Repeated pairs are only yielded once (per DataLoader
+    worker, which each read every num_workers-th chunk). With a shuffle_buffer, the
+    pairs are shuffled within a window of that many pairs, in a new order every epoch.
+    """
+
+    def __init__(
+        self,
+        file_path,
+        split=None,
+        test_size=0.2,
+        k=5,
+        chunksize=10000,
+        shuffle_buffer=0,
+        seed=42,
+        example=_input_example,
+    ):
+        if split not in (None, "train", "test"):
+            raise ValueError(f"unknown split {split!r}, expected 'train' or 'test'")
+        self.file_path = file_path
+        self.split = split
+        self.test_size = test_size
+        self.k = k
+        self.chunksize = chunksize
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.example = example
+        self.epoch = 0
+
+    def _pairs(self, worker_id, num_workers):
+        seen = set()
+        chunks = load_and_preprocess_data(self.file_path, self.chunksize)
+        for n, chunk in enumerate(chunks):
+            if n % num_workers != worker_id:
+                continue
+            pairs = long_pairs(chunk, self.k)
+            hashes = pair_hashes(pairs).to_numpy()
+            keep = np.array([h not in seen for h in hashes.tolist()], dtype=bool)
+            seen.update(hashes[keep].tolist())
+            if self.split is not None:
+                test = hashes < np.uint64(self.test_size * 2.0**64)
+                keep &= test if self.split == "test" else ~test
+            for question, source, label in pairs[keep].itertuples(index=False):
+                yield self.example([question, source], label)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker is None else (worker.id, worker.num_workers)
+        )
+        examples = self._pairs(worker_id, num_workers)
+        if self.shuffle_buffer:
+            # workers get a fresh copy of the dataset every epoch, their epochs are
+            # told apart by the seed the DataLoader draws for them each epoch
+            worker_seed = 0 if worker is None else worker.seed
+            rng = np.random.default_rng([self.seed, self.epoch, worker_seed])
+            examples = _shuffled(examples, self.shuffle_buffer, rng)
+        self.epoch += 1
+        return iter(examples)
+
+
+def fine_tune_model(
+    training_examples,
+    model_name="all-MiniLM-L6-v2",
+    epochs=3,
+    batch_size=16,
+    num_workers=0,
+    steps_per_epoch=None,
+):
+    """Fine tunes the model on a list of InputExamples, or on a PairDataset read by
+    num_workers DataLoader workers (counting its batches first if steps_per_epoch
+    is not given).
+    """
+    from sentence_transformers import SentenceTransformer, losses
+    from torch.utils.data import DataLoader
+
     model = SentenceTransformer(model_name)
-    model = model.to(device)
-    train_dataloader = DataLoader(training_examples, shuffle=True, batch_size=batch_size)
+    model = model.to(get_device())
+    streamed = isinstance(training_examples, IterableDataset)
+    train_dataloader = DataLoader(
+        training_examples,
+        shuffle=not streamed,
+        batch_size=batch_size,
+        num_workers=num_workers,
+    )
+    if streamed and steps_per_epoch is None:
+        steps_per_epoch = math.ceil(sum(1 for _ in training_examples) / batch_size)
     train_loss = losses.CosineSimilarityLoss(model)
-    model.fit(train_objectives=[(train_dataloader, train_loss)], epochs=epochs, warmup_steps=100, show_progress_bar=True)
+    model.fit(
+        train_objectives=[(train_dataloader, train_loss)],
+        epochs=epochs,
+        steps_per_epoch=steps_per_epoch,
+        warmup_steps=100,
+        show_progress_bar=True,
+    )
     return model
 
-def evaluate_model(model, test_examples):
-    true_scores, pred_scores = [], []
-    for example in tqdm(test_examples):
-        true_score = example.label
-        embeddings = model.encode(example.texts, device=device)
-        pred_score = np.dot(embeddings[0], embeddings[1]) / (np.linalg.norm(embeddings[0]) * np.linalg.norm(embeddings[1]))
-        true_scores.append(true_score)
-        pred_scores.append(pred_score)
 
-    true_scores, pred_scores = np.array(true_scores), np.array(pred_scores)
+def text_key(text):
+    """Returns the cache key of a text, a hash so long sources are not kept twice."""
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def encode_texts(model, texts, cache=None, batch_size=256):
+    """Returns the unit-length embeddings of the texts, one row per text. Every
+    distinct text is encoded once, in batches, and the texts already in the cache
+    (a dict of text hash -> embedding for this model) are not encoded again.
+    """
+    cache = {} if cache is None else cache
+    keys = [text_key(text) for text in texts]
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cache:
+            missing.setdefault(key, text)
+    if missing:
+        embeddings = model.encode(
+            list(missing.values()),
+            batch_size=batch_size,
+            convert_to_numpy=True,
+        ).astype(np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms == 0, 1, norms)
+        cache.update(zip(missing, embeddings))
+    return np.stack([cache[key] for key in keys])
+
+
+def evaluate_model(model, test_examples, cache=None, batch_size=256, model_key=None):
+    """Returns the Spearman correlation and the mean squared error of the cosine
+    similarities of the example pairs against their labels, and both as arrays.
+    The embeddings are kept in cache[model_key] (the model name, by default the
+    model itself), so one cache can be passed to the evaluations of every model.
+    """
+    cache = {} if cache is None else cache
+    model_cache = cache.setdefault(model if model_key is None else model_key, {})
+    true_scores = np.array([example.label for example in test_examples])
+    # questions and sources are encoded together, a text shared by both only once
+    texts = [example.texts[0] for example in test_examples]
+    texts += [example.texts[1] for example in test_examples]
+    embeddings = encode_texts(model, texts, model_cache, batch_size)
+    questions, sources = np.split(embeddings, 2)
+    # the cosine of every pair at once, the embeddings have unit length
+    pred_scores = np.einsum("ij,ij->i", questions, sources)
+
     correlation, p_value = spearmanr(true_scores, pred_scores)
     mse = mean_squared_error(true_scores, pred_scores)
     return correlation, mse, true_scores, pred_scores
 
 
-df = load_and_preprocess_data(data_file)
-training_examples = prepare_training_data(df)
-train_examples, test_examples = train_test_split(training_examples, test_size=0.2, random_state=42)
-
-model = fine_tune_model(train_examples, model_name=model_name, epochs=epochs, batch_size=batch_size)
-
-os.makedirs(output_dir, exist_ok=True)
-model.save(os.path.join(output_dir, 'fine_tuned_model'))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("data_file", nargs="?", default="./data/responses.csv")
+    parser.add_argument("output_dir", nargs="?", default="./fine_tuned_model")
+    parser.add_argument("--model-name", default="all-MiniLM-L6-v2")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=0, help="DataLoader workers")
+    parser.add_argument(
+        "--chunksize", type=int, default=10000, help="csv rows read at once"
+    )
+    parser.add_argument("--shuffle-buffer", type=int, default=10000)
+    parser.add_argument(
+        "--encode-batch-size", type=int, default=256, help="for the evaluation"
+    )
+    args = parser.parse_args()
+    from sentence_transformers import SentenceTransformer
 
+    device = get_device()
+    print(f"Using device: {device}")
 
-base_model = SentenceTransformer(model_name)
-fine_tuned_model = SentenceTransformer(os.path.join(output_dir, 'fine_tuned_model'))
+    train_examples = PairDataset(
+        args.data_file,
+        "train",
+        chunksize=args.chunksize,
+        shuffle_buffer=args.shuffle_buffer,
+    )
+    test_examples = list(PairDataset(args.data_file, "test", chunksize=args.chunksize))
 
-base_corr, base_mse, base_true, base_pred = evaluate_model(base_model, test_examples)
-ft_corr, ft_mse, ft_true, ft_pred = evaluate_model(fine_tuned_model, test_examples)
+    model = fine_tune_model(
+        train_examples,
+        model_name=args.model_name,
+        epochs=args.epochs,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+    )
 
-print(f"Base Model - Correlation: {base_corr:.4f}, MSE: {base_mse:.4f}")
-print(f"Fine-tuned Model - Correlation: {ft_corr:.4f}, MSE: {ft_mse:.4f}")
+    os.makedirs(args.output_dir, exist_ok=True)
+    model.save(os.path.join(args.output_dir, "fine_tuned_model"))
 
-# Cell 7: Qualitative Analysis
-for i in range(min(5, len(test_examples))):
-    example = test_examples[i]
-    print(f"\nQuestion: {example.texts[0]}")
-    print(f"Source: {example.texts[1][:100]}...")
-    print(f"True Score: {example.label:.4f}")
-    print(f"Base Model Prediction: {base_pred[i]:.4f}")
-    print(f"Fine-tuned Model Prediction: {ft_pred[i]:.4f}")
+    base_model = SentenceTransformer(args.model_name, device=str(device))
+    fine_tuned_model = SentenceTransformer(
+        os.path.join(args.output_dir, "fine_tuned_model"), device=str(device)
+    )
 
+    cache = {}
+    base_corr, base_mse, base_true, base_pred = evaluate_model(
+        base_model,
+        test_examples,
+        cache,
+        args.encode_batch_size,
+        model_key=args.model_name,
+    )
+    ft_corr, ft_mse, ft_true, ft_pred = evaluate_model(
+        fine_tuned_model,
+        test_examples,
+        cache,
+        args.encode_batch_size,
+        model_key=os.path.join(args.output_dir, "fine_tuned_model"),
+    )
 
+    print(f"Base Model - Correlation: {base_corr:.4f}, MSE: {base_mse:.4f}")
+    print(f"Fine-tuned Model - Correlation: {ft_corr:.4f}, MSE: {ft_mse:.4f}")
 
+    # Cell 7: Qualitative Analysis
+    for i in range(min(5, len(test_examples))):
+        example = test_examples[i]
+        print(f"\nQuestion: {example.texts[0]}")
+        print(f"Source: {example.texts[1][:100]}...")
+        print(f"True Score: {example.label:.4f}")
+        print(f"Base Model Prediction: {base_pred[i]:.4f}")
+        print(f"Fine-tuned Model Prediction: {ft_pred[i]:.4f}")
@@ -0,0 +1,122 @@
+"""Agreement between the human and the generated (keyword scorer) binary relevances.
+
+All the judgments are scored at once: the confusion matrix of every rank is counted
+with a single integer bincount, and the precision, recall and Cohen's kappa of the
+keyword scorer are computed from the matrices, for every rank and overall.
+"""
+
+import argparse
+import json
+import math
+
+import numpy as np
+
+from rag_evaluation.calculate_retrieval_metrics import read_relevance_matrix
+
+
+def human_columns(k: int = 5) -> list:
+    return [f"source {i} human binary relevance" for i in range(1, k + 1)]
+
+
+def generated_columns(k: int = 5) -> list:
+    return [f"source {i} generated binary relevance" for i in range(1, k + 1)]
+
+
+def rating_columns(k: int = 5) -> list:
+    return [f"source {i} human relevance" for i in range(1, k + 1)]
+
+
+def read_judgments(input_f: str, k: int = 5) -> tuple:
+    """Reads the N x k human and generated binary relevances of data.csv (or its `.npz`
+    table). Sources without a human rating are marked -1 so they are not counted.
+    """
+    human = read_relevance_matrix(input_f, human_columns(k))
+    generated = read_relevance_matrix(input_f, generated_columns(k))
+    ratings = read_relevance_matrix(input_f, rating_columns(k))
+    human[ratings < 0] = -1
+    return human, generated
+
+
+def confusion_matrices(human, generated):
+    """Returns the ranks x 2 x 2 confusion matrices of N x ranks binary relevance
+    matrices, indexed [rank, generated, human]. Judgments where either relevance is
+    negative (missing) are left out.
+    """
+    human = np.asarray(human, dtype=np.int64)
+    generated = np.asarray(generated, dtype=np.int64)
+    if human.shape != generated.shape or human.ndim != 2:
+        raise ValueError(
+            f"expected two N x ranks matrices, got {human.shape} and {generated.shape}"
+        )
+    valid = (human >= 0) & (generated >= 0)
+    if np.any(valid & ((human > 1) | (generated > 1))):
+        raise ValueError("relevances must be binary (0 or 1), or negative if missing")
+
+    # one code per judgment: 4 cells for every rank
+    ranks = human.shape[1]
+    codes = np.arange(ranks) * 4 + generated * 2 + human
+    return np.bincount(codes[valid], minlength=4 * ranks).reshape(ranks, 2, 2)
+
+
+def scores(cm) -> dict:
+    """Returns the judgment count, precision, recall, agreement and Cohen's kappa of the
+    generated relevances for a 2 x 2 confusion matrix, or element-wise for a stack of
+    them. Undefined ratios (e.g. no generated positives) are nan.
+    """
+    cm = np.asarray(cm)
+    tn, fn = cm[..., 0, 0], cm[..., 0, 1]
+    fp, tp = cm[..., 1, 0], cm[..., 1, 1]
+    n = cm.sum(axis=(-2, -1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        observed = (tp + tn) / n
+        # the agreement expected by chance from the marginals
+        expected = ((tp + fp) * (tp + fn) + (tn + fn) * (tn + fp)) / n.astype(
+            np.float64
+        ) ** 2
+        return {
+            "judgments": n,
+            "precision": tp / (tp + fp),
+            "recall": tp / (tp + fn),
+            "agreement": observed,
+            "kappa": (observed - expected) / (1 - expected),
+        }
+
+
+def agreement(human, generated) -> dict:
+    """Returns the confusion matrices and scores of every rank ("ranks") and of all
+    the judgments together ("overall"), see confusion_matrices and scores.
+    """
+    cms = confusion_matrices(human, generated)
+    overall = cms.sum(axis=0)
+    return {
+        "ranks": {"confusion matrix": cms, **scores(cms)},
+        "overall": {"confusion matrix": overall, **scores(overall)},
+    }
+
+
+def to_json(value):
+    """Converts the arrays of an agreement result to lists, and nan to None."""
+    if isinstance(value, dict):
+        return {key: to_json(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return to_json(value.tolist())
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", nargs="?", default="./data/data.csv")
+    parser.add_argument("output", nargs="?", default="./data/agreement.json")
+    parser.add_argument("-k", type=int, default=5, help="number of sources")
+    args = parser.parse_args()
+
+    result = agreement(*read_judgments(args.input, args.k))
+    with open(args.output, mode="w") as f_out:
+        json.dump(to_json(result), f_out, indent=2)
+    print(json.dumps(to_json(result["overall"])))
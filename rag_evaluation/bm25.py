@@ -0,0 +1,360 @@
+"""In-process BM25 retriever over the chunks of saved policy-chat responses, a local
+stand-in for the policy-chat service.
+
+The chunks are indexed once as a sparse terms x chunks matrix of BM25 weights, so a
+batch of queries is scored with sparse matrix products, one per block of chunks, and
+the running top k chunks of every query are picked with argpartition. The index is saved as one `.npz` file, and
+the responses have the `source_documents` shape of policy-chat, so `get_source_texts`
+and the rest of the pipeline read them unchanged.
+
+    python -m rag_evaluation.bm25 build data/retrieved_sources.json data/bm25_index.npz
+    python -m rag_evaluation.bm25 retrieve data/bm25_index.npz data/queries.csv out.csv
+"""
+
+import argparse
+import csv
+import itertools
+import json
+
+import numpy as np
+from scipy import sparse
+
+from rag_evaluation import instrumentation
+from rag_evaluation.calculate_retrieval_metrics import (COMMON_WORDS,
+                                                        string_format)
+from rag_evaluation.columnar import decode_strings, encode_strings
+from rag_evaluation.jsonl import JsonlWriter, read_jsonl
+from rag_evaluation.retrieve_documents import (get_source_texts, headers,
+                                               read_queries)
+from rag_evaluation.tokenizers import get_tokenizer
+
+# bump when the layout of the saved index changes
+INDEX_VERSION = 1
+
+# bytes of the temporary arrays of one block of a search
+SEARCH_MEMORY = 64 * 2**20
+
+
+def analyze(text: str, tokenizer: str = "regex") -> list:
+    """Returns the terms of a text: formatted, tokenized and without the stop words."""
+    words = get_tokenizer(tokenizer)(string_format(text))
+    return [word for word in words if word not in COMMON_WORDS]
+
+
+def read_chunks(path: str = "./data/retrieved_sources.json") -> list:
+    """Returns the distinct source documents of saved policy-chat responses, in order of
+    first appearance. The file is either a JSON list of {"query", "response"} records
+    (retrieved_sources.json) or the JSON Lines written by retrieve_documents.
+    """
+    if str(path).endswith(".jsonl"):
+        records = read_jsonl(path)
+    else:
+        with open(path) as f_in:
+            records = json.load(f_in)
+
+    documents = {}
+    for record in records:
+        for document in record["response"].get("source_documents", []):
+            documents.setdefault(document["page_content"], document)
+    return list(documents.values())
+
+
+def top_k(scores, k: int, offset: int = 0) -> tuple:
+    """Returns the indices (plus offset) and scores of the k largest scores of every row
+    of a queries x documents array, in no particular order.
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(k), scores.shape)
+    return top + offset, np.take_along_axis(scores, top, axis=1)
+
+
+def block_rows(
+    queries: int, dimension: int, memory: int = SEARCH_MEMORY, itemsize: int = 4
+) -> int:
+    """Returns the number of document rows to score at once so that the temporary
+    arrays of a block (its dense vectors, the scores and their top k partition) of a
+    batch of queries take about `memory` bytes, for scores of `itemsize` bytes.
+    """
+    return max(1, memory // (itemsize * dimension + (2 * itemsize + 8) * queries))
+
+
+def merge_top_k(top, top_scores, block_top, block_scores, k: int) -> tuple:
+    """Returns the running top k of every query among the previous best and the best
+    of a block, see top_k.
+    """
+    candidates = np.concatenate([top, block_top], axis=1)
+    candidate_scores = np.concatenate([top_scores, block_scores], axis=1)
+    best, top_scores = top_k(candidate_scores, k)
+    return np.take_along_axis(candidates, best, axis=1), top_scores
+
+
+def sort_by_score(top, top_scores) -> tuple:
+    """Sorts the top documents of every query by decreasing score, ties by index."""
+    order = np.lexsort((top, -top_scores), axis=1)
+    return (
+        np.take_along_axis(top, order, axis=1),
+        np.take_along_axis(top_scores, order, axis=1),
+    )
+
+
+def to_responses(documents: list, queries: list, top, top_scores) -> list:
+    """Returns a policy-chat style response to every query: the query, an empty result
+    and its top documents, with their score in the metadata.
+    """
+    return [
+        {
+            "query": query,
+            "result": "",
+            "source_documents": [
+                {
+                    **documents[index],
+                    "metadata": {
+                        **documents[index].get("metadata", {}),
+                        "score": score,
+                    },
+                }
+                for index, score in zip(indices.tolist(), scores.tolist())
+            ],
+        }
+        for query, indices, scores in zip(queries, top, top_scores)
+    ]
+
+
+class BM25Index:
+    """BM25 index of source documents ({"page_content", "metadata"} as returned by
+    policy-chat). Build it with `BM25Index.build(read_chunks(path))`.
+    """
+
+    def __init__(
+        self,
+        documents: list,
+        vocabulary: dict,
+        weights,
+        k1: float = 1.5,
+        b: float = 0.75,
+        tokenizer: str = "regex",
+    ):
+        self.documents = documents
+        self.vocabulary = vocabulary
+        self.weights = weights  # terms x documents, csr
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer
+
+    @classmethod
+    def build(
+        cls, documents: list, k1: float = 1.5, b: float = 0.75, tokenizer="regex"
+    ):
+        """Indexes the text of every document (see get_source_texts)."""
+        if not isinstance(tokenizer, str):
+            raise ValueError("the tokenizer must be given by name to save the index")
+        vocabulary = {}
+        term_ids, indptr = [], [0]
+        for text in get_source_texts({"source_documents": documents}):
+            term_ids.extend(
+                vocabulary.setdefault(term, len(vocabulary))
+                for term in analyze(text, tokenizer)
+            )
+            indptr.append(len(term_ids))
+
+        # documents x terms counts, the repeated terms are summed
+        counts = sparse.csr_matrix(
+            (np.ones(len(term_ids)), np.array(term_ids, dtype=np.int64), indptr),
+            shape=(len(documents), len(vocabulary)),
+        )
+        counts.sum_duplicates()
+
+        n_documents = len(documents)
+        lengths = np.diff(indptr).astype(np.float64)
+        average_length = lengths.mean() if n_documents and lengths.any() else 1.0
+        frequencies = np.bincount(counts.indices, minlength=len(vocabulary))
+        # the Lucene idf, never negative for terms in most documents
+        idf = np.log1p((n_documents - frequencies + 0.5) / (frequencies + 0.5))
+
+        rows = np.repeat(np.arange(n_documents), np.diff(counts.indptr))
+        tf = counts.data
+        norms = k1 * (1 - b + b * lengths[rows] / average_length)
+        counts.data = idf[counts.indices] * tf * (k1 + 1) / (tf + norms)
+        return cls(documents, vocabulary, counts.T.tocsr(), k1, b, tokenizer)
+
+    def _query_matrix(self, queries: list):
+        """Returns the queries x terms counts of the indexed terms of the queries."""
+        term_ids, indptr = [], [0]
+        for query in queries:
+            term_ids.extend(
+                self.vocabulary[term]
+                for term in analyze(query, self.tokenizer)
+                if term in self.vocabulary
+            )
+            indptr.append(len(term_ids))
+        return sparse.csr_matrix(
+            (np.ones(len(term_ids)), np.array(term_ids, dtype=np.int64), indptr),
+            shape=(len(queries), len(self.vocabulary)),
+        )
+
+    def search(
+        self,
+        queries: list,
+        k: int = 5,
+        block_size: int = None,
+        memory: int = SEARCH_MEMORY,
+    ) -> tuple:
+        """Returns the indices and BM25 scores of the top k documents of every query,
+        as two queries x k arrays sorted by decreasing score (ties by document order).
+        The documents are scored block_size at a time, by default as many as fit
+        `memory` bytes (see block_rows).
+        """
+        matrix = self._query_matrix(queries)
+        # only the rows of the query terms, by document to slice the blocks
+        terms = np.unique(matrix.indices)
+        matrix = matrix[:, terms]
+        weights = self.weights[terms].tocsc()
+        if block_size is None:
+            block_size = block_rows(len(queries), 0, memory, itemsize=8)
+
+        top = np.empty((len(queries), 0), dtype=np.int64)
+        top_scores = np.empty((len(queries), 0))
+        for start in range(0, weights.shape[1], block_size):
+            scores = (matrix @ weights[:, start : start + block_size]).toarray()
+            top, top_scores = merge_top_k(top, top_scores, *top_k(scores, k, start), k)
+        return sort_by_score(top, top_scores)
+
+    def retrieve(self, queries: list, k: int = 5) -> list:
+        """Returns a policy-chat style response to every query, see to_responses."""
+        instrumentation.count("bm25 queries", len(queries))
+        return to_responses(self.documents, queries, *self.search(queries, k))
+
+    def save(self, path: str):
+        """Saves the index to a compressed `.npz` file."""
+        terms_data, terms_offsets = encode_strings(list(self.vocabulary))
+        documents_data, documents_offsets = encode_strings(
+            [json.dumps(document) for document in self.documents]
+        )
+        np.savez_compressed(
+            path,
+            version=INDEX_VERSION,
+            k1=self.k1,
+            b=self.b,
+            tokenizer=self.tokenizer,
+            terms_data=terms_data,
+            terms_offsets=terms_offsets,
+            documents_data=documents_data,
+            documents_offsets=documents_offsets,
+            weights_data=self.weights.data,
+            weights_indices=self.weights.indices,
+            weights_indptr=self.weights.indptr,
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads an index saved with `save`."""
+        with np.load(path) as saved:
+            if saved["version"] != INDEX_VERSION:
+                raise ValueError(
+                    f"{path} is a version {saved['version']} index, "
+                    f"expected version {INDEX_VERSION}"
+                )
+            terms = decode_strings(saved["terms_data"], saved["terms_offsets"])
+            documents = [
+                json.loads(document)
+                for document in decode_strings(
+                    saved["documents_data"], saved["documents_offsets"]
+                )
+            ]
+            weights = sparse.csr_matrix(
+                (
+                    saved["weights_data"],
+                    saved["weights_indices"],
+                    saved["weights_indptr"],
+                ),
+                shape=(len(terms), len(documents)),
+            )
+            return cls(
+                documents,
+                {term: i for i, term in enumerate(terms)},
+                weights,
+                float(saved["k1"]),
+                float(saved["b"]),
+                str(saved["tokenizer"]),
+            )
+
+
+def generate_responses(
+    index,
+    input: str,
+    output: str,
+    k: int = 5,
+    batch_size: int = 1024,
+    responses_f: str = None,
+    report_f: str = None,
+):
+    """Writes the top k sources of every query in a csv file of queries like
+    retrieve_documents.generate_responses, and optionally every response to a JSON
+    Lines file. The index is any in-process index with a `retrieve(queries, k)`
+    method, and the queries are retrieved in batches, so memory stays bounded.
+    """
+    with instrumentation.reporting(report_f), instrumentation.stage("retrieval"):
+        with open(output, mode="w", newline="") as f_out:
+            jsonl_writer = JsonlWriter(responses_f) if responses_f else None
+            try:
+                writer = csv.writer(f_out)
+                writer.writerow(headers(k))
+                queries = read_queries(input)
+                while batch := list(itertools.islice(queries, batch_size)):
+                    for response in index.retrieve(batch, k):
+                        writer.writerow(
+                            [response["query"]] + get_source_texts(response) + [""]
+                        )
+                        if jsonl_writer is not None:
+                            jsonl_writer.write(
+                                {"query": response["query"], "response": response}
+                            )
+            finally:
+                if jsonl_writer is not None:
+                    jsonl_writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="index the chunks of saved responses")
+    build.add_argument("input", nargs="?", default="./data/retrieved_sources.json")
+    build.add_argument("output", nargs="?", default="./data/bm25_index.npz")
+    build.add_argument("--k1", type=float, default=1.5)
+    build.add_argument("--b", type=float, default=0.75)
+    build.add_argument("--tokenizer", default="regex")
+
+    retrieve = commands.add_parser("retrieve", help="retrieve the sources of queries")
+    retrieve.add_argument("index", nargs="?", default="./data/bm25_index.npz")
+    retrieve.add_argument("input", nargs="?", default="./data/queries.csv")
+    retrieve.add_argument("output", nargs="?", default="./data/retrieved_sources.csv")
+    retrieve.add_argument("-k", type=int, default=5, help="number of sources")
+    retrieve.add_argument("--batch-size", type=int, default=1024)
+    retrieve.add_argument("--responses", help="also write the responses as JSON Lines")
+    retrieve.add_argument(
+        "--report",
+        action="store_true",
+        help="write timings and counters to <output>.report.json",
+    )
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = BM25Index.build(
+            read_chunks(args.input), args.k1, args.b, args.tokenizer
+        )
+        index.save(args.output)
+        print(f"indexed {len(index.documents)} chunks, {len(index.vocabulary)} terms")
+    else:
+        generate_responses(
+            BM25Index.load(args.index),
+            args.input,
+            args.output,
+            args.k,
+            args.batch_size,
+            args.responses,
+            instrumentation.report_path(args.output) if args.report else None,
+        )
@@ -0,0 +1,122 @@
+"""Persistent key/value cache stored in SQLite, shared by the pipeline stages.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def make_key(*parts) -> str:
+    """Returns a content hash of the given JSON serializable parts to use as a cache key."""
+    content = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class CacheMissError(KeyError):
+    """Raised when a value has to come from the cache (e.g. offline) but is not cached."""
+
+
+class DiskCache:
+    """Caches JSON serializable values on disk by key. Once the cache holds more than
+    `max_entries` values, the least recently used ones are evicted on commit. Values
+    older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(self, path: str, max_entries: int = None, ttl: float = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used INTEGER NOT NULL, "
+            "created REAL NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(cache)")]
+        if "created" not in columns:
+            self.conn.execute(
+                "ALTER TABLE cache ADD COLUMN created REAL NOT NULL DEFAULT 0"
+            )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)"
+        )
+        # logical clock for the least recently used order
+        (self._clock,) = self.conn.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM cache"
+        ).fetchone()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        return count
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def get(self, key: str, default=None):
+        """Returns the cached value for the key, or default if it is not cached or expired."""
+        row = self.conn.execute(
+            "SELECT value, created FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and self.ttl is not None and time.time() - row[1] > self.ttl:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            row = None
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.conn.execute(
+            "UPDATE cache SET last_used = ? WHERE key = ?", (self._tick(), key)
+        )
+        return json.loads(row[0])
+
+    def put(self, key: str, value):
+        """Caches a value under the key, replacing any previous value."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, last_used, created) "
+            "VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), self._tick(), time.time()),
+        )
+
+    def evict(self) -> int:
+        """Removes the least recently used values above max_entries. Returns the number removed."""
+        if self.max_entries is None:
+            return 0
+        excess = len(self) - self.max_entries
+        if excess <= 0:
+            return 0
+        self.conn.execute(
+            "DELETE FROM cache WHERE key IN "
+            "(SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        return excess
+
+    def commit(self):
+        """Evicts down to max_entries and writes the pending changes to disk."""
+        self.evict()
+        self.conn.commit()
+
+    def close(self):
+        """Commits and closes the cache."""
+        self.commit()
+        self.conn.close()
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counts of this session and the number of cached values."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit rate": round(self.hits / lookups, 3) if lookups else 0,
+            "entries": len(self),
+        }
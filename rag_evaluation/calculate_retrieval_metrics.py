@@ -1,23 +1,35 @@
 """Generates a csv file containing the metrics for a prompt in separate columns.
 """
 
+import argparse
+import contextlib
 import csv
+import hashlib
+import json
 import math  # for logarithmic discount
 import os
 import string
+import sys
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
-import nltk  # for word tokenization
-from nltk.corpus import stopwords
+from rag_evaluation import instrumentation
+from rag_evaluation.cache import DiskCache, make_key
+from rag_evaluation.stopwords import ENGLISH_STOPWORDS
+from rag_evaluation.tokenizers import TOKENIZERS, get_tokenizer
 
-try:
-    nltk.data.find("tokenizers/punkt")
-except LookupError:
-    nltk.download("punkt")
+# bump whenever a change to the scoring changes the metric values
+SCORER_VERSION = "1"
 
-try:
-    nltk.data.find("corpora/stopwords")
-except LookupError:
-    nltk.download("stopwords")
+# words that are never keywords, built once per process
+COMMON_WORDS = ENGLISH_STOPWORDS.union({"•"})
+
+# bounds of the chunk interner of a run (or of each worker): chunks and words kept
+INTERN_MAX_CHUNKS = 10000
+INTERN_MAX_WORDS = 2**18
+
+# largest csv field that is read, chunks of source text can be very long
+FIELD_SIZE_LIMIT = 2**31 - 1
 
 
 def string_format(sentence: str) -> str:
@@ -27,18 +39,17 @@ def string_format(sentence: str) -> str:
     return sentence
 
 
-def get_keywords(query: str) -> set:
+def get_keywords(query: str, tokenizer="nltk") -> set:
     """Takes a query and extracts keywords to put in a separate set."""
     # format and tokenize the query
     query = string_format(query)
-    words = nltk.word_tokenize(query)  # returns a list
+    words = get_tokenizer(tokenizer)(query)  # returns a list
 
     # remove common stop words from the list
-    common_words = set(stopwords.words("english")).union({"•"})
     keywords = set()
     for word in words:
         # skip over common words
-        if word in common_words:
+        if word in COMMON_WORDS:
             continue
 
         # add keywords to a new set
@@ -46,11 +57,11 @@ def get_keywords(query: str) -> set:
     return keywords
 
 
-def get_source_relevance(source: str, keywords: set) -> int:
+def get_source_relevance(source: str, keywords: set, tokenizer="nltk") -> int:
     """Returns 1 if a source is relevant, 0 otherwise based on searching for keywords."""
     # format and tokenize the source
     source = string_format(source)
-    source_words = nltk.word_tokenize(source)
+    source_words = get_tokenizer(tokenizer)(source)
 
     match_count = 0  # to keep track of how many keywords are in a source_words
 
@@ -66,61 +77,154 @@ def get_source_relevance(source: str, keywords: set) -> int:
     return 0
 
 
-def get_total_relevance(sources: list, keywords: set, k: int) -> int:
-    """Returns an int representing the number of relevant sources out of the top k sources."""
-    relevance = 0
-    # sum up the relevances
-    for source in sources[1 : k + 1]:
-        relevance += get_source_relevance(source, keywords)
-    return relevance
-
+def get_relevance_vector(sources: list, keywords: set, tokenizer="nltk") -> list:
+    """Returns the relevance (1 or 0) of every source, tokenizing each source exactly once."""
+    tokenizer = get_tokenizer(tokenizer)
+    return [get_source_relevance(source, keywords, tokenizer) for source in sources]
 
-def precision_at_k(sources: list, keywords: set, k: int) -> float:
-    """Returns the average percent of the retrieved resources that were relevant out of k sources for one q/a pair."""
-    # evaluate the relevance of the sources
-    relevance = get_total_relevance(sources, keywords, k)
 
-    # calculate the precision@k
-    precision = relevance / k
-    return round(precision, 3)
+class ChunkInterner:
+    """Interns the source chunks of a run. Every distinct chunk is formatted and
+    tokenized once, and its words are kept as an array of integer ids into a shared
+    vocabulary, so the same chunk retrieved for many queries is not tokenized again.
+    Relevance is then found by looking up the ids of the query keywords in the chunk's
+    ids, with the rule of get_source_relevance.
 
+    Memory is bounded: only the `max_chunks` most recently used chunks are kept, and
+    once the vocabulary holds more than `max_words` words it is started over along
+    with the chunks, so a run over distinct chunks does not grow with the input.
+    """
 
-def average_precision(sources: list, keywords: set, k: int) -> float:
-    """Returns the average precision of a q/a pair for the top-k sources."""
+    def __init__(
+        self,
+        tokenizer="nltk",
+        max_chunks: int = INTERN_MAX_CHUNKS,
+        max_words: int = INTERN_MAX_WORDS,
+    ):
+        import numpy as np  # imported on use to keep the module import cheap
+
+        self.tokenizer = get_tokenizer(tokenizer)
+        self.max_chunks = max_chunks
+        self.max_words = max_words
+        self.vocabulary = {}
+        self.chunks = OrderedDict()  # hash of the chunk text -> int32 word ids
+        self._matches = np.zeros(1024, dtype=bool)  # flags the keyword ids, reused
+
+    def clear(self):
+        """Forgets every chunk and word."""
+        self.vocabulary.clear()
+        self.chunks.clear()
+
+    def intern(self, source: str):
+        """Returns the word ids of a chunk, tokenizing it if it is not kept."""
+        import numpy as np
+
+        key = hashlib.blake2b(source.encode("utf-8"), digest_size=16).digest()
+        ids = self.chunks.get(key)
+        if ids is not None:
+            self.chunks.move_to_end(key)
+            return ids
+
+        words = self.tokenizer(string_format(source))
+        vocabulary = self.vocabulary
+        ids = list(map(vocabulary.get, words))
+        if None in ids:
+            # add the new words in order of appearance
+            new_words = [w for w in dict.fromkeys(words) if w not in vocabulary]
+            vocabulary.update(zip(new_words, range(len(vocabulary), 2**31)))
+            ids = list(map(vocabulary.get, words))
+        ids = self.chunks[key] = np.array(ids, dtype=np.int32)
+        if len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)  # the least recently used chunk
+        instrumentation.count("chunks interned")
+        return ids
+
+    def relevance_vector(self, sources: list, keywords: set) -> list:
+        """Returns the relevance (1 or 0) of every source, like get_relevance_vector."""
+        import numpy as np
+
+        # start over between rows, so the ids of a row all come from one vocabulary
+        if len(self.vocabulary) > self.max_words:
+            self.clear()
+        tokens = [self.intern(source) for source in sources]
+        keyword_ids = [self.vocabulary[w] for w in keywords if w in self.vocabulary]
+        if not keyword_ids:
+            return [0] * len(tokens)
+        if len(self._matches) < len(self.vocabulary):
+            self._matches = np.zeros(2 * len(self.vocabulary), dtype=bool)
+
+        self._matches[keyword_ids] = True
+        try:
+            relevances = []
+            for ids in tokens:
+                matches = self._matches[ids]
+                # relevant once a word that is not a keyword follows 4+ matches
+                relevances.append(int(np.any(~matches & (np.cumsum(matches) > 3))))
+            return relevances
+        finally:
+            self._matches[keyword_ids] = False
+
+
+def total_relevance_from_vector(relevances: list, k: int) -> int:
+    """Returns the number of relevant sources out of the top k sources of a relevance vector."""
+    return sum(relevances[1 : k + 1])
+
+
+def precision_from_vector(relevances: list, k: int) -> float:
+    """Returns the precision@k of a relevance vector."""
+    return round(total_relevance_from_vector(relevances, k) / k, 3)
+
+
+def average_precision_from_vector(relevances: list, k: int) -> float:
+    """Returns the average precision of a relevance vector for the top-k sources."""
+    precision = precision_from_vector(relevances, k)
     total_avgs = 0
-
-    # calculate average precisions for each k
     for i in range(k):
-        source = sources[i]
-        total_avgs += precision_at_k(sources, keywords, k) * get_source_relevance(
-            source, keywords
-        )
+        total_avgs += precision * relevances[i]
 
     # avoid zero division
-    total_rel = get_total_relevance(sources, keywords, k)
+    total_rel = total_relevance_from_vector(relevances, k)
     if total_rel == 0:
-        ap = 0
-    # calculate the average precision
-    else:
-        ap = round(total_avgs / total_rel, 3)
-    return ap
+        return 0
+    return round(total_avgs / total_rel, 3)
 
 
-def mean_reciprocal_rank(sources: list, keywords: set) -> float:
-    """Returns the mean reciprocal rank of a q/a pair of the sources."""
-    # variables needed for calculation
-    total_q = len(sources) - 1
+def reciprocal_rank_from_vector(relevances: list) -> float:
+    """Returns the mean reciprocal rank of a relevance vector."""
+    total_q = len(relevances) - 1
     total_rr = 0  # total the reciprocal ranks
 
-    # calculate the reciprocal rank
-    for i in range(total_q):
-        i += 1  # prevent zero division by indexing from 1
-        relevance = get_source_relevance(sources[i], keywords)
-        if relevance == 1:
+    # index from 1 to prevent zero division
+    for i in range(1, total_q + 1):
+        if relevances[i] == 1:
             total_rr += 1 / i
     return round(total_rr / total_q, 3)
 
 
+def get_total_relevance(sources: list, keywords: set, k: int, tokenizer="nltk") -> int:
+    """Returns an int representing the number of relevant sources out of the top k sources."""
+    relevances = get_relevance_vector(sources[: k + 1], keywords, tokenizer)
+    return total_relevance_from_vector(relevances, k)
+
+
+def precision_at_k(sources: list, keywords: set, k: int, tokenizer="nltk") -> float:
+    """Returns the average percent of the retrieved resources that were relevant out of k sources for one q/a pair."""
+    relevances = get_relevance_vector(sources[: k + 1], keywords, tokenizer)
+    return precision_from_vector(relevances, k)
+
+
+def average_precision(sources: list, keywords: set, k: int, tokenizer="nltk") -> float:
+    """Returns the average precision of a q/a pair for the top-k sources."""
+    relevances = get_relevance_vector(sources[: k + 1], keywords, tokenizer)
+    return average_precision_from_vector(relevances, k)
+
+
+def mean_reciprocal_rank(sources: list, keywords: set, tokenizer="nltk") -> float:
+    """Returns the mean reciprocal rank of a q/a pair of the sources."""
+    relevances = get_relevance_vector(sources, keywords, tokenizer)
+    return reciprocal_rank_from_vector(relevances)
+
+
 def cumulative_gain(relevances: list) -> float:
     """Returns the total sum of relevancy for one query/documents pair with min being 0 (no relevancy)
     and max being k^2 (extremely relevant)
@@ -134,8 +238,8 @@ def cumulative_gain(relevances: list) -> float:
 def normalized_discounted_cg(relevances: list) -> float:
     """Return the normalized discounted cumulative gain based on the relevances provided."""
     dcg = 0  # non normalized
-    for relevance in enumerate(relevances):
-        dcg += int(relevance) / math.log2()
+    for i, relevance in enumerate(relevances):
+        dcg += int(relevance) / math.log2(i + 2)
     # normalize the metric
     ideal_dcg = len(relevances) ^ 2
     ndcg = dcg / ideal_dcg
@@ -143,52 +247,415 @@ def normalized_discounted_cg(relevances: list) -> float:
     return round(ndcg, 3)
 
 
-def generate_metrics(input_f: str, output_f: str, k: int):
-    """Generates a csv file contains the prompts and the metrics for their retrieved
-    documents. Returns the name of the output file.
+def read_relevance_matrix(input_f: str, columns: list, missing: int = -1):
+    """Reads the given relevance columns of a csv file or a `.npz` table (e.g. the human
+    relevances in data.csv) into an N x len(columns) integer matrix. Empty cells are
+    filled with `missing`.
     """
-    # get the full path of the input
-    input_f = os.path.abspath(input_f)
-    # write the metrics to a csv file
-    with open(output_f, mode="w", newline="") as f_out:
-        output_f = csv.writer(f_out)
-
-        # write the header
-        output_f.writerow(
-            [
-                "prompt",
-                " precision at k",
-                " mean reciprocal rank",
-                " average precision",
-                "cumulative gain",
-                "normalized discounted cumulative gain",
-            ]
-        )
+    import numpy as np  # imported on use to keep the module import cheap
+
+    if str(input_f).endswith(".npz"):
+        from rag_evaluation.columnar import MISSING_INT, read_table
+
+        table = read_table(input_f, columns)
+        matrix = np.column_stack([table[column] for column in columns])
+        empty = np.isnan(matrix) if matrix.dtype.kind == "f" else matrix == MISSING_INT
+        matrix = np.where(empty, missing, matrix)
+        return matrix.astype(np.int64).reshape(len(matrix), len(columns))
+
+    rows = []
+    with open(input_f, mode="r", newline="") as f_in:
+        reader = csv.DictReader(f_in)
+        for row in reader:
+            rows.append(
+                [
+                    int(row[column]) if row[column] != "" else missing
+                    for column in columns
+                ]
+            )
+    return np.array(rows, dtype=np.int64).reshape(len(rows), len(columns))
+
+
+def batch_metrics(
+    relevances, k: int, gains=None, query_slot: bool = False, missing: int = -1
+) -> dict:
+    """Returns the P@k, AP, MRR, CG and nDCG of every row of an N x ranks relevance matrix.
+
+    The columns are the relevances of the ranks 1, 2, ... (e.g. the human relevances
+    read with `read_relevance_matrix`). With `query_slot`, column 0 is a placeholder
+    that is not scored, like index 0 of the vectors the single row helpers take, so
+    stacking the vectors generate_metrics scores gives the same values. CG and nDCG
+    are computed from `gains` when provided (e.g. the human relevances), otherwise
+    from `relevances`. Cells equal to `missing` (unrated sources, as
+    `read_relevance_matrix` fills them) are not relevant and add no gain.
+    """
+    import numpy as np  # imported on use to keep the module import cheap
+
+    relevances = np.asarray(relevances, dtype=np.float64)
+    if relevances.ndim != 2:
+        raise ValueError("relevances must be a 2D (queries x ranks) matrix")
+    gains = relevances if gains is None else np.asarray(gains, dtype=np.float64)
+    relevances = np.where(relevances == missing, 0, relevances)
+    gains = np.where(gains == missing, 0, gains)
+    if not query_slot:
+        # rank i in column i, as the row helpers index the relevance vectors
+        relevances = np.pad(relevances, ((0, 0), (1, 0)))
+    n_rows, n_ranks = relevances.shape
+
+    # precision@k over the ranks 1..k
+    total_rel = relevances[:, 1 : k + 1].sum(axis=1)
+    p_at_k = np.round(total_rel / k, 3)
+
+    # average precision, masking the rows without any relevant source; the row
+    # helpers sum the placeholder and the ranks 1..k-1, a padded matrix every rank
+    start = 0 if query_slot else 1
+    total_avgs = p_at_k * relevances[:, start : start + k].sum(axis=1)
+    ap = np.divide(
+        total_avgs, total_rel, out=np.zeros(n_rows), where=total_rel != 0
+    ).round(3)
+
+    # mean reciprocal rank over every rank after the first
+    total_q = n_ranks - 1
+    reciprocal_ranks = 1 / np.arange(1, total_q + 1) if total_q > 0 else np.zeros(0)
+    total_rr = ((relevances[:, 1:] == 1) * reciprocal_ranks).sum(axis=1)
+    mrr = np.round(total_rr / total_q, 3) if total_q > 0 else np.zeros(n_rows)
+
+    # cumulative gain and the (normalized) discounted cumulative gain
+    cg = gains.sum(axis=1)
+    discounts = 1 / np.log2(np.arange(2, gains.shape[1] + 2))
+    dcg = (gains * discounts).sum(axis=1)
+    ideal_dcg = gains.shape[1] ^ 2
+    ndcg = np.round(dcg / ideal_dcg, 3) if ideal_dcg else np.zeros(n_rows)
+
+    return {
+        "precision at k": p_at_k,
+        "mean reciprocal rank": mrr,
+        "average precision": ap,
+        "cumulative gain": cg,
+        "normalized discounted cumulative gain": ndcg,
+    }
+
+
+def parse_responses(responses, k: int):
+    """Splits every row of the retrieved sources into its query, sources and human relevances."""
+    for response in responses:
+        yield response[0], response[1 : k + 1], response[k + 1 : 2 * k + 2]
+
+
+def extract_keywords(parsed, tokenizer="nltk"):
+    """Adds the keywords of the query to every parsed row."""
+    tokenizer = get_tokenizer(tokenizer)
+    for query, sources, relevances in parsed:
+        yield query, sources, relevances, get_keywords(query, tokenizer)
+
+
+def score_parsed(parsed, k: int, tokenizer="nltk", interner: ChunkInterner = None):
+    """Yields the output row (prompt and metrics) of every parsed row with keywords.
+    With an interner, the sources it keeps are not tokenized again.
+    """
+    tokenizer = get_tokenizer(tokenizer)
+    for query, sources, relevances, keywords in parsed:
+        # tokenize and score every source once
+        if interner is None:
+            source_relevances = get_relevance_vector(sources, keywords, tokenizer)
+        else:
+            source_relevances = interner.relevance_vector(sources, keywords)
+
+        p_at_k = precision_from_vector(source_relevances, k)
+        mrr = reciprocal_rank_from_vector(source_relevances)
+        ap = average_precision_from_vector(source_relevances, k)
+        cg = cumulative_gain(relevances)
+        ndcg = normalized_discounted_cg(relevances)
+        instrumentation.count("rows scored")
+        yield [query, p_at_k, mrr, ap, cg, ndcg]
+
+
+def _pipeline(responses, k: int, tokenizer="nltk", interner: ChunkInterner = None):
+    """Chains the parse, keyword extraction and scoring stages over the rows."""
+    parsed = extract_keywords(parse_responses(responses, k), tokenizer)
+    return score_parsed(parsed, k, tokenizer, interner)
+
+
+def score_response(response: list, k: int, tokenizer="nltk") -> list:
+    """Returns the output row (prompt and metrics) for one row of the retrieved sources."""
+    return next(_pipeline([response], k, tokenizer))
+
+
+# the interners of a worker process, kept across the chunks it scores in a run
+_worker_interners = {}
 
-        # read in the queries and responses from the csv file
-        with open(input_f, mode="r", newline="") as f_in:
-            responses = csv.reader(f_in)
-            # skip the header
-            next(responses)
-
-            # get the metrics and write to the out file
-            for response in responses:
-                query = response[0]
-                sources = response[1 : k + 1]
-                relevances = response[k + 1 : 2 * k + 2]
-
-                # get the keywords from the prompts
-                keywords = get_keywords(query)
-
-                p_at_k = precision_at_k(sources, keywords, k)
-                mrr = mean_reciprocal_rank(sources, keywords)
-                ap = average_precision(sources, keywords, k)
-                cg = cumulative_gain(relevances)
-                ndcg = normalized_discounted_cg(relevances)
-                output_f.writerow([query, p_at_k, mrr, ap, cg, ndcg])
+
+def _worker_interner(tokenizer, instrument: bool, max_chunks: int) -> ChunkInterner:
+    """Returns the interner of this worker process for a tokenizer, or None when the
+    chunks are not interned (max_chunks is 0).
+    """
+    if not max_chunks:
+        return None
+    key = (tokenizer, instrument, max_chunks)
+    if key not in _worker_interners:
+        _worker_interners.clear()  # only the interner of the current run is kept
+        _worker_interners[key] = ChunkInterner(tokenizer, max_chunks)
+    return _worker_interners[key]
+
+
+def _score_chunk(
+    chunk: list, k: int, tokenizer="nltk", instrument=False, intern_max_chunks=0
+) -> tuple:
+    """Scores a chunk of rows in a worker process. Returns the rows and, when
+    instrumented, the counters recorded while scoring them.
+    """
+    if not instrument:
+        interner = _worker_interner(tokenizer, instrument, intern_max_chunks)
+        return list(_pipeline(chunk, k, tokenizer, interner)), {}
+    instrumentation.enable()  # a fresh recorder in this worker
+    try:
+        # created while recording, so that the interner counts its tokenizations
+        interner = _worker_interner(tokenizer, instrument, intern_max_chunks)
+        rows = list(_pipeline(chunk, k, tokenizer, interner))
+    finally:
+        recorder = instrumentation.disable()
+    return rows, dict(recorder.counters)
+
+
+def _chunks(rows, chunk_size: int):
+    """Groups an iterable of rows into lists of at most chunk_size rows."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def metric_cache_key(response: list, k: int) -> str:
+    """Returns the cache key of a row: a hash of its query, sources, k and the scorer version."""
+    return make_key(SCORER_VERSION, k, response)
+
+
+def _score_uncached(
+    responses,
+    k: int,
+    chunk_size: int,
+    executor=None,
+    workers=1,
+    tokenizer="nltk",
+    interner: ChunkInterner = None,
+):
+    """Yields the output row of every response in input order, scoring chunks of rows
+    on the process pool executor when one is given. The workers intern the chunks
+    with the same bound as the interner.
+    """
+    if executor is None:
+        yield from _pipeline(responses, k, tokenizer, interner)
+        return
+
+    def collect(future):
+        rows, counts = future.result()
+        instrumentation.merge_counts(counts)
+        return rows
+
+    # keep a bounded number of chunks in flight and collect them in order
+    instrument = instrumentation.enabled()
+    max_chunks = interner.max_chunks if interner is not None else 0
+    pending = deque()
+    for chunk in _chunks(responses, chunk_size):
+        pending.append(
+            executor.submit(_score_chunk, chunk, k, tokenizer, instrument, max_chunks)
+        )
+        if len(pending) >= 2 * workers:
+            yield from collect(pending.popleft())
+    while pending:
+        yield from collect(pending.popleft())
+
+
+def _score_cached(
+    responses,
+    k: int,
+    chunk_size: int,
+    cache: DiskCache,
+    executor=None,
+    workers=1,
+    tokenizer="nltk",
+    interner: ChunkInterner = None,
+):
+    """Yields the output row of every response in input order, reading unchanged rows
+    back from the cache and only scoring the new or changed ones.
+    """
+    batch_size = chunk_size * workers * 2
+    for batch in _chunks(responses, batch_size):
+        keys = [metric_cache_key(response, k) for response in batch]
+        rows = [cache.get(key) for key in keys]
+
+        # score the misses and cache their rows
+        misses = [response for response, row in zip(batch, rows) if row is None]
+        instrumentation.count("metric cache hits", len(batch) - len(misses))
+        instrumentation.count("metric cache misses", len(misses))
+        scored = _score_uncached(
+            misses, k, chunk_size, executor, workers, tokenizer, interner
+        )
+        for i, row in enumerate(rows):
+            if row is None:
+                row = next(scored)
+                cache.put(keys[i], row)
+            yield row
+        cache.commit()
+
+
+def score_responses(
+    responses,
+    k: int,
+    workers: int = 1,
+    chunk_size: int = 64,
+    cache=None,
+    tokenizer="nltk",
+    intern_max_chunks: int = INTERN_MAX_CHUNKS,
+):
+    """Yields the output row of every response in input order. With more than one
+    worker, chunks of rows are scored by a process pool. With a cache, only the rows
+    that are not cached yet are scored. The run (or every worker) keeps the tokens of
+    up to `intern_max_chunks` recently used sources, 0 to tokenize every source.
+    """
+    interner = (
+        ChunkInterner(tokenizer, intern_max_chunks) if intern_max_chunks else None
+    )
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    with executor or contextlib.nullcontext():
+        if cache is None:
+            yield from _score_uncached(
+                responses, k, chunk_size, executor, workers, tokenizer, interner
+            )
+        else:
+            yield from _score_cached(
+                responses, k, chunk_size, cache, executor, workers, tokenizer, interner
+            )
+
+
+def read_responses(f_in):
+    """Lazily reads the rows of the retrieved sources, skipping the header."""
+    responses = csv.reader(f_in)
+    next(responses, None)
+    yield from responses
+
+
+def write_rows(f_out, rows, flush_every: int = 100):
+    """Writes the header and the metric rows, flushing every `flush_every` rows so
+    partial results are visible during long runs.
+    """
+    writer = csv.writer(f_out)
+    writer.writerow(
+        [
+            "prompt",
+            " precision at k",
+            " mean reciprocal rank",
+            " average precision",
+            "cumulative gain",
+            "normalized discounted cumulative gain",
+        ]
+    )
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if flush_every and i % flush_every == 0:
+            f_out.flush()
+
+
+def _open_csv(path: str, mode: str):
+    """Opens a csv file for reading or writing, where "-" is stdin or stdout."""
+    if path == "-":
+        stream = sys.stdin if mode == "r" else sys.stdout
+        return open(stream.fileno(), mode=mode, newline="", closefd=False)
+    return open(os.path.abspath(path), mode=mode, newline="")
+
+
+def generate_metrics(
+    input_f: str,
+    output_f: str,
+    k: int,
+    workers: int = 1,
+    chunk_size: int = 64,
+    field_size_limit: int = FIELD_SIZE_LIMIT,
+    flush_every: int = 100,
+    cache: DiskCache = None,
+    tokenizer: str = "nltk",
+    report_f: str = None,
+    intern_max_chunks: int = INTERN_MAX_CHUNKS,
+):
+    """Generates a csv file contains the prompts and the metrics for their retrieved
+    documents. The rows are streamed through read -> parse -> keyword extraction ->
+    score -> write, so memory stays flat with the input size. Either file may be "-"
+    for stdin/stdout. Rows already in the cache are read back instead of scored.
+    `tokenizer` selects the word tokenizer backend ("nltk" or "regex").
+    With `report_f`, the run is instrumented and its report written there as JSON.
+    Up to `intern_max_chunks` recently seen sources are kept tokenized (see
+    ChunkInterner), 0 to tokenize every source. Returns the name of the output file.
+    """
+    # allow very long chunks of text in a single field
+    csv.field_size_limit(field_size_limit)
+
+    with instrumentation.reporting(report_f), instrumentation.stage("metrics"):
+        with _open_csv(input_f, "r") as f_in, _open_csv(output_f, "w") as f_out:
+            responses = read_responses(f_in)
+            rows = score_responses(
+                responses, k, workers, chunk_size, cache, tokenizer, intern_max_chunks
+            )
+            write_rows(f_out, rows, flush_every)
     return output_f
 
 
 if __name__ == "__main__":
-    k = 5
-    generate_metrics("./data/retrieved_sources.csv", "./data/metrics.csv", k)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "input_f",
+        nargs="?",
+        default="./data/retrieved_sources.csv",
+        help='csv file of queries and sources, "-" for stdin',
+    )
+    parser.add_argument(
+        "output_f",
+        nargs="?",
+        default="./data/metrics.csv",
+        help='csv file to write the metrics to, "-" for stdout',
+    )
+    parser.add_argument("-k", type=int, default=5, help="number of sources")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--field-size-limit", type=int, default=FIELD_SIZE_LIMIT)
+    parser.add_argument("--flush-every", type=int, default=100)
+    parser.add_argument("--cache", help="sqlite file to cache the metric rows in")
+    parser.add_argument("--cache-max-entries", type=int)
+    parser.add_argument("--tokenizer", choices=sorted(TOKENIZERS), default="nltk")
+    parser.add_argument(
+        "--intern-max-chunks",
+        type=int,
+        default=INTERN_MAX_CHUNKS,
+        help="recently seen sources kept tokenized (per worker), 0 to keep none",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="write timings and counters to <output>.report.json",
+    )
+    args = parser.parse_args()
+
+    metric_cache = (
+        DiskCache(args.cache, max_entries=args.cache_max_entries)
+        if args.cache
+        else None
+    )
+    generate_metrics(
+        args.input_f,
+        args.output_f,
+        args.k,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        field_size_limit=args.field_size_limit,
+        flush_every=args.flush_every,
+        cache=metric_cache,
+        tokenizer=args.tokenizer,
+        report_f=instrumentation.report_path(args.output_f) if args.report else None,
+        intern_max_chunks=args.intern_max_chunks,
+    )
+    if metric_cache is not None:
+        print(json.dumps(metric_cache.stats()), file=sys.stderr)
+        metric_cache.close()
@@ -0,0 +1,222 @@
+"""Typed columnar tables stored as compressed `.npz` files, with a converter from the
+wide csv files of the pipeline.
+
+Every column is stored as its own array, so a stage loads only the columns it names.
+Numeric columns are stored with the numpy dtype of the schema, and string columns as
+their concatenated utf-8 bytes and the offsets of each value.
+"""
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+# empty integer cells (e.g. an unrated source) are stored as -1, empty floats as nan
+MISSING_INT = -1
+
+SCHEMA_KEY = "__schema__"
+
+# data.csv: the prompts, their sources and the human and generated relevances
+RETRIEVAL_SCHEMA = {
+    "prompt": "str",
+    "medical": "str",
+    **{f"source{i}": "str" for i in range(1, 6)},
+    **{f"source {i} human relevance": "int8" for i in range(1, 6)},
+    **{f"source {i} human binary relevance": "int8" for i in range(1, 6)},
+    **{f"source {i} generated binary relevance": "int8" for i in range(1, 6)},
+}
+
+# metrics.csv and normalized_metrics.csv
+METRICS_SCHEMA = {
+    "prompt": "str",
+    "precision at k": "float64",
+    "mean reciprocal rank": "float64",
+    "average precision": "float64",
+    "cumulative gain": "float64",
+    "normalized discounted cumulative gain": "float64",
+}
+
+# llm_responses_data.csv: the responses and their human ratings
+LLM_RESPONSES_SCHEMA = {
+    "query": "str",
+    "response": "str",
+    "good_answer": "int8",
+    "disclaimer": "int8",
+    "hallucinated": "int8",
+    "could_not_answer_from_sources": "int8",
+    "sources_cited": "str",
+}
+
+
+def encode_strings(values) -> tuple:
+    """Returns the utf-8 bytes of the strings concatenated, and the offsets of each one
+    (N + 1 offsets, string i is data[offsets[i]:offsets[i + 1]]).
+    """
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets):
+    """Returns the strings of encode_strings as an object array."""
+    raw = data.tobytes()
+    bounds = offsets.tolist()
+    values = np.empty(len(bounds) - 1, dtype=object)
+    values[:] = [
+        raw[start:end].decode("utf-8") for start, end in zip(bounds, bounds[1:])
+    ]
+    return values
+
+
+def _to_array(values, dtype: str):
+    """Converts a column of values to its schema dtype, empty cells become missing."""
+    if dtype == "str":
+        return values
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        missing = MISSING_INT
+    else:
+        missing = np.nan
+    return np.array(
+        [missing if value == "" else value for value in values], dtype=dtype
+    )
+
+
+def write_table(path: str, columns: dict, schema: dict):
+    """Writes the columns (name -> sequence of values) to a compressed `.npz` table.
+    Every column of the schema (name -> "str" or a numpy dtype) must be given.
+    """
+    arrays = {SCHEMA_KEY: np.array(json.dumps(schema))}
+    for name, dtype in schema.items():
+        if dtype == "str":
+            data, offsets = encode_strings(columns[name])
+            arrays[f"{name}:data"] = data
+            arrays[f"{name}:offsets"] = offsets
+        else:
+            arrays[name] = np.asarray(columns[name], dtype=dtype)
+    np.savez_compressed(path, **arrays)
+
+
+def read_schema(path: str) -> dict:
+    """Returns the schema of a table, the column names in order and their types."""
+    with np.load(path) as table:
+        return json.loads(table[SCHEMA_KEY].item())
+
+
+def read_table(path: str, columns: list = None) -> dict:
+    """Returns the given columns of a table (all of them by default) as numpy arrays,
+    strings as object arrays. Only the requested columns are read and decompressed.
+    """
+    with np.load(path) as table:
+        schema = json.loads(table[SCHEMA_KEY].item())
+        if columns is None:
+            columns = list(schema)
+        unknown = [name for name in columns if name not in schema]
+        if unknown:
+            raise KeyError(f"no columns {unknown} in {path}")
+        result = {}
+        for name in columns:
+            if schema[name] == "str":
+                result[name] = decode_strings(
+                    table[f"{name}:data"], table[f"{name}:offsets"]
+                )
+            else:
+                result[name] = table[name]
+        return result
+
+
+def read_frame(path: str, columns: list = None):
+    """Returns the given columns of a `.npz` table or a csv file as a pandas data frame.
+    The csv column names are matched and returned without their surrounding spaces.
+    """
+    import pandas as pd  # only needed by the stages that plot or rescale
+
+    if str(path).endswith(".npz"):
+        return pd.DataFrame(read_table(path, columns), columns=columns)
+    frame = pd.read_csv(
+        path, usecols=None if columns is None else lambda name: name.strip() in columns
+    )
+    frame.columns = frame.columns.str.strip()
+    return frame[columns or slice(None)]
+
+
+def find_table(csv_path: str) -> str:
+    """Returns the `.npz` table converted from a csv file if it is up to date, otherwise
+    the csv file itself.
+    """
+    table_path = os.path.splitext(csv_path)[0] + ".npz"
+    if os.path.exists(table_path) and (
+        not os.path.exists(csv_path)
+        or os.path.getmtime(table_path) >= os.path.getmtime(csv_path)
+    ):
+        return table_path
+    return csv_path
+
+
+def _infer_type(values) -> str:
+    """Returns the narrowest of int64, float64 and str that holds every value."""
+    for dtype, parse in (("int64", int), ("float64", float)):
+        try:
+            for value in values:
+                if value != "":
+                    parse(value)
+            return dtype
+        except ValueError:
+            continue
+    return "str"
+
+
+def convert_csv(input_f: str, output_f: str = None, schema: dict = None) -> str:
+    """Converts a csv file with a header to a `.npz` table and returns its path. Columns
+    that are not in the schema have their type inferred from the values, and the
+    column names are stored without their surrounding spaces.
+    """
+    if output_f is None:
+        output_f = os.path.splitext(input_f)[0] + ".npz"
+    csv.field_size_limit(2**31 - 1)  # sources can be longer than the default limit
+
+    with open(input_f, mode="r", newline="") as f_in:
+        reader = csv.reader(f_in)
+        header = [name.strip() for name in next(reader)]
+        values = [[] for _ in header]
+        for row in reader:
+            if not row:
+                continue
+            for column, value in zip(values, row):
+                column.append(value)
+            for column in values[len(row) :]:
+                column.append("")  # short rows
+
+    schema = schema or {}
+    full_schema = {
+        name: schema.get(name) or _infer_type(column)
+        for name, column in zip(header, values)
+    }
+    columns = {
+        name: _to_array(column, full_schema[name])
+        for name, column in zip(header, values)
+    }
+    write_table(output_f, columns, full_schema)
+    return output_f
+
+
+SCHEMAS = {
+    "data.csv": RETRIEVAL_SCHEMA,
+    "metrics.csv": METRICS_SCHEMA,
+    "normalized_metrics.csv": METRICS_SCHEMA,
+    "llm_responses_data.csv": LLM_RESPONSES_SCHEMA,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts csv files to .npz tables next to them."
+    )
+    parser.add_argument("inputs", nargs="+", help="csv files to convert")
+    args = parser.parse_args()
+
+    for input_f in args.inputs:
+        schema = SCHEMAS.get(os.path.basename(input_f))
+        print(convert_csv(input_f, schema=schema))
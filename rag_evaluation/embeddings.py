@@ -0,0 +1,262 @@
+"""Dense retrieval over the chunks of saved policy-chat responses with a memory-mapped
+embedding index, for CPU-only hosts.
+
+The unit-length chunk vectors are stored as a float32 or float16 `.npy` file that is
+memory-mapped at search time, next to a table of the documents. A batch of queries is
+scored against blocks of the vectors with one matrix product per block, keeping the
+running top k of every query with argpartition, so memory stays bounded by the block
+size and not by the size of the corpus.
+
+The encoder is pluggable: any object with an `encode(texts)` method returning one
+vector per text, e.g. a local SentenceTransformer model, or the deterministic
+HashingEncoder for tests and quick runs.
+
+    python -m rag_evaluation.embeddings build data/retrieved_sources.json data/dense
+    python -m rag_evaluation.embeddings retrieve data/dense data/queries.csv out.csv
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from rag_evaluation import instrumentation
+from rag_evaluation.bm25 import (
+    SEARCH_MEMORY,
+    analyze,
+    block_rows,
+    generate_responses,
+    merge_top_k,
+    read_chunks,
+    sort_by_score,
+    to_responses,
+    top_k,
+)
+from rag_evaluation.columnar import decode_strings, encode_strings
+from rag_evaluation.retrieve_documents import get_source_texts
+
+# bump when the layout of the saved index changes
+INDEX_VERSION = 1
+
+HASHING_ENCODER = "hashing"
+
+
+class HashingEncoder:
+    """Deterministic bag of words encoder: every term is hashed to a signed dimension,
+    so the same text always has the same vector, on any host and without a model.
+    """
+
+    def __init__(self, dimension: int = 384, tokenizer: str = "regex"):
+        self.dimension = dimension
+        self.tokenizer = tokenizer
+        # cached per encoder, the features depend on its dimension
+        self._feature = functools.lru_cache(maxsize=2**16)(self._term_feature)
+
+    def _term_feature(self, term: str) -> tuple:
+        """Returns the dimension and the sign of a term."""
+        digest = int.from_bytes(
+            hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little"
+        )
+        return digest % self.dimension, 1.0 if digest >> 63 else -1.0
+
+    def encode(self, texts: list, **kwargs) -> np.ndarray:
+        """Returns the texts x dimension term count vectors, signed by the hashes."""
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            for term in analyze(text, self.tokenizer):
+                column, sign = self._feature(term)
+                rows.append(row)
+                columns.append(column)
+                signs.append(sign)
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        np.add.at(vectors, (rows, columns), signs)
+        return vectors
+
+
+def load_encoder(name: str = HASHING_ENCODER, dimension: int = None):
+    """Returns the hashing encoder, or the SentenceTransformer model of a name or a local
+    path (e.g. the fine tuned model) on the CPU.
+    """
+    if name == HASHING_ENCODER:
+        return HashingEncoder(dimension or 384)
+    # heavy, only imported to use a model
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name, device="cpu")
+
+
+def normalize(vectors) -> np.ndarray:
+    """Returns the vectors as float32 scaled to unit length, zero vectors are kept."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class EmbeddingIndex:
+    """Memory-mapped index of unit-length document vectors, stored in a directory as
+    `vectors.npy`, `documents.npz` (the id table) and `index.json`. Build it with
+    `EmbeddingIndex.build(read_chunks(path), encoder, directory)`.
+    """
+
+    def __init__(self, directory: str, encoder=None):
+        with open(os.path.join(directory, "index.json")) as f_in:
+            self.info = json.load(f_in)
+        if self.info["version"] != INDEX_VERSION:
+            raise ValueError(
+                f"{directory} is a version {self.info['version']} index, "
+                f"expected version {INDEX_VERSION}"
+            )
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        with np.load(os.path.join(directory, "documents.npz")) as table:
+            self.documents = [
+                json.loads(document)
+                for document in decode_strings(table["data"], table["offsets"])
+            ]
+        self.encoder = encoder or load_encoder(
+            self.info["encoder"], self.info["dimension"]
+        )
+
+    @classmethod
+    def build(
+        cls,
+        documents: list,
+        encoder,
+        directory: str,
+        encoder_name: str = None,
+        dtype: str = "float32",
+        batch_size: int = 256,
+    ):
+        """Encodes the text of every document (see get_source_texts) in batches, writing
+        the vectors straight to the memory-mapped file, and returns the index.
+        `encoder_name` (the model name or path, see load_encoder) is saved to load the
+        same encoder with the index. It is only optional for a HashingEncoder.
+        """
+        if encoder_name is None:
+            if not isinstance(encoder, HashingEncoder):
+                raise ValueError("encoder_name is needed to load the encoder again")
+            encoder_name = HASHING_ENCODER
+        os.makedirs(directory, exist_ok=True)
+        texts = get_source_texts({"source_documents": documents})
+        vectors = None
+        for start in range(0, len(texts), batch_size):
+            batch = normalize(encoder.encode(texts[start : start + batch_size]))
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(
+                    os.path.join(directory, "vectors.npy"),
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(len(texts), batch.shape[1]),
+                )
+            vectors[start : start + len(batch)] = batch
+        if vectors is None:
+            raise ValueError("no documents to index")
+        vectors.flush()
+
+        data, offsets = encode_strings([json.dumps(document) for document in documents])
+        np.savez_compressed(
+            os.path.join(directory, "documents.npz"), data=data, offsets=offsets
+        )
+        with open(os.path.join(directory, "index.json"), mode="w") as f_out:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "encoder": encoder_name,
+                    "dimension": vectors.shape[1],
+                    "dtype": dtype,
+                    "documents": len(documents),
+                },
+                f_out,
+                indent=2,
+            )
+        del vectors  # closes the memory map before it is opened again for reading
+        return cls(directory, encoder)
+
+    def search(
+        self,
+        queries: list,
+        k: int = 5,
+        block_size: int = None,
+        memory: int = SEARCH_MEMORY,
+    ) -> tuple:
+        """Returns the indices and cosine similarities of the top k documents of every
+        query, as two queries x k arrays sorted by decreasing similarity (ties by
+        document order). The vectors are read block_size rows at a time, by default
+        as many as fit `memory` bytes (see block_rows).
+        """
+        embedded = normalize(self.encoder.encode(queries))
+        if embedded.shape[1] != self.vectors.shape[1]:
+            raise ValueError(
+                f"the encoder gives {embedded.shape[1]} dimensions, "
+                f"the index has {self.vectors.shape[1]}"
+            )
+        if block_size is None:
+            block_size = block_rows(len(queries), embedded.shape[1], memory)
+        top = np.empty((len(queries), 0), dtype=np.int64)
+        top_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.vectors), block_size):
+            block = np.asarray(self.vectors[start : start + block_size], np.float32)
+            top, top_scores = merge_top_k(
+                top, top_scores, *top_k(embedded @ block.T, k, start), k
+            )
+
+        return sort_by_score(top, top_scores)
+
+    def retrieve(self, queries: list, k: int = 5) -> list:
+        """Returns a policy-chat style response to every query, see to_responses."""
+        instrumentation.count("dense queries", len(queries))
+        return to_responses(self.documents, queries, *self.search(queries, k))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="embed the chunks of saved responses")
+    build.add_argument("input", nargs="?", default="./data/retrieved_sources.json")
+    build.add_argument("output", nargs="?", default="./data/dense_index")
+    build.add_argument(
+        "--encoder",
+        default=HASHING_ENCODER,
+        help="'hashing', or a SentenceTransformer model name or path",
+    )
+    build.add_argument("--dimension", type=int, help="of the hashing encoder")
+    build.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    build.add_argument("--batch-size", type=int, default=256)
+
+    retrieve = commands.add_parser("retrieve", help="retrieve the sources of queries")
+    retrieve.add_argument("index", nargs="?", default="./data/dense_index")
+    retrieve.add_argument("input", nargs="?", default="./data/queries.csv")
+    retrieve.add_argument("output", nargs="?", default="./data/dense_sources.csv")
+    retrieve.add_argument("-k", type=int, default=5, help="number of sources")
+    retrieve.add_argument("--batch-size", type=int, default=1024)
+    retrieve.add_argument("--responses", help="also write the responses as JSON Lines")
+    retrieve.add_argument(
+        "--report",
+        action="store_true",
+        help="write timings and counters to <output>.report.json",
+    )
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = EmbeddingIndex.build(
+            read_chunks(args.input),
+            load_encoder(args.encoder, args.dimension),
+            args.output,
+            args.encoder,
+            args.dtype,
+            args.batch_size,
+        )
+        print(f"embedded {len(index.documents)} chunks in {index.vectors.shape[1]}d")
+    else:
+        generate_responses(
+            EmbeddingIndex(args.index),
+            args.input,
+            args.output,
+            args.k,
+            args.batch_size,
+            args.responses,
+            instrumentation.report_path(args.output) if args.report else None,
+        )
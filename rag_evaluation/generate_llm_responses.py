@@ -3,108 +3,612 @@ policy-chat API and the query.The responses are then saved to a csv file with th
 query, retrieved sources, and llm generated response.
 """
 
+import argparse
+import asyncio
 import csv
-import json
 import os
-import sys
+import random
+import re
+import time
+from collections import deque
 
-import requests
-from mistralai.client import MistralClient
-from mistralai.models.chat_completion import ChatMessage
+import httpx
+from mistralai import Mistral, models
 
+from rag_evaluation import instrumentation
+from rag_evaluation.cache import CacheMissError, DiskCache, make_key
+from rag_evaluation.jsonl import JsonlWriter, read_jsonl
+from rag_evaluation.retrieve_documents import (ask_policy_chat,
+                                               get_source_texts,
+                                               open_retrieval_cache, retrieve)
 
-def pass_to_policy_chat(query: str):
-    """Return a list of the retrieved sources from poliy-chat given a query as an input."""
+MODEL = "mistral-large-latest"
+COMPLETION_CACHE_PATH = "./data/completion_cache.sqlite"
+
+
+def pass_to_policy_chat(query: str, cache=None, offline: bool = False):
+    """Return a list of the retrieved sources from poliy-chat given a query as an input.
+    The response is served from the retrieval cache when it is there.
+    """
     # send POST request to policy-chat API
-    result = requests.post("http://localhost:8000/ask", json={"query": query})
-    response_data = result.json()
+    (response_data,) = retrieve([query], cache=cache, offline=offline)
 
     # get the text from the sources
-    sources = response_data.get("source_documents", [])
-    source_texts = [
-        json.loads(source["page_content"]).get("text", "") for source in sources
-    ]
+    source_texts = get_source_texts(response_data)
     print("sources retrieved")
     return source_texts
 
 
-def get_llm_response(query: str, sources=None):
+_PROMPT_HEADER = """ Based on the following retreieved sources using a policy-chat API, please answer the query.
+    Here is the query:
+    query = "{query}"
+    Here are the retrieved sources, the higher the source number the less relevant the information will be, take that into account.
+    Base your response off of the retrieved sources, make them not too long and easily understandable.
+    If none of the sources help you answer the question, say that you cannot answer it with the sources. Do not make up an answer.
+"""
+_SOURCE_LINE = "    source {number}: {text}\n"
+_PROMPT_FOOTER = "    "
+_TRUNCATED = " ..."
+# the end of a text that is part of a word, to cut on any whitespace
+_PARTIAL_WORD = re.compile(r"\S+$")
+
+
+def estimate_tokens(text: str) -> int:
+    """Returns a rough token count of the text (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def _truncate(text: str, fits) -> str:
+    """Returns the longest prefix of the text ending on a whole word that fits, marked
+    as truncated, or an empty string if not even one word fits.
+    """
+    # binary search over the length, works for any estimator that grows with the text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(text[:middle] + _TRUNCATED):
+            low = middle
+        else:
+            high = middle - 1
+    cut = text[:low]
+    if low < len(text) and not text[low].isspace():
+        cut = _PARTIAL_WORD.sub("", cut)  # do not end on part of a word
+    cut = cut.rstrip()
+    return cut + _TRUNCATED if cut else ""
+
+
+def pack_prompt(
+    query: str,
+    sources: list,
+    k: int = 5,
+    max_tokens: int = None,
+    max_source_tokens: int = None,
+    estimator=estimate_tokens,
+):
+    """Formats the query and up to k retrieved sources into the prompt passed to the
+    LLM. Returns the prompt and its estimated token count.
+
+    The sources are packed in rank order, skipping empty ones. Each source is cut to
+    `max_source_tokens` and to what is left of the `max_tokens` budget of the whole
+    prompt; a source that does not fit a single word under its own cap is skipped, and
+    packing stops once the budget is used up.
+    """
+    prompt = _PROMPT_HEADER.format(query=query)
+    budget = None
+    if max_tokens is not None:
+        budget = max_tokens - estimator(prompt + _PROMPT_FOOTER)
+
+    sources = [source for source in sources if source and source.strip()][:k]
+    number = 0
+    for source in sources:
+        limit = max_source_tokens
+        budget_bound = False
+        if budget is not None:
+            line_tokens = estimator(_SOURCE_LINE.format(number=number + 1, text=""))
+            available = budget - line_tokens
+            budget_bound = limit is None or available <= limit
+            limit = available if budget_bound else limit
+        if limit is not None and estimator(source) > limit:
+            source = _truncate(source, lambda text: estimator(text) <= limit)
+            if not source:
+                if budget_bound:
+                    break  # the budget of the prompt is used up
+                continue
+        number += 1
+        line = _SOURCE_LINE.format(number=number, text=source)
+        prompt += line
+        if budget is not None:
+            budget -= estimator(line)
+    prompt += _PROMPT_FOOTER
+    return prompt, estimator(prompt)
+
+
+def build_prompt(query: str, sources: list, **kwargs) -> str:
+    """Formats the query and the retrieved sources into the prompt passed to the LLM,
+    see pack_prompt for the options.
+    """
+    prompt, _ = pack_prompt(query, sources, **kwargs)
+    return prompt
+
+
+def get_client(
+    api_key: str = None, server_url: str = None, async_client=None
+) -> Mistral:
+    """Returns a Mistral client, by default with the key in MISTRAL_API_KEY."""
+    if api_key is None:
+        api_key = os.environ["MISTRAL_API_KEY"]
+    return Mistral(api_key=api_key, server_url=server_url, async_client=async_client)
+
+
+def format_response(response: str) -> str:
+    """Returns the text of a completion on a single line."""
+    return response.replace("\n", "")
+
+
+def completion_cache_key(model: str, prompt: str, sampling: dict = None) -> str:
+    """Returns the completion cache key: a hash of the model, the full prompt and the
+    sampling parameters.
+    """
+    return make_key("completion", model, prompt, sampling or {})
+
+
+def open_completion_cache(
+    path: str = COMPLETION_CACHE_PATH, max_entries: int = None
+) -> DiskCache:
+    """Opens the on-disk cache of LLM completions."""
+    return DiskCache(path, max_entries=max_entries)
+
+
+def _cached_completion(completion_cache: DiskCache, key: str, replay: bool):
+    """Returns the cached completion of a key, or None when it has to be generated.
+    In replay mode a miss raises CacheMissError instead.
+    """
+    if replay and completion_cache is None:
+        raise ValueError("replay needs a completion cache to serve from")
+    if completion_cache is None:
+        return None
+    response = completion_cache.get(key)
+    if response is not None:
+        instrumentation.count("completion cache hits")
+        return response
+    instrumentation.count("completion cache misses")
+    if replay:
+        raise CacheMissError("prompt not in the completion cache")
+    return None
+
+
+def _store_completion(completion_cache: DiskCache, key: str, response: str):
+    if completion_cache is not None:
+        completion_cache.put(key, response)
+        completion_cache.commit()
+
+
+def get_llm_response(
+    query: str,
+    sources=None,
+    cache=None,
+    client: Mistral = None,
+    completion_cache: DiskCache = None,
+    replay: bool = False,
+    sampling: dict = None,
+    offline: bool = False,
+    **prompt_options,
+):
     """Takes a command line string query as the argument. Calls policy-chat API to get relevant
-    sources and then passes to a LLM for repsonse generation.
+    sources and then passes to a LLM for repsonse generation. Completions of prompts
+    already in the completion cache are not requested again. `offline`, the sources are
+    only read from the retrieval cache. The prompt options (k, max_tokens, ...) are
+    passed to pack_prompt.
     """
 
     # get the retrieved sources from policy-chat API if needed
     if not sources:
-        sources = pass_to_policy_chat(query)
+        sources = pass_to_policy_chat(query, cache, offline)
 
     # format content to pass to the API
-    prompt = f""" Based on the following retreieved sources using a policy-chat API, please answer the query.
-    Here is the query:
-    query = "{query}"
-    Here are the retrieved sources, the higher the source number the less relevant the information will be, take that into account.
-    Base your response off of the retrieved sources, make them not too long and easily understandable.
-    If none of the sources help you answer the question, say that you cannot answer it with the sources. Do not make up an answer.
-    source 1: {sources[0]}
-    source 2: {sources[1]}
-    source 3: {sources[2]}
-    source 4: {sources[3]}
-    source 5: {sources[4]}
-    """
+    prompt = build_prompt(query, sources, **prompt_options)
+    sampling = sampling or {}
+    key = completion_cache_key(MODEL, prompt, sampling)
+    response = _cached_completion(completion_cache, key, replay)
+    if response is not None:
+        return format_response(response)
 
     # call the mistral API to generate a response
-    api_key = os.environ["MISTRAL_API_KEY"]
-    model = "mistral-large-latest"
+    if client is None:
+        client = get_client()
+    instrumentation.count("mistral requests")
+    with instrumentation.latency("mistral"):
+        chat_response = client.chat.complete(
+            model=MODEL, messages=[{"role": "user", "content": prompt}], **sampling
+        )
+    response = chat_response.choices[0].message.content
+    _store_completion(completion_cache, key, response)
+    return format_response(response)
 
-    client = MistralClient(api_key=api_key)
 
-    chat_response = client.chat(
-        model=model, messages=[ChatMessage(role="user", content=prompt)]
-    )
+class TokenBucket:
+    """Rate limiter that allows `requests_per_second` requests and, optionally,
+    `tokens_per_minute` prompt tokens, with bursts up to one second of requests and
+    one minute of tokens.
+    """
 
-    response = chat_response.choices[0].message.content
+    def __init__(self, requests_per_second: float, tokens_per_minute: float = None):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.request_capacity = max(1.0, requests_per_second)
+        self.requests = self.request_capacity
+        self.tokens = tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
-    # format the response
-    formated_response = response.replace("\n", "")
-    return formated_response
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(
+            self.request_capacity, self.requests + elapsed * self.requests_per_second
+        )
+        if self.tokens_per_minute is not None:
+            self.tokens = min(
+                self.tokens_per_minute,
+                self.tokens + elapsed * self.tokens_per_minute / 60,
+            )
 
+    async def acquire(self, tokens: int = 0):
+        """Waits until a request of `tokens` prompt tokens is allowed."""
+        async with self.lock:
+            if self.tokens_per_minute is not None:
+                # a request larger than the bucket waits for a full bucket
+                tokens = min(tokens, self.tokens_per_minute)
+            while True:
+                self._refill()
+                wait = (1 - self.requests) / self.requests_per_second
+                if self.tokens_per_minute is not None:
+                    wait = max(
+                        wait, (tokens - self.tokens) * 60 / self.tokens_per_minute
+                    )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests -= 1
+            if self.tokens_per_minute is not None:
+                self.tokens -= tokens
+
+
+def _should_retry(error: Exception) -> bool:
+    """Retries rate limits, server errors and connection errors."""
+    if isinstance(error, models.SDKError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+async def _generate_one(
+    client: Mistral,
+    limiter: TokenBucket,
+    semaphore: asyncio.Semaphore,
+    query: str,
+    sources: list,
+    model: str,
+    retries: int,
+    backoff: float,
+    cache,
+    completion_cache: DiskCache,
+    replay: bool,
+    sampling: dict,
+    prompt_options: dict,
+    offline: bool,
+):
+    """Generates the response to one query, retrying with jittered exponential backoff.
+    Cached completions are returned without calling the API. Returns the response and
+    the estimated number of prompt tokens.
+    """
+    if not sources:
+        (response_data,) = await ask_policy_chat([query], cache=cache, offline=offline)
+        sources = get_source_texts(response_data)
+    prompt, prompt_tokens = pack_prompt(query, sources, **prompt_options)
+    key = completion_cache_key(model, prompt, sampling)
+    response = _cached_completion(completion_cache, key, replay)
+    if response is not None:
+        return format_response(response), prompt_tokens
+
+    async with semaphore:
+        for attempt in range(retries + 1):
+            await limiter.acquire(prompt_tokens)
+            instrumentation.count("mistral requests")
+            try:
+                with instrumentation.latency("mistral"):
+                    chat_response = await client.chat.complete_async(
+                        model=model,
+                        messages=[{"role": "user", "content": prompt}],
+                        **sampling,
+                    )
+                response = chat_response.choices[0].message.content
+                _store_completion(completion_cache, key, response)
+                return format_response(response), prompt_tokens
+            except (models.SDKError, httpx.TransportError) as error:
+                if attempt == retries or not _should_retry(error):
+                    raise
+                instrumentation.count("mistral retries")
+                await asyncio.sleep(random.uniform(0, backoff * 2**attempt))
+
+
+async def stream_llm_responses(
+    rows,
+    client: Mistral = None,
+    api_key: str = None,
+    server_url: str = None,
+    model: str = MODEL,
+    concurrency: int = 4,
+    requests_per_second: float = 1.0,
+    tokens_per_minute: float = None,
+    retries: int = 5,
+    backoff: float = 1.0,
+    cache=None,
+    completion_cache: DiskCache = None,
+    replay: bool = False,
+    sampling: dict = None,
+    k: int = 5,
+    max_prompt_tokens: int = None,
+    max_source_tokens: int = None,
+    offline: bool = False,
+):
+    """Yields (query, response, prompt tokens) for every (query, sources) row in input
+    order. One client is shared by all the requests, which run `concurrency` at a time
+    under a token bucket rate limit. Rows without sources are retrieved from policy-chat,
+    or `offline` only from the retrieval cache (a query that is not cached raises
+    CacheMissError).
+    Each prompt packs up to k sources into `max_prompt_tokens`, see pack_prompt.
+    Prompts in the completion cache are answered from it; with `replay` the API is
+    never called and a prompt that is not cached raises CacheMissError.
+
+    Without a `client`, one is made for this event loop from `api_key` and
+    `server_url`, with a pool of `concurrency` keep-alive connections.
+    """
+    sampling = sampling or {}
+    prompt_options = {
+        "k": k,
+        "max_tokens": max_prompt_tokens,
+        "max_source_tokens": max_source_tokens,
+    }
+    async_client = None
+    if client is None and not replay:
+        limits = httpx.Limits(
+            max_connections=concurrency, max_keepalive_connections=concurrency
+        )
+        async_client = httpx.AsyncClient(limits=limits)
+        client = get_client(api_key, server_url, async_client)
+    limiter = TokenBucket(requests_per_second, tokens_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    pending = deque()
+    try:
+        for query, sources in rows:
+            task = asyncio.ensure_future(
+                _generate_one(
+                    client,
+                    limiter,
+                    semaphore,
+                    query,
+                    sources,
+                    model,
+                    retries,
+                    backoff,
+                    cache,
+                    completion_cache,
+                    replay,
+                    sampling,
+                    prompt_options,
+                    offline,
+                )
+            )
+            pending.append((query, task))
+            if len(pending) >= 2 * concurrency:
+                query, task = pending.popleft()
+                yield (query, *await task)
+        while pending:
+            query, task = pending.popleft()
+            yield (query, *await task)
+    finally:
+        for _, task in pending:
+            task.cancel()
+        if async_client is not None:
+            await async_client.aclose()
+
+
+def row_id(index: int, query: str, sources) -> str:
+    """Returns the id of an input row: its position and a hash of its content."""
+    return f"{index}-{make_key('row', query, sources)[:16]}"
+
+
+def read_manifest(manifest_f: str):
+    """Returns the completed row ids of a run manifest and the size of the output file
+    when the last of them was recorded, or (empty set, None) if there is no manifest.
+    """
+    completed, offset = set(), None
+    if os.path.exists(manifest_f):
+        for record in read_jsonl(manifest_f):
+            completed.add(record["row"])
+            offset = record["offset"]
+    return completed, offset
+
+
+async def _write_llm_responses(rows, f_out, manifest: JsonlWriter, completed, **kwargs):
+    """Writes every generated response to the csv file as soon as it is in order, then
+    records its row id, the new size of the output and the prompt tokens in the manifest.
+    """
+    writer = csv.writer(f_out)
+    pending_ids = deque()
+
+    def remaining_rows():
+        for i, (query, sources) in enumerate(rows):
+            current_id = row_id(i, query, sources)
+            if current_id in completed:
+                continue
+            pending_ids.append(current_id)
+            yield query, sources
+
+    responses = stream_llm_responses(remaining_rows(), **kwargs)
+    async for query, llm_response, prompt_tokens in responses:
+        writer.writerow([query] + [llm_response] + [""])
+        f_out.flush()
+        os.fsync(f_out.fileno())
+        manifest.write(
+            {
+                "row": pending_ids.popleft(),
+                "offset": f_out.tell(),
+                "prompt tokens": prompt_tokens,
+            }
+        )
 
-if __name__ == "__main__":
-    out_f = "./data/llm_responses.csv"
-    in_f = "./data/retrieved_sources.csv"  # do not provide an input file if you want to use command line arguments
 
-    # get the total number of arguments
-    n = len(sys.argv)
+def generate_llm_responses(
+    rows,
+    output: str,
+    resume: bool = False,
+    manifest_f: str = None,
+    report_f: str = None,
+    **kwargs,
+):
+    """Generates the LLM response to every (query, sources) row and writes them to a
+    csv file in input order, see stream_llm_responses for the options.
+
+    Every completed row is recorded in a run manifest (`output`.manifest.jsonl by
+    default). With `resume`, the rows in the manifest are skipped and the new rows
+    are appended to the output, after dropping anything written after the last
+    recorded row. With `report_f`, the run is instrumented and its report written
+    there as JSON.
+    """
+    if manifest_f is None:
+        manifest_f = f"{output}.manifest.jsonl"
+    completed, offset = read_manifest(manifest_f) if resume else (set(), None)
+
+    if offset is None:
+        # start a new run
+        with open(output, mode="w", newline="") as f_out:
+            writer = csv.writer(f_out)
+            # write the header
+            writer.writerow(["query", "response"])
+        manifest_mode = "w"
+    else:
+        # drop a row that was written but not recorded before the run stopped
+        with open(output, mode="r+b") as f_out:
+            f_out.truncate(offset)
+        manifest_mode = "a"
+
+    with instrumentation.reporting(report_f), instrumentation.stage("generation"):
+        with open(output, mode="a", newline="") as f_out, JsonlWriter(
+            manifest_f, mode=manifest_mode, fsync=True
+        ) as manifest:
+            asyncio.run(
+                _write_llm_responses(rows, f_out, manifest, completed, **kwargs)
+            )
+    return output
+
+
+def read_sources(input_f: str):
+    """Lazily reads the (query, sources) rows of a csv file of retrieved sources."""
+    with open(input_f, mode="r", newline="") as f_in:
+        reader = csv.reader(f_in)
+        next(reader, None)  # skip the header
+        for row in reader:
+            yield row[0], row[1:]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "query",
+        nargs="?",
+        help="a single query to answer with sources from policy-chat",
+    )
+    parser.add_argument(
+        "--input",
+        default="./data/retrieved_sources.csv",
+        help="csv file of queries and sources, used when no query is given",
+    )
+    parser.add_argument("--output", default="./data/llm_responses.csv")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the rows a previous run completed and append to its output",
+    )
+    parser.add_argument(
+        "-k", type=int, default=5, help="the number of sources to put in each prompt"
+    )
+    parser.add_argument(
+        "--max-prompt-tokens",
+        type=int,
+        help="token budget of each prompt, the sources are truncated to fit it",
+    )
+    parser.add_argument(
+        "--max-source-tokens",
+        type=int,
+        help="token budget of each source in a prompt",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="requests to the API in flight"
+    )
+    parser.add_argument("--requests-per-second", type=float, default=1.0)
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=float,
+        help="limit the estimated prompt tokens sent to the API per minute",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="write timings, counters and latencies to <output>.report.json",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="only answer from the completion cache, never call the API",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="only read the sources from the retrieval cache, never call policy-chat",
+    )
+    parser.add_argument(
+        "--retrieval-cache-ttl",
+        type=float,
+        help="seconds after which a cached policy-chat response is retrieved again",
+    )
+    parser.add_argument(
+        "--retrieval-cache-max-entries",
+        type=int,
+        help="evict the least recently used policy-chat responses past this many",
+    )
+    args = parser.parse_args()
 
     # if just a query is provided
-    if n == 2:
-        query = sys.argv[1]
-        responses = [(query, None)]  # get sources from poliy-chat
+    if args.query is not None:
+        rows = [(args.query, None)]  # get sources from poliy-chat
         print("need to call policy chat")
 
     else:  # a csv file is passed with sources already generated
         print("sources already generated")
-        responses = []
-        with open(in_f, mode="r", newline="") as f_in:
-            reader = csv.reader(f_in)
-            for row in reader:
-                query = row[0]
-                sources = row[1:]
-                responses.append((query, sources))
-
-    # open the output file for writing
-    with open(out_f, mode="w", newline="") as f_out:
-        writer = csv.writer(f_out)
-        # write the header
-        writer.writerow(["query", "response"])
-
-        # generate the llm response
-        for row in responses[1:]:  # skips the header
-            query = row[0]
-            sources = row[1]
-            llm_response = get_llm_response(query, sources)
-
-            # format the row to write
-            row = [query] + [llm_response] + [""]
-            # write the row
-            writer.writerow(row)
-    print(out_f)
+        rows = read_sources(args.input)
+
+    # generate the llm responses, retrieved sources and completions are cached
+    with open_retrieval_cache(
+        ttl=args.retrieval_cache_ttl, max_entries=args.retrieval_cache_max_entries
+    ) as cache, open_completion_cache() as completion_cache:
+        generate_llm_responses(
+            rows,
+            args.output,
+            resume=args.resume,
+            cache=cache,
+            completion_cache=completion_cache,
+            replay=args.replay,
+            offline=args.offline,
+            concurrency=args.concurrency,
+            requests_per_second=args.requests_per_second,
+            tokens_per_minute=args.tokens_per_minute,
+            k=args.k,
+            max_prompt_tokens=args.max_prompt_tokens,
+            max_source_tokens=args.max_source_tokens,
+            report_f=instrumentation.report_path(args.output) if args.report else None,
+        )
+        print("completion cache:", completion_cache.stats())
+    print(args.output)
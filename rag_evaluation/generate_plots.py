@@ -1,43 +1,54 @@
 """Script to generate relevant plots for the retrieval data.
+
+The relevance columns of data.csv are reshaped once into a long table that every
+figure is built from. The figures are shown in the browser, or written as static
+html/png/svg files in parallel for unattended runs (png and svg need kaleido).
 """
 
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import plotly.express as px
 
+from rag_evaluation import agreement
+from rag_evaluation.columnar import (LLM_RESPONSES_SCHEMA, METRICS_SCHEMA,
+                                     RETRIEVAL_SCHEMA, find_table, read_frame)
+
+HUMAN_RELEVANCE = "human relevance"
+HUMAN_BINARY = "human binary relevance"
+GENERATED_BINARY = "generated binary relevance"
+
+FORMATS = ("html", "png", "svg")
+
 
 def create_violin(df, x: str, y: str, title: str):
     fig = px.violin(df, y="value", color=x, box=True, points="all", title=title)
     fig.update_layout(yaxis_title=y, xaxis_title=x, boxmode="overlay")
-    fig.show()
+    return fig
 
 
 def create_bar(df, x: str, y: str, color: str, title: str):
     fig = px.bar(df, x=x, y=y, color=color, barmode="group", title=title)
-    fig.show()
+    return fig
 
 
 def create_scatter(df, x: str, y: str, color=None, symbol=None):
     fig = px.scatter(df, x=x, y=y, color=color, symbol=symbol)
-    fig.show()
-
-
-def create_confusion_matrix(df, group_1: str, group_2: str):
-    cm = ((df.groupby([group_2, group_1])).size()).unstack(fill_value=0)
-    cm = cm.reindex([1, 0], axis=0).reindex([1, 0], axis=1)
-    print(cm)
+    return fig
 
 
-def filter_data_by_source(df, columns: list):
-    """Creates source dataframe from the main dataframe given a list of columns to filter."""
-    df = df.iloc[:, columns]
-    return df
+def create_confusion_matrix(cm, title: str):
+    """Creates an annotated heatmap of a confusion matrix."""
+    fig = px.imshow(cm, text_auto=True, title=title)
+    fig.update_xaxes(type="category")
+    fig.update_yaxes(type="category")
+    return fig
 
 
 def transform_source_df(df, var_name: str, value_name: str):
     """Group long data together for ease of plotting."""
-    # transform wide format to long
-    # df = df.melt(var_name, value_name)
-
     # convert value to string to use discrete coloring
     df[value_name] = df[value_name].astype(str)
 
@@ -46,112 +57,173 @@ def transform_source_df(df, var_name: str, value_name: str):
     return df
 
 
-def generate_source_plots(
-    df, source_df: str, columns: list, group_1: str, group_2: str, plot_name: str
-):
-    """Generates the bar graph and confusion matrix for a given source after manipulating the data."""
-    # transform the data frame
-    source_df = filter_data_by_source(df, columns)  # wide data
-    long_source_df = transform_source_df(
-        source_df.melt(var_name="relevance", value_name="value"), "relevance", "value"
-    )  # long data
+def long_relevances(df):
+    """Reshapes the wide relevance columns (e.g. "source 1 human relevance") into one
+    long table with a row per query and column: its row, column name ("relevance"),
+    source number, kind of relevance and value. Missing relevances are dropped.
+    """
+    long_df = df.reset_index(names="row").melt(
+        id_vars="row", var_name="relevance", value_name="value"
+    )
+    long_df = long_df.loc[long_df["value"].notna() & (long_df["value"] != -1)]
+    parts = long_df["relevance"].str.extract(r"source (\d+) (.+)")
+    return long_df.assign(
+        source=parts[0].astype(int), kind=parts[1], value=long_df["value"].astype(int)
+    )
 
-    create_confusion_matrix(source_df, group_1, group_2)
-    create_bar(long_source_df, "relevance", "count", "value", plot_name)
 
+def confusion_matrices(df) -> dict:
+    """Returns the generated (rows) against human (columns) binary relevance confusion
+    matrix of every source in the wide relevances, see agreement.confusion_matrices.
+    """
+    sources = sorted(
+        int(source)
+        for source in df.columns.str.extract(rf"source (\d+) {HUMAN_BINARY}")[0]
+        .dropna()
+        .unique()
+    )
+    human = df[[f"source {source} {HUMAN_BINARY}" for source in sources]]
+    generated = df[[f"source {source} {GENERATED_BINARY}" for source in sources]]
+    cms = agreement.confusion_matrices(
+        human.fillna(-1).to_numpy(), generated.fillna(-1).to_numpy()
+    )
+    # 1 before 0 in both directions
+    return {
+        source: pd.DataFrame(
+            cm[::-1, ::-1],
+            index=pd.Index([1, 0], name=GENERATED_BINARY),
+            columns=pd.Index([1, 0], name=HUMAN_BINARY),
+        )
+        for source, cm in zip(sources, cms)
+    }
+
+
+def build_figures(retrieved_df, metrics_df, llm_df) -> dict:
+    """Returns every figure of the report by name, built from the wide relevances of
+    data.csv, the normalized metrics and the llm response ratings.
+    """
+    long_df = long_relevances(retrieved_df)
+    # count every value of every relevance column once for all the bar plots
+    counts = (
+        long_df.groupby(["source", "kind", "relevance", "value"])
+        .size()
+        .reset_index(name="count")
+    )
+    counts["value"] = counts["value"].astype(str)  # discrete coloring
 
-if __name__ == "__main__":
-    # read and clean the raw retrieval data
-    retrieved_df = pd.read_csv("./data/data.csv")  # convert the csv to a df
-    retrieved_df = retrieved_df.loc[
-        retrieved_df["source 1 human relevance"] != -1
-    ]  # get rid of the -1 rows
-    retrieved_df = retrieved_df.iloc[
-        :, 7:
-    ]  # get rid of the queries and sources (wide data)
-
-    # generate human retrieval metric plots (i.e on a scale of 0-4)
-    human_relevance_df = retrieved_df.iloc[:, [0, 1, 2, 3, 4]]
-    long_human_relevance_df = transform_source_df(
-        human_relevance_df.melt(var_name="relevance", value_name="value"),
+    figures = {}
+    # human retrieval metric plots (i.e on a scale of 0-4)
+    figures["human_relevance"] = create_bar(
+        counts.loc[counts["kind"] == HUMAN_RELEVANCE],
         "relevance",
+        "count",
         "value",
-    )  # long data
-    create_bar(
-        long_human_relevance_df, "relevance", "count", "value", "human_relevance"
+        "human_relevance",
     )
 
-    # generate plots for source 1
-    generate_source_plots(
-        retrieved_df,
-        "source1_df",
-        [5, 10],
-        "source 1 human binary relevance",
-        "source 1 generated binary relevance",
-        "source 1",
+    # human against generated binary relevance of every source
+    binary_counts = counts.loc[counts["kind"].isin([HUMAN_BINARY, GENERATED_BINARY])]
+    for source, source_counts in binary_counts.groupby("source"):
+        figures[f"source_{source}"] = create_bar(
+            source_counts, "relevance", "count", "value", f"source {source}"
+        )
+    for source, cm in confusion_matrices(retrieved_df).items():
+        figures[f"source_{source}_confusion"] = create_confusion_matrix(
+            cm, f"source {source} generated vs human binary relevance"
+        )
+
+    # the normalized retrieval metrics (e.g. precision @k)
+    normal_retrieved = metrics_df.melt(var_name="metric", value_name="value")
+    figures["retrieval_metrics"] = create_violin(
+        normal_retrieved, "metric", "value", "retrieval metrics"
     )
 
-    # generate plots for source 2
-    generate_source_plots(
-        retrieved_df,
-        "source2_df",
-        [6, 11],
-        "source 2 human binary relevance",
-        "source 2 generated binary relevance",
-        "source 2",
+    # the llm repsonse data
+    long_llm_df = transform_source_df(
+        llm_df.melt(var_name="statistic", value_name="value"), "statistic", "value"
     )
-
-    # generate plots for source 3
-    generate_source_plots(
-        retrieved_df,
-        "source3_df",
-        [7, 12],
-        "source 3 human binary relevance",
-        "source 3 generated binary relevance",
-        "source 3",
+    figures["llm_response"] = create_bar(
+        long_llm_df, "statistic", "count", "value", "llm response"
     )
+    return figures
+
+
+def _write_figure(name: str, figure_json: str, output_dir: str, formats) -> list:
+    """Writes one figure in every format in a worker process, returns the paths."""
+    import plotly.io as pio
+
+    figure = pio.from_json(figure_json)
+    paths = []
+    for extension in formats:
+        path = os.path.join(output_dir, f"{name}.{extension}")
+        if extension == "html":
+            # plotly.js is written once next to the files instead of into each one
+            figure.write_html(path, include_plotlyjs="directory")
+        else:
+            figure.write_image(path)
+        paths.append(path)
+    return paths
+
+
+def write_figures(figures: dict, output_dir: str, formats=("html",), workers=1):
+    """Writes every figure to output_dir in the given formats (html, png or svg),
+    rendering `workers` figures at a time. Returns the paths written.
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"unknown formats {sorted(unknown)}, expected {FORMATS}")
+    if set(formats) - {"html"}:
+        try:
+            import kaleido  # noqa: F401
+        except ImportError:
+            raise ImportError("png and svg output needs kaleido installed") from None
+
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [
+        (name, figure.to_json(), output_dir, tuple(formats))
+        for name, figure in figures.items()
+    ]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            written = list(executor.map(_write_figure, *zip(*jobs)))
+    else:
+        written = [_write_figure(*job) for job in jobs]
+    return [path for paths in written for path in paths]
 
-    # generate plots for source 4
-    generate_source_plots(
-        retrieved_df,
-        "source4_df",
-        [8, 13],
-        "source 4 human binary relevance",
-        "source 4 generated binary relevance",
-        "source 4",
-    )
 
-    # generate plots for source 5
-    generate_source_plots(
-        retrieved_df,
-        "source5_df",
-        [9, 14],
-        "source 5 human binary relevance",
-        "source 5 generated binary relevance",
-        "source 5",
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--output-dir",
+        help="write the figures to this directory instead of showing them",
     )
-
-    # read and clean the generated retrieval metrics (e.g. precision @k)
-    normal_retrieved_df = pd.read_csv("./data/normalized_metrics.csv")
-    normal_retrieved_unswapped = normal_retrieved_df.iloc[:, 1:]
-    normal_retrieved = normal_retrieved_unswapped.melt(
-        var_name="metric", value_name="value"
+    parser.add_argument(
+        "--format", nargs="+", choices=FORMATS, default=["html"], dest="formats"
     )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
 
-    # plot the normalized retrieval metrics
-    create_violin(normal_retrieved, "metric", "value", "retrieval metrics")
-
-    # read, clean, and transform the llm data
-    llm_df = (pd.read_csv("./data/llm_responses_data.csv")).iloc[
-        :, 2:-1
-    ]  # get just the metrics from the csv file
-
-    # convert llm data to long data
-    long_llm_df = llm_df.melt(var_name="statistic", value_name="value")
-    long_llm_df["value"] = long_llm_df["value"].astype(str)
-    long_llm_df = (
-        long_llm_df.groupby(["statistic", "value"]).size().reset_index(name="count")
-    )
+    # read and clean the raw retrieval data, only the relevances (wide data)
+    relevance_columns = [name for name in RETRIEVAL_SCHEMA if "relevance" in name]
+    retrieved_df = read_frame(find_table("./data/data.csv"), relevance_columns)
+    retrieved_df = retrieved_df.loc[
+        retrieved_df["source 1 human relevance"] != -1
+    ]  # get rid of the -1 rows
 
-    # plot the llm repsonse data
-    create_bar(long_llm_df, "statistic", "count", "value", "llm response")
+    # read the generated retrieval metrics (e.g. precision @k)
+    metric_columns = [name for name in METRICS_SCHEMA if name != "prompt"]
+    metrics_df = read_frame(find_table("./data/normalized_metrics.csv"), metric_columns)
+
+    # read the llm ratings
+    rating_columns = [
+        name for name, dtype in LLM_RESPONSES_SCHEMA.items() if dtype == "int8"
+    ]
+    llm_df = read_frame(find_table("./data/llm_responses_data.csv"), rating_columns)
+
+    figures = build_figures(retrieved_df, metrics_df, llm_df)
+    if args.output_dir is None:
+        for figure in figures.values():
+            figure.show()
+    else:
+        for path in write_figures(figures, args.output_dir, args.formats, args.workers):
+            print(path)
@@ -0,0 +1,220 @@
+"""Opt-in instrumentation shared by the pipeline stages: wall and CPU time per stage,
+counters (tokenizations, HTTP calls, cache hits, ...) and latency histograms, written
+as a JSON report.
+
+Nothing is recorded until a recorder is enabled, e.g. with `recording(report_f)`.
+While disabled, `stage` and `latency` return a shared no-op context manager, `count`
+returns immediately and `get_tokenizer` hands out the plain tokenizer functions.
+"""
+
+import bisect
+import contextlib
+import datetime
+import json
+import os
+import time
+from collections import Counter
+
+# upper bounds in seconds of the latency histogram buckets, the last one is open
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+_recorder = None
+_DISABLED = contextlib.nullcontext()
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, so memory stays constant per name."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        labels = [f"<={bound}" for bound in LATENCY_BUCKETS] + [
+            f">{LATENCY_BUCKETS[-1]}"
+        ]
+        return {
+            "count": self.count,
+            "total seconds": self.total,
+            "mean seconds": self.total / self.count if self.count else None,
+            "min seconds": self.min if self.count else None,
+            "max seconds": self.max,
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+
+class Recorder:
+    """Collects the stage timings, counters and latencies of one run."""
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = {}
+        self.counters = Counter()
+        self.latencies = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            totals = self.stages.setdefault(
+                name, {"calls": 0, "wall seconds": 0.0, "cpu seconds": 0.0}
+            )
+            totals["calls"] += 1
+            totals["wall seconds"] += time.perf_counter() - wall
+            totals["cpu seconds"] += time.process_time() - cpu
+
+    @contextlib.contextmanager
+    def latency(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies.setdefault(name, Histogram()).add(
+                time.perf_counter() - start
+            )
+
+    def report(self) -> dict:
+        """Returns the recorded run as a JSON serializable dict."""
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall seconds": time.perf_counter() - self.start_wall,
+            "cpu seconds": time.process_time() - self.start_cpu,
+            "stages": self.stages,
+            "counters": dict(self.counters),
+            "latencies": {
+                name: histogram.to_dict() for name, histogram in self.latencies.items()
+            },
+        }
+
+
+def enable() -> Recorder:
+    """Starts recording with a new recorder and returns it."""
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable():
+    """Stops recording and returns the recorder that was in use, if any."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def enabled() -> bool:
+    return _recorder is not None
+
+
+def stage(name: str):
+    """Times a stage of the run (wall and CPU time), e.g. `with stage("score"): ...`."""
+    if _recorder is None:
+        return _DISABLED
+    return _recorder.stage(name)
+
+
+def latency(name: str):
+    """Adds the duration of the block to the latency histogram of a kind of request."""
+    if _recorder is None:
+        return _DISABLED
+    return _recorder.latency(name)
+
+
+def count(name: str, n: int = 1):
+    """Adds n to a counter, e.g. count("http calls")."""
+    if _recorder is not None:
+        _recorder.counters[name] += n
+
+
+def merge_counts(counts: dict):
+    """Adds the counters recorded in another process (e.g. a pool worker)."""
+    if _recorder is not None:
+        _recorder.counters.update(counts)
+
+
+def counting(function, name: str):
+    """Returns the function wrapped to count its calls, or the function itself when
+    recording is disabled.
+    """
+    if _recorder is None or getattr(function, "counted_as", None) == name:
+        return function
+
+    def counted(*args, **kwargs):
+        count(name)
+        return function(*args, **kwargs)
+
+    counted.counted_as = name
+    return counted
+
+
+def write_report(report_f: str, recorder: Recorder = None):
+    """Writes the report of a recorder (the current one by default) as JSON."""
+    recorder = recorder or _recorder
+    with open(report_f, mode="w") as f_out:
+        json.dump(recorder.report(), f_out, indent=2)
+
+
+@contextlib.contextmanager
+def recording(report_f: str = None):
+    """Records everything in the block and writes the report to report_f at the end,
+    even if the run fails. Inside another recording, the block is recorded by it.
+    """
+    if _recorder is not None:
+        try:
+            yield _recorder
+        finally:
+            if report_f is not None:
+                write_report(report_f)
+        return
+    recorder = enable()
+    try:
+        yield recorder
+    finally:
+        disable()
+        if report_f is not None:
+            write_report(report_f, recorder)
+
+
+def reporting(report_f: str = None):
+    """Records the block and writes its report to report_f, or does nothing extra when
+    there is no report file (an outer recording still sees the block).
+    """
+    if report_f is None:
+        return _DISABLED
+    return recording(report_f)
+
+
+def report_path(output_f: str) -> str:
+    """Returns the path of the report written alongside an output file."""
+    if output_f == "-":
+        return "report.json"
+    return f"{os.path.splitext(output_f)[0]}.report.json"
@@ -0,0 +1,51 @@
+"""Streaming JSON Lines files: one compact JSON record per line.
+"""
+
+import json
+import os
+
+
+class JsonlWriter:
+    """Appends one compact JSON record per line, flushing every record so that an
+    interrupted run keeps everything written so far. With `fsync` every record is
+    also synced to disk before write returns.
+    """
+
+    def __init__(self, path: str, mode: str = "w", fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self.f_out = open(path, mode=mode, encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, record):
+        """Writes a record as a single line."""
+        self.f_out.write(
+            json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        )
+        self.f_out.flush()
+        if self.fsync:
+            os.fsync(self.f_out.fileno())
+
+    def close(self):
+        self.f_out.close()
+
+
+def read_jsonl(path: str):
+    """Lazily yields the records of a JSON Lines file. A last line cut off by an
+    interrupted write is skipped.
+    """
+    with open(path, mode="r", encoding="utf-8") as f_in:
+        for line in f_in:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # only the unterminated last line of an interrupted run may be partial
+                if line.endswith("\n"):
+                    raise
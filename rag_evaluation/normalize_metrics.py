@@ -1,25 +1,181 @@
 """Normalizes data using max min scaling so all the metrics can be easily compared.
+
+The metrics are rescaled in two streaming passes over the csv file: the first finds
+the minimum and maximum of every metric (per group, optionally), and the second
+rescales and writes each row, so the file is never held in memory. Metrics with fixed
+bounds (e.g. the theoretical bounds of metric_bounds) skip the first pass.
 """
 
-import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+import argparse
+import csv
+import math
 
-if __name__ == "__main__":
-    # open the file with the metrics
-    df = pd.read_csv("metrics.csv")
+from rag_evaluation import instrumentation
+from rag_evaluation.calculate_retrieval_metrics import (
+    FIELD_SIZE_LIMIT, cumulative_gain, normalized_discounted_cg)
+
+METRICS = [
+    "precision at k",
+    "mean reciprocal rank",
+    "average precision",
+    "cumulative gain",
+    "normalized discounted cumulative gain",
+]
+
+# the fake row older metrics files carry to pin the ranges, it is never used or written
+SENTINEL_PROMPT = "This is a row to normalize the data"
+
+
+def metric_bounds(k: int = 5, max_relevance: int = 4) -> dict:
+    """Returns the theoretical (minimum, maximum) of every metric of
+    calculate_retrieval_metrics for k sources rated from 0 to max_relevance.
+    """
+    # the gains are the k + 1 relevance columns read by parse_responses
+    best = [max_relevance] * (k + 1)
+    return {
+        "precision at k": (0.0, 1.0),
+        "mean reciprocal rank": (0.0, 1.0),
+        "average precision": (0.0, 1.0),
+        "cumulative gain": (0.0, float(cumulative_gain(best))),
+        "normalized discounted cumulative gain": (
+            0.0,
+            float(normalized_discounted_cg(best)),
+        ),
+    }
+
+
+def rescale(value: float, low: float, high: float) -> float:
+    """Min-max scales a value into [0, 1], a constant range maps to 0 like MinMaxScaler."""
+    if high == low:
+        return value - low
+    return (value - low) / (high - low)
+
+
+def _read_rows(input_f: str):
+    """Lazily yields the header and then the rows of a metrics file, skipping the
+    sentinel row.
+    """
+    with open(input_f, mode="r", newline="") as f_in:
+        reader = csv.reader(f_in)
+        yield next(reader)
+        for row in reader:
+            if row and row[0] != SENTINEL_PROMPT:
+                yield row
+
+
+def column_index(header: list, name: str) -> int:
+    """Returns the index of a column, ignoring the spaces around the names (the metrics
+    files of generate_metrics have a leading space in some metric names).
+    """
+    names = [column.strip() for column in header]
+    try:
+        return names.index(name.strip())
+    except ValueError:
+        raise ValueError(f"no column {name!r} in {header}") from None
 
-    # get the variables
-    queries = df[["prompt"]]
-    metrics = df.drop(columns=["prompt"])
 
-    # normalize using min max scaling
-    scaler = MinMaxScaler()
-    normalized_metrics = scaler.fit_transform(metrics)
+def scan_ranges(input_f: str, metrics: list, group_by: str = None) -> dict:
+    """Returns the observed {group: {metric: (minimum, maximum)}} of a metrics file in a
+    single pass, with every row in the group None when there is no group column.
+    """
+    rows = _read_rows(input_f)
+    header = next(rows)
+    indices = [column_index(header, metric) for metric in metrics]
+    group_index = column_index(header, group_by) if group_by is not None else None
 
-    # add normalized data to a data frame
-    min_max = pd.concat(
-        [queries, pd.DataFrame(normalized_metrics, columns=metrics.columns)], axis=1
+    ranges = {}
+    for row in rows:
+        group = row[group_index] if group_index is not None else None
+        group_ranges = ranges.setdefault(group, {})
+        for metric, i in zip(metrics, indices):
+            if row[i] == "":
+                continue
+            value = float(row[i])
+            low, high = group_ranges.get(metric, (math.inf, -math.inf))
+            group_ranges[metric] = (min(low, value), max(high, value))
+    return ranges
+
+
+def normalize_metrics(
+    input_f: str,
+    output_f: str,
+    metrics: list = None,
+    bounds: dict = None,
+    group_by: str = None,
+    field_size_limit: int = FIELD_SIZE_LIMIT,
+    report_f: str = None,
+) -> str:
+    """Min-max scales the metrics of a csv file and writes the rows to output_f. The
+    metrics in `bounds` ({metric: (minimum, maximum)}) are scaled with those bounds;
+    the others with the range observed in the file, or in their group of rows with the
+    same `group_by` value. Empty cells are left empty. With `report_f`, the run is
+    instrumented and its report written there as JSON.
+    """
+    with instrumentation.reporting(report_f):
+        csv.field_size_limit(field_size_limit)
+        metrics = METRICS if metrics is None else metrics
+        bounds = bounds or {}
+        observed = [metric for metric in metrics if metric not in bounds]
+        with instrumentation.stage("scan ranges"):
+            ranges = scan_ranges(input_f, observed, group_by) if observed else {}
+        with instrumentation.stage("rescale"):
+            _rescale_rows(input_f, output_f, metrics, bounds, ranges, group_by)
+    return output_f
+
+
+def _rescale_rows(input_f, output_f, metrics, bounds, ranges, group_by):
+    """Writes every row of the metrics file with its metrics rescaled."""
+    rows = _read_rows(input_f)
+    header = next(rows)
+    indices = [column_index(header, metric) for metric in metrics]
+    group_index = column_index(header, group_by) if group_by is not None else None
+    with open(output_f, mode="w", newline="") as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(header)
+        for row in rows:
+            group = row[group_index] if group_index is not None else None
+            group_ranges = ranges.get(group, {})
+            for metric, i in zip(metrics, indices):
+                if row[i] == "":
+                    continue
+                low, high = bounds.get(metric) or group_ranges[metric]
+                row[i] = repr(rescale(float(row[i]), low, high))
+            writer.writerow(row)
+            instrumentation.count("rows normalized")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", nargs="?", default="metrics.csv")
+    parser.add_argument("output", nargs="?", default="normalized_metrics.csv")
+    parser.add_argument(
+        "--theoretical-bounds",
+        action="store_true",
+        help="scale with the fixed bounds of each metric instead of the observed ranges",
+    )
+    parser.add_argument("-k", type=int, default=5, help="number of sources")
+    parser.add_argument(
+        "--max-relevance", type=int, default=4, help="highest human relevance"
+    )
+    parser.add_argument(
+        "--group-by", help="column whose values are normalized separately"
     )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="write timings and counters to <output>.report.json",
+    )
+    args = parser.parse_args()
 
-    # write the df to a new csv file
-    min_max.to_csv("normalized_metrics.csv", index=False)
+    bounds = (
+        metric_bounds(args.k, args.max_relevance) if args.theoretical_bounds else None
+    )
+    print(
+        normalize_metrics(
+            args.input,
+            args.output,
+            bounds=bounds,
+            group_by=args.group_by,
+            report_f=instrumentation.report_path(args.output) if args.report else None,
+        )
+    )
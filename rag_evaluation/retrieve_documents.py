@@ -1,11 +1,24 @@
 """Loads a file of queries and generates responses from policy-chat API.
 """
 
+import argparse
+import asyncio
 import csv
 import json
 import string
+from collections import deque
 
-import requests
+import httpx
+
+from rag_evaluation import instrumentation
+from rag_evaluation.cache import CacheMissError, DiskCache, make_key
+from rag_evaluation.jsonl import JsonlWriter
+
+POLICY_CHAT_URL = "http://localhost:8000/ask"
+
+# change the tag when the retriever or its index changes to stop serving old responses
+RETRIEVER_VERSION = "policy-chat"
+RETRIEVAL_CACHE_PATH = "./data/retrieval_cache.sqlite"
 
 
 def headers(columns: int) -> list:
@@ -16,52 +29,272 @@ def headers(columns: int) -> list:
     return headers
 
 
-def generate_responses(headers: list, input: str, output: str):
-    """Save the responses from policy-chat API of a given list of queries to a csv file."""
-    # save the query and source texts to a csv file
-    with open(output, mode="w", newline="") as f_out:
-        writer = csv.writer(f_out)
-        writer.writerow(headers)
-        responses = []
-
-        # read in the queries
-        with open(input, mode="r") as f_in:
-            queries = csv.reader(f_in)
-            for row in queries:
-                # skip irrelevant rows
-                if not row:
-                    continue
-
-                # format relevant rows
-                query = row[0].strip()
-                query = query.translate(str.maketrans("", "", string.punctuation + "•"))
-
-                # send POST request
-                result = requests.post(
-                    "http://localhost:8000/ask", json={"query": query}
+def format_query(query: str) -> str:
+    """Strips the whitespace and punctuation from a query before it is sent to policy-chat."""
+    query = query.strip()
+    return query.translate(str.maketrans("", "", string.punctuation + "•"))
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes a query for the retrieval cache: formatted, lowercase and single spaced."""
+    return " ".join(format_query(query).lower().split())
+
+
+def retrieval_cache_key(query: str, retriever_version: str = RETRIEVER_VERSION) -> str:
+    """Returns the retrieval cache key of a query for a version of the retriever."""
+    return make_key("retrieval", retriever_version, normalize_query(query))
+
+
+def open_retrieval_cache(
+    path: str = RETRIEVAL_CACHE_PATH, ttl: float = None, max_entries: int = None
+) -> DiskCache:
+    """Opens the on-disk cache of policy-chat responses shared by the pipeline stages."""
+    return DiskCache(path, max_entries=max_entries, ttl=ttl)
+
+
+def get_source_texts(response_data: dict) -> list:
+    """Returns the text of every source document in a policy-chat response."""
+    sources = response_data.get("source_documents", [])
+    return [json.loads(source["page_content"]).get("text", "") for source in sources]
+
+
+def _should_retry(error: Exception) -> bool:
+    """Retries connection errors, timeouts, rate limits and server errors."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+async def _ask(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    query: str,
+    url: str,
+    retries: int,
+    backoff: float,
+) -> dict:
+    """Sends one query to policy-chat, retrying with exponential backoff."""
+    async with semaphore:
+        for attempt in range(retries + 1):
+            instrumentation.count("policy-chat requests")
+            try:
+                with instrumentation.latency("policy-chat"):
+                    result = await client.post(url, json={"query": query})
+                result.raise_for_status()
+                return result.json()
+            except (httpx.HTTPStatusError, httpx.TransportError) as error:
+                if attempt == retries or not _should_retry(error):
+                    raise
+                instrumentation.count("policy-chat retries")
+                await asyncio.sleep(backoff * 2**attempt)
+
+
+async def _retrieve_one(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    query: str,
+    url: str,
+    retries: int,
+    backoff: float,
+    cache: DiskCache,
+    offline: bool,
+    retriever_version: str,
+) -> tuple:
+    """Returns the response to one query from the cache, or from policy-chat on a miss,
+    and whether it was fetched. Only the source documents of a response are cached.
+    """
+    key = retrieval_cache_key(query, retriever_version)
+    if cache is not None:
+        response = cache.get(key)
+        if response is not None:
+            instrumentation.count("retrieval cache hits")
+            return response, False
+        instrumentation.count("retrieval cache misses")
+    if offline:
+        raise CacheMissError(f"not in the retrieval cache: {query!r}")
+
+    response = await _ask(client, semaphore, query, url, retries, backoff)
+    if cache is not None:
+        cache.put(key, {"source_documents": response.get("source_documents", [])})
+    return response, True
+
+
+async def stream_policy_chat(
+    queries,
+    url: str = POLICY_CHAT_URL,
+    concurrency: int = 8,
+    timeout: float = 60.0,
+    retries: int = 3,
+    backoff: float = 0.5,
+    cache: DiskCache = None,
+    offline: bool = False,
+    retriever_version: str = RETRIEVER_VERSION,
+    commit_every: int = 100,
+):
+    """Yields (query, response) for every query in input order. At most `concurrency`
+    requests are in flight, sharing a pool of keep-alive connections, and only a
+    bounded window of queries is pending, so memory stays constant for any number of
+    queries. With a cache, cached responses are served from it and only the misses
+    are sent; offline, a miss raises CacheMissError instead. The fetched responses
+    are committed to the cache every `commit_every` responses, so a run that is
+    killed keeps most of them.
+    """
+    if offline and cache is None:
+        raise ValueError("offline retrieval needs a cache to serve from")
+
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    uncommitted = 0
+
+    def done(query, result):
+        nonlocal uncommitted
+        response, fetched = result
+        uncommitted += fetched
+        if cache is not None and uncommitted >= commit_every:
+            cache.commit()
+            uncommitted = 0
+        return query, response
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        pending = deque()
+        try:
+            for query in queries:
+                task = asyncio.ensure_future(
+                    _retrieve_one(
+                        client,
+                        semaphore,
+                        query,
+                        url,
+                        retries,
+                        backoff,
+                        cache,
+                        offline,
+                        retriever_version,
+                    )
                 )
-                response_data = result.json()
+                pending.append((query, task))
+                if len(pending) >= 2 * concurrency:
+                    query, task = pending.popleft()
+                    yield done(query, await task)
+            while pending:
+                query, task = pending.popleft()
+                yield done(query, await task)
+        finally:
+            for _, task in pending:
+                task.cancel()
+            if cache is not None:
+                cache.commit()
+
 
-                # get the text from the sources
-                sources = response_data.get("source_documents", [])
-                source_texts = [
-                    json.loads(source["page_content"]).get("text", "")
-                    for source in sources
-                ]
+async def ask_policy_chat(queries: list, url: str = POLICY_CHAT_URL, **kwargs) -> list:
+    """Returns the policy-chat responses of the queries in input order, see stream_policy_chat."""
+    return [
+        response async for _, response in stream_policy_chat(queries, url, **kwargs)
+    ]
 
-                # write to the csv file
-                full_row = [query] + source_texts + [""]
-                writer.writerow(full_row)
-                responses.append({"query": query, "response": response_data})
 
-            # also save the prompt and response to a json file
-            with open("responses.json", "w") as f:
-                json.dump(responses, f, indent=4)
+def retrieve(queries: list, url: str = POLICY_CHAT_URL, **kwargs) -> list:
+    """Returns the policy-chat responses of the queries in input order, see stream_policy_chat."""
+    return asyncio.run(ask_policy_chat(queries, url, **kwargs))
+
+
+def read_queries(input: str):
+    """Lazily reads and formats the queries of a csv file, skipping the empty rows."""
+    with open(input, mode="r", newline="") as f_in:
+        for row in csv.reader(f_in):
+            if row:
+                yield format_query(row[0])
+
+
+async def _write_responses(queries, writer, jsonl_writer: JsonlWriter, **kwargs):
+    """Writes every response to the csv and JSON Lines files as soon as it is in order."""
+    async for query, response_data in stream_policy_chat(queries, **kwargs):
+        full_row = [query] + get_source_texts(response_data) + [""]
+        writer.writerow(full_row)
+        jsonl_writer.write({"query": query, "response": response_data})
+
+
+def generate_responses(
+    headers: list,
+    input: str,
+    output: str,
+    url: str = POLICY_CHAT_URL,
+    concurrency: int = 8,
+    timeout: float = 60.0,
+    retries: int = 3,
+    cache: DiskCache = None,
+    offline: bool = False,
+    responses_f: str = "responses.jsonl",
+    report_f: str = None,
+):
+    """Save the responses from policy-chat API of a given list of queries to a csv file,
+    and every raw response as one line of a JSON Lines file. Both are written as the
+    responses arrive, so memory stays constant and an interrupted run keeps what was
+    written. Responses in the retrieval cache are not requested again. With
+    `report_f`, the run is instrumented and its report written there as JSON.
+    """
+    with instrumentation.reporting(report_f), instrumentation.stage("retrieval"):
+        with open(output, mode="w", newline="") as f_out, JsonlWriter(
+            responses_f
+        ) as jsonl_writer:
+            writer = csv.writer(f_out)
+            writer.writerow(headers)
+            asyncio.run(
+                _write_responses(
+                    read_queries(input),
+                    writer,
+                    jsonl_writer,
+                    url=url,
+                    concurrency=concurrency,
+                    timeout=timeout,
+                    retries=retries,
+                    cache=cache,
+                    offline=offline,
+                )
+            )
 
     print("all done")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="write timings and counters to <output>.report.json",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="only read the responses from the retrieval cache, never call policy-chat",
+    )
+    parser.add_argument(
+        "--retrieval-cache-ttl",
+        type=float,
+        help="seconds after which a cached policy-chat response is retrieved again",
+    )
+    parser.add_argument(
+        "--retrieval-cache-max-entries",
+        type=int,
+        help="evict the least recently used policy-chat responses past this many",
+    )
+    args = parser.parse_args()
+
     columns = 5
     headers = headers(columns)
-    generate_responses(headers, "./data/queries.csv", "./data/retrieved_sources.csv")
+    output = "./data/retrieved_sources.csv"
+    with open_retrieval_cache(
+        ttl=args.retrieval_cache_ttl, max_entries=args.retrieval_cache_max_entries
+    ) as cache:
+        generate_responses(
+            headers,
+            "./data/queries.csv",
+            output,
+            cache=cache,
+            offline=args.offline,
+            report_f=instrumentation.report_path(output) if args.report else None,
+        )
+        print(cache.stats())
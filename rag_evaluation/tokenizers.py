@@ -0,0 +1,66 @@
+"""Word tokenizer backends used to extract keywords and score sources.
+
+The text is always passed through `string_format` first, so the tokenizers only need
+to split words once the ASCII punctuation has been stripped. NLTK is the reference
+backend; the regex backend reproduces its output on formatted text without the
+Treebank pipeline.
+"""
+
+import re
+
+from rag_evaluation import instrumentation
+
+# quotes that NLTK splits into separate tokens (the ASCII ones are already stripped)
+_QUOTES = str.maketrans({quote: f" {quote} " for quote in "«“‘„»”’"})
+
+# the contractions NLTK splits that have no apostrophe, e.g. "cannot" -> "can not"
+_CONTRACTIONS = re.compile(
+    r"(?i)\b(?:(can)(not)|(gim)(me)|(gon)(na)|(got)(ta)|(lem)(me))\b"
+    r"|\b(wan)(na)(?=\s|$)"
+)
+
+
+def _split_contraction(match: re.Match) -> str:
+    first, second = (group for group in match.groups() if group is not None)
+    return f" {first} {second} "
+
+
+def nltk_tokenize(text: str) -> list:
+    """Returns the words of the text using the reference NLTK tokenizer.
+
+    NLTK is imported on first use, and the text is treated as a single line: once the
+    sentence punctuation is stripped there is nothing to split into sentences, so the
+    Punkt model (and downloading it) is never needed.
+    """
+    import nltk  # slow to import, so only loaded by the processes that use it
+
+    return nltk.word_tokenize(text, preserve_line=True)
+
+
+def regex_tokenize(text: str) -> list:
+    """Returns the words of formatted text using precompiled regexes and str.split."""
+    text = text.translate(_QUOTES)
+    text = _CONTRACTIONS.sub(_split_contraction, text)
+    return text.split()
+
+
+TOKENIZERS = {
+    "nltk": nltk_tokenize,
+    "regex": regex_tokenize,
+}
+
+
+def get_tokenizer(tokenizer="nltk"):
+    """Returns the tokenizer function for a backend name, or the tokenizer itself if a
+    callable is passed.
+    """
+    if callable(tokenizer):
+        function = tokenizer
+    elif tokenizer in TOKENIZERS:
+        function = TOKENIZERS[tokenizer]
+    else:
+        raise ValueError(
+            f"unknown tokenizer {tokenizer!r}, expected one of {sorted(TOKENIZERS)}"
+        )
+    # counts the calls only while instrumentation is recording
+    return instrumentation.counting(function, "tokenizations")
@@ -0,0 +1,166 @@
+"""Shared fixtures, including local stand-ins for the services the pipeline calls.
+"""
+
+import csv
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+class StandInServer:
+    """Runs a JSON over HTTP handler in a background thread and records the requests."""
+
+    def __init__(self, respond):
+        self.respond = respond  # (path, body) -> (status, body)
+        self.requests = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"null")
+                with server.lock:
+                    server.requests.append((self.path, body))
+                status, payload = server.respond(self.path, body)
+                content = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def policy_texts():
+    """The texts of a few short policy chunks."""
+    return [
+        "Hearing screening of every infant before discharge.",
+        "Medication orders are reviewed by the pharmacist.",
+        "The infant hearing screen is repeated by Audiology.",
+        "Visitors sign in at the front desk.",
+    ]
+
+
+@pytest.fixture
+def policy_document():
+    """Returns a function that makes a policy-chat source document of a text."""
+
+    def document(text: str) -> dict:
+        return {
+            "page_content": json.dumps({"filename": "policy.pdf", "text": text}),
+            "metadata": {"source": "policy.pdf"},
+        }
+
+    return document
+
+
+@pytest.fixture
+def write_retrieved_sources():
+    """Returns a function that writes a retrieved sources csv (the prompt, the sources
+    and the human relevances) to a path and returns the path. The rows are the given
+    ones, or built from the first n_rows of data.csv.
+    """
+
+    def write(path, n_rows=40, rows=None):
+        if rows is None:
+            with open(os.path.join(DATA_DIR, "data.csv"), newline="") as f_in:
+                data = list(csv.reader(f_in))[1 : n_rows + 1]
+            rows = [
+                [row[0]] + row[2:7] + [value or "0" for value in row[7:13]]
+                for row in data
+            ]
+        with open(path, mode="w", newline="") as f_out:
+            writer = csv.writer(f_out)
+            writer.writerow(["prompt"] + [f"source{i}" for i in range(1, 6)])
+            writer.writerows(rows)
+        return path
+
+    return write
+
+
+@pytest.fixture
+def retrieved_fixture():
+    """The policy-chat responses in retrieved_sources.json keyed by query."""
+    with open(os.path.join(DATA_DIR, "retrieved_sources.json")) as f_in:
+        return {entry["query"]: entry["response"] for entry in json.load(f_in)}
+
+
+@pytest.fixture
+def policy_chat_server(retrieved_fixture):
+    """A stand-in policy-chat /ask endpoint serving the fixture source documents."""
+
+    def respond(path, body):
+        if path != "/ask":
+            return 404, {"detail": "Not Found"}
+        response = retrieved_fixture.get(body["query"])
+        if response is None:
+            return 200, {"query": body["query"], "result": "", "source_documents": []}
+        return 200, response
+
+    with StandInServer(respond) as server:
+        yield server
+
+
+def chat_completion(content: str, model: str = "mistral-large-latest") -> dict:
+    """Returns a chat completions response body with a single choice."""
+    return {
+        "id": "cmpl-test",
+        "object": "chat.completion",
+        "model": model,
+        "created": 0,
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+@pytest.fixture
+def chat_server():
+    """A stand-in chat completions endpoint that answers every prompt with the query
+    it contains. Status codes queued in `server.failures` are returned first.
+    """
+
+    def respond(path, body):
+        if path != "/v1/chat/completions":
+            return 404, {"detail": "Not Found"}
+        with server.lock:
+            failure = server.failures.pop(0) if server.failures else None
+        if failure is not None:
+            return failure, {"detail": "try again"}
+        prompt = body["messages"][-1]["content"]
+        query = re.search(r'query = "(.*)"', prompt).group(1)
+        return 200, chat_completion(f"answer to\n{query}", body["model"])
+
+    server = StandInServer(respond)
+    server.failures = []
+    with server:
+        yield server
@@ -0,0 +1,64 @@
+"""Testing the agreement of the generated relevances with the human relevances.
+"""
+
+import json
+import math
+
+import numpy as np
+import pytest
+
+from rag_evaluation.agreement import (agreement, confusion_matrices,
+                                      read_judgments, scores, to_json)
+
+HUMAN = [[1, 0], [1, 1], [0, -1], [0, 0]]
+GENERATED = [[1, 1], [0, 1], [1, 1], [0, 1]]
+
+
+def test_confusion_matrices():
+    cms = confusion_matrices(HUMAN, GENERATED)
+    # indexed [rank, generated, human], the missing judgment is left out
+    assert cms.tolist() == [[[1, 1], [1, 1]], [[0, 0], [2, 1]]]
+    with pytest.raises(ValueError):
+        confusion_matrices(HUMAN, GENERATED[:2])
+    with pytest.raises(ValueError):
+        confusion_matrices([[4]], [[1]])
+
+
+def test_scores():
+    result = scores([[40, 10], [5, 45]])
+    assert result["judgments"] == 100
+    assert result["precision"] == 0.9
+    assert result["recall"] == pytest.approx(45 / 55)
+    assert result["agreement"] == 0.85
+    # observed 0.85, expected by chance 0.5 * 0.55 + 0.5 * 0.45
+    assert result["kappa"] == pytest.approx((0.85 - 0.5) / 0.5)
+
+    # no generated positives
+    assert math.isnan(scores([[3, 1], [0, 0]])["precision"])
+
+
+def test_agreement_json():
+    result = agreement(HUMAN, GENERATED)
+    assert result["overall"]["confusion matrix"].tolist() == [[1, 1], [3, 2]]
+    assert np.allclose(result["ranks"]["recall"], [0.5, 1.0])
+
+    encoded = json.loads(json.dumps(to_json(result)))
+    assert encoded["overall"]["judgments"] == 7
+    assert encoded["ranks"]["precision"] == [0.5, pytest.approx(1 / 3)]
+    assert encoded["ranks"]["kappa"][1] == 0.0  # always generated relevant
+
+    # kappa is undefined when both always say relevant, and written as null
+    assert to_json(scores([[0, 0], [0, 3]]))["kappa"] is None
+
+
+def test_read_judgments_skips_unrated(tmp_path):
+    input_f = tmp_path / "data.csv"
+    input_f.write_text(
+        "source 1 human relevance,source 1 human binary relevance,"
+        "source 1 generated binary relevance\n"
+        "3,1,1\n"
+        "-1,0,1\n"
+    )
+    human, generated = read_judgments(input_f, k=1)
+    assert human.tolist() == [[1], [-1]]
+    assert generated.tolist() == [[1], [1]]
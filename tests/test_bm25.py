@@ -0,0 +1,83 @@
+"""Testing the in-process BM25 retriever.
+"""
+
+import csv
+import math
+import os
+
+import numpy as np
+import pytest
+
+from rag_evaluation.bm25 import (BM25Index, block_rows, generate_responses,
+                                 read_chunks)
+from rag_evaluation.retrieve_documents import get_source_texts
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def test_scores_match_bm25(policy_texts, policy_document):
+    index = BM25Index.build(
+        [policy_document(text) for text in policy_texts], k1=1.2, b=0.5
+    )
+    top, scores = index.search(["infant hearing", "pharmacist"], k=2)
+    assert top.tolist() == [[0, 2], [1, 0]]
+    assert scores[1, 1] == 0.0
+
+    # "pharmacist" is in 1 of 4 documents, of 4 terms out of 4.5 on average
+    idf = math.log(1 + (4 - 1 + 0.5) / (1 + 0.5))
+    expected = idf * 2.2 / (1 + 1.2 * (1 - 0.5 + 0.5 * 4 / 4.5))
+    assert scores[1, 0] == pytest.approx(expected)
+
+
+def test_save_and_load(tmp_path):
+    index = BM25Index.build(
+        read_chunks(os.path.join(DATA_DIR, "retrieved_sources.json"))
+    )
+    index.save(tmp_path / "index.npz")
+    loaded = BM25Index.load(tmp_path / "index.npz")
+    queries = ["hearing screening at the birth hospital", "unknown words only"]
+    assert loaded.documents == index.documents
+    assert loaded.retrieve(queries) == index.retrieve(queries)
+
+
+@pytest.mark.parametrize("block_size", [1, 7, None])
+def test_blocked_search_matches_brute_force(block_size):
+    index = BM25Index.build(
+        read_chunks(os.path.join(DATA_DIR, "retrieved_sources.json"))
+    )
+    queries = ["infant hearing screening", "medication orders", "no such words"]
+    top, scores = index.search(queries, k=5, block_size=block_size)
+    expected = (index._query_matrix(queries) @ index.weights).toarray()
+    assert np.allclose(np.take_along_axis(expected, top, axis=1), scores)
+    assert np.allclose(np.sort(expected, axis=1)[:, ::-1][:, :5], scores)
+
+
+def test_block_rows_bound_the_memory():
+    # 1024 queries of float64 scores, about 64 MB per block
+    assert block_rows(1024, 0, itemsize=8) == 64 * 2**20 // (24 * 1024)
+    assert block_rows(10**9, 0, itemsize=8) == 1
+
+
+def test_retrieve_has_the_policy_chat_shape(policy_texts, policy_document):
+    documents = [policy_document(text) for text in policy_texts]
+    (response,) = BM25Index.build(documents).retrieve(["front desk visitors"], k=3)
+    assert response["query"] == "front desk visitors"
+    assert get_source_texts(response)[0] == policy_texts[3]
+    assert response["source_documents"][0]["metadata"]["source"] == "policy.pdf"
+    assert len(response["source_documents"]) == 3
+
+
+def test_generate_responses(policy_texts, policy_document, tmp_path):
+    index = BM25Index.build([policy_document(text) for text in policy_texts])
+    input_f = tmp_path / "queries.csv"
+    input_f.write_text("infant hearing?\n\nthe pharmacist\n")
+    output_f = tmp_path / "retrieved_sources.csv"
+    generate_responses(
+        index, input_f, output_f, k=2, batch_size=1, responses_f=tmp_path / "r.jsonl"
+    )
+    with open(output_f, newline="") as f_in:
+        rows = list(csv.reader(f_in))
+    assert rows[0] == ["prompt", "source1", "source2"]
+    assert [row[0] for row in rows[1:]] == ["infant hearing", "the pharmacist"]
+    assert rows[2][1] == policy_texts[1]
+    assert len((tmp_path / "r.jsonl").read_text().splitlines()) == 2
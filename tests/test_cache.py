@@ -0,0 +1,56 @@
+"""Testing for the persistent key/value cache.
+"""
+
+import time
+
+from rag_evaluation.cache import DiskCache, make_key
+
+
+def test_make_key_stable():
+    assert make_key("v1", 5, ["query"]) == make_key("v1", 5, ["query"])
+    assert make_key("v1", 5, ["query"]) != make_key("v2", 5, ["query"])
+
+
+def test_get_put_stats(tmp_path):
+    with DiskCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get("missing") is None
+        cache.put("key", ["query", 0.2, 1])
+        assert cache.get("key") == ["query", 0.2, 1]
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 1,
+            "hit rate": 0.5,
+            "entries": 1,
+        }
+
+
+def test_persists_between_sessions(tmp_path):
+    with DiskCache(tmp_path / "cache.sqlite") as cache:
+        cache.put("key", {"value": 1})
+    with DiskCache(tmp_path / "cache.sqlite") as cache:
+        assert cache.get("key") == {"value": 1}
+
+
+def test_evicts_least_recently_used(tmp_path):
+    with DiskCache(tmp_path / "cache.sqlite", max_entries=2) as cache:
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")  # b is now the least recently used
+        cache.put("c", 3)
+        cache.commit()
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+
+def test_expires_after_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    with DiskCache(tmp_path / "cache.sqlite", ttl=60) as cache:
+        cache.put("key", "value")
+        now[0] += 59
+        assert cache.get("key") == "value"
+        now[0] += 2
+        assert cache.get("key") is None
+        assert len(cache) == 0
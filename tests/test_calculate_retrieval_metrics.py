@@ -1,10 +1,22 @@
 """Testing for calculating the retrieval metrics.
 """
 
+import csv
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from rag_evaluation.cache import DiskCache
 from rag_evaluation.calculate_retrieval_metrics import (
-    average_precision, cumulative_gain, get_keywords, get_source_relevance,
-    mean_reciprocal_rank, normalized_discounted_cg, precision_at_k,
-    string_format)
+    ChunkInterner, average_precision, average_precision_from_vector,
+    batch_metrics, cumulative_gain, generate_metrics, get_keywords,
+    get_relevance_vector, get_source_relevance, mean_reciprocal_rank,
+    normalized_discounted_cg, precision_at_k, precision_from_vector,
+    read_relevance_matrix, reciprocal_rank_from_vector, string_format)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 
 
 def test_empty_string_format():
@@ -66,6 +78,72 @@ def test_source_relevance_multiple_keywords_not_relevant():
     )
 
 
+def test_relevance_vector_simple():
+    sources = [
+        "query",
+        "super super super super relevant source",
+        "source2",
+    ]
+    assert get_relevance_vector(sources, {"super"}) == [0, 1, 0]
+
+
+def test_interned_relevance_matches_source_relevance():
+    rng = np.random.default_rng(0)
+    words = ["super", "duper", "the", "policy", "infant", "hearing", "Super,"]
+    sources = [
+        " ".join(rng.choice(words, size=rng.integers(0, 12))) for _ in range(300)
+    ]
+    interner = ChunkInterner("regex")
+    for keywords in ({"super"}, {"super", "duper", "policy"}, {"unknown"}, set()):
+        expected = [get_source_relevance(s, keywords, "regex") for s in sources]
+        assert interner.relevance_vector(sources, keywords) == expected
+
+    # every distinct chunk is tokenized once, into int32 word ids
+    assert len(interner.chunks) == len(set(sources))
+    assert all(ids.dtype == np.int32 for ids in interner.chunks.values())
+    assert interner.intern(sources[0]) is interner.intern(sources[0])
+
+
+def test_interner_is_bounded():
+    sources = [f"super super super super source {i}" for i in range(50)]
+    interner = ChunkInterner("regex", max_chunks=10, max_words=20)
+    for i in range(0, 50, 5):
+        assert interner.relevance_vector(sources[i : i + 5], {"super"}) == [1] * 5
+        assert len(interner.chunks) <= 10
+        assert len(interner.vocabulary) <= 20 + 5
+
+
+def test_generate_metrics_without_interning(write_retrieved_sources, tmp_path):
+    input_f = tmp_path / "retrieved_sources.csv"
+    write_retrieved_sources(input_f)
+    generate_metrics(input_f, tmp_path / "a.csv", 5, tokenizer="regex")
+    generate_metrics(
+        input_f, tmp_path / "b.csv", 5, tokenizer="regex", intern_max_chunks=0
+    )
+    assert (tmp_path / "a.csv").read_text() == (tmp_path / "b.csv").read_text()
+
+
+def test_metrics_from_vector_match_wrappers():
+    sources = [
+        "query",
+        "source1",
+        "super super super super relevant source",
+        "source3",
+        "super super super super relevant again",
+        "source5",
+    ]
+    keywords = {"super"}
+    k = 5
+    relevances = get_relevance_vector(sources, keywords)
+    assert precision_from_vector(relevances, k) == precision_at_k(sources, keywords, k)
+    assert average_precision_from_vector(relevances, k) == average_precision(
+        sources, keywords, k
+    )
+    assert reciprocal_rank_from_vector(relevances) == mean_reciprocal_rank(
+        sources, keywords
+    )
+
+
 def test_precision_at_k_zero():
     assert precision_at_k(["test"], set(), 1) == 0
 
@@ -140,3 +218,141 @@ def test_normalized_discounted_cg_gain_zero():
 def test_normalized_discounted_cg_gain_simple():
     relevances = [0, 1, 2, 3]
     assert normalized_discounted_cg(relevances) == 0.487
+
+
+def test_batch_metrics_match_row_helpers():
+    rng = np.random.default_rng(0)
+    relevances = rng.integers(0, 2, size=(200, 6))
+    gains = rng.integers(0, 5, size=(200, 5))
+    k = 5
+    metrics = batch_metrics(relevances, k, gains=gains, query_slot=True)
+    for i, (row, gain_row) in enumerate(zip(relevances.tolist(), gains.tolist())):
+        assert metrics["precision at k"][i] == precision_from_vector(row, k)
+        assert metrics["average precision"][i] == average_precision_from_vector(row, k)
+        assert metrics["mean reciprocal rank"][i] == reciprocal_rank_from_vector(row)
+        assert metrics["cumulative gain"][i] == cumulative_gain(gain_row)
+        assert metrics["normalized discounted cumulative gain"][
+            i
+        ] == normalized_discounted_cg(gain_row)
+
+
+def test_batch_metrics_zero_relevance():
+    metrics = batch_metrics(np.zeros((3, 6)), 5)
+    assert not metrics["average precision"].any()
+    assert not metrics["precision at k"].any()
+
+
+def test_read_relevance_matrix():
+    columns = [f"relevance{i}" for i in range(1, 6)]
+    matrix = read_relevance_matrix(
+        os.path.join(DATA_DIR, "binarized_human_metrics.csv"), columns
+    )
+    assert matrix.shape == (500, 5)
+    assert matrix[0].tolist() == [1, 1, 0, 0, 0]
+
+
+def test_batch_metrics_scores_every_rank():
+    metrics = batch_metrics([[1, 0, 0, 0, 0]], 5)
+    assert metrics["precision at k"].tolist() == [0.2]
+    assert metrics["mean reciprocal rank"].tolist() == [0.2]
+    # the same row with a query placeholder in column 0
+    padded = batch_metrics([[0, 1, 0, 0, 0, 0]], 5, query_slot=True)
+    for name, values in metrics.items():
+        if name not in ("cumulative gain", "normalized discounted cumulative gain"):
+            assert values.tolist() == padded[name].tolist()
+
+
+def test_batch_metrics_relevant_at_rank_k():
+    metrics = batch_metrics([[0, 0, 0, 0, 1]], 5)
+    assert metrics["precision at k"].tolist() == [0.2]
+    assert metrics["average precision"].tolist() == [0.2]
+
+
+def test_batch_metrics_unrated_sources():
+    metrics = batch_metrics([[1, -1, 0, 0, 2]], 5)
+    expected = batch_metrics([[1, 0, 0, 0, 2]], 5)
+    for name, values in metrics.items():
+        assert values.tolist() == expected[name].tolist()
+    assert metrics["cumulative gain"].tolist() == [3]
+
+    columns = [f"source {i} human relevance" for i in range(1, 6)]
+    matrix = read_relevance_matrix(os.path.join(DATA_DIR, "data.csv"), columns)
+    assert (matrix == -1).any()
+    metrics = batch_metrics(matrix, 5)
+    assert (metrics["cumulative gain"] >= 0).all()
+    assert (metrics["normalized discounted cumulative gain"] >= 0).all()
+
+
+def test_batch_metrics_on_human_relevances():
+    columns = [f"relevance{i}" for i in range(1, 6)]
+    matrix = read_relevance_matrix(
+        os.path.join(DATA_DIR, "binarized_human_metrics.csv"), columns
+    )
+    metrics = batch_metrics(matrix, 5)
+    # the first row is [1, 1, 0, 0, 0]: two of the five sources are relevant
+    assert metrics["precision at k"][0] == 0.4
+    assert metrics["mean reciprocal rank"][0] == round((1 + 1 / 2) / 5, 3)
+    assert metrics["cumulative gain"][0] == 2
+    assert np.array_equal(metrics["precision at k"], np.round(matrix.sum(1) / 5, 3))
+
+
+def test_generate_metrics_parallel_matches_serial(write_retrieved_sources, tmp_path):
+    input_f = write_retrieved_sources(tmp_path / "retrieved_sources.csv")
+    serial = generate_metrics(input_f, tmp_path / "serial.csv", 5)
+    parallel = generate_metrics(
+        input_f, tmp_path / "parallel.csv", 5, workers=2, chunk_size=3
+    )
+    assert serial.read_bytes() == parallel.read_bytes()
+    assert len(serial.read_text().splitlines()) == 41
+
+
+def test_generate_metrics_from_stdin(write_retrieved_sources, tmp_path, monkeypatch):
+    input_f = write_retrieved_sources(tmp_path / "retrieved_sources.csv", n_rows=5)
+    expected = generate_metrics(input_f, tmp_path / "file.csv", 5)
+    with open(input_f, newline="") as f_in:
+        monkeypatch.setattr(sys, "stdin", f_in)
+        actual = generate_metrics("-", tmp_path / "stdin.csv", 5)
+    assert expected.read_bytes() == actual.read_bytes()
+
+
+def test_generate_metrics_long_field(tmp_path):
+    input_f = tmp_path / "retrieved_sources.csv"
+    long_source = "super " * 100_000 + "source"
+    with open(input_f, mode="w", newline="") as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(["prompt"] + [f"source{i}" for i in range(1, 6)])
+        writer.writerow(["super query"] + [long_source] * 5 + ["1"] * 6)
+    output_f = generate_metrics(input_f, tmp_path / "metrics.csv", 5)
+    with open(output_f, newline="") as f_in:
+        rows = list(csv.reader(f_in))
+    assert rows[1][:4] == ["super query", "0.8", "0.521", "1.0"]
+
+
+def test_generate_metrics_cache_rerun(write_retrieved_sources, tmp_path):
+    input_f = write_retrieved_sources(tmp_path / "retrieved_sources.csv", n_rows=10)
+    expected = generate_metrics(input_f, tmp_path / "expected.csv", 5)
+    with DiskCache(tmp_path / "cache.sqlite") as cache:
+        first = generate_metrics(input_f, tmp_path / "first.csv", 5, cache=cache)
+        assert cache.stats()["misses"] == 10
+        second = generate_metrics(input_f, tmp_path / "second.csv", 5, cache=cache)
+        assert cache.stats()["hits"] == 10
+    assert expected.read_bytes() == first.read_bytes() == second.read_bytes()
+
+
+def test_import_is_offline_and_lazy():
+    code = (
+        "import sys, rag_evaluation.calculate_retrieval_metrics; "
+        "assert 'nltk' not in sys.modules and 'numpy' not in sys.modules"
+    )
+    subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.join(os.path.dirname(__file__), ".."),
+        check=True,
+    )
+
+
+def test_keywords_use_bundled_stopwords():
+    assert get_keywords("what is the policy about the NICU", "regex") == {
+        "policy",
+        "nicu",
+    }
@@ -0,0 +1,85 @@
+"""Testing the columnar tables and the csv converter.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from rag_evaluation.calculate_retrieval_metrics import (generate_metrics,
+                                                        read_relevance_matrix)
+from rag_evaluation.columnar import (METRICS_SCHEMA, convert_csv,
+                                     decode_strings, encode_strings,
+                                     find_table, read_frame, read_schema,
+                                     read_table, write_table)
+
+
+def test_strings_round_trip():
+    values = ["policy", "", "• bullet", "naïve"]
+    data, offsets = encode_strings(values)
+    assert data.dtype == np.uint8 and len(offsets) == len(values) + 1
+    assert list(decode_strings(data, offsets)) == values
+
+
+def test_write_and_project(tmp_path):
+    path = tmp_path / "table.npz"
+    schema = {"prompt": "str", "relevance": "int8", "score": "float64"}
+    write_table(
+        path,
+        {"prompt": ["a", "b"], "relevance": [3, -1], "score": [0.5, np.nan]},
+        schema,
+    )
+    assert read_schema(path) == schema
+
+    table = read_table(path, ["relevance"])
+    assert list(table) == ["relevance"]
+    assert table["relevance"].dtype == np.int8
+    assert table["relevance"].tolist() == [3, -1]
+    with pytest.raises(KeyError):
+        read_table(path, ["missing"])
+
+
+def test_convert_csv(tmp_path):
+    input_f = tmp_path / "data.csv"
+    input_f.write_text(
+        "prompt,source 1 human relevance,score,note\n"
+        'what is the policy,4,0.25,"a, b"\n'
+        "another prompt,,1,\n"
+    )
+    output_f = convert_csv(input_f, schema={"source 1 human relevance": "int8"})
+    assert output_f == os.path.splitext(input_f)[0] + ".npz"
+    assert read_schema(output_f) == {
+        "prompt": "str",
+        "source 1 human relevance": "int8",
+        "score": "float64",
+        "note": "str",
+    }
+    table = read_table(output_f)
+    assert table["source 1 human relevance"].tolist() == [4, -1]
+    assert table["score"].tolist() == [0.25, 1.0]
+    assert table["note"].tolist() == ["a, b", ""]
+
+    columns = ["note", "prompt"]
+    assert read_frame(output_f, columns).equals(read_frame(input_f, columns).fillna(""))
+    assert find_table(str(input_f)) == output_f
+
+    # the relevance matrix reads the same from either format
+    assert np.array_equal(
+        read_relevance_matrix(output_f, ["source 1 human relevance"], missing=0),
+        read_relevance_matrix(input_f, ["source 1 human relevance"], missing=0),
+    )
+
+
+def test_read_generate_metrics_output(write_retrieved_sources, tmp_path):
+    # the metrics header has spaces before some of the names
+    input_f = write_retrieved_sources(tmp_path / "retrieved_sources.csv", n_rows=4)
+    metrics_f = tmp_path / "metrics.csv"
+    generate_metrics(input_f, metrics_f, 5, 1, 1, tokenizer="regex")
+    columns = [name for name in METRICS_SCHEMA if name != "prompt"]
+
+    frame = read_frame(metrics_f, columns)
+    assert list(frame.columns) == columns and len(frame) == 4
+    table_f = convert_csv(metrics_f, schema=METRICS_SCHEMA)
+    assert read_schema(table_f) == METRICS_SCHEMA
+    assert np.array_equal(read_frame(table_f, columns).to_numpy(), frame.to_numpy())
+    assert list(read_frame(metrics_f).columns) == list(METRICS_SCHEMA)
@@ -0,0 +1,108 @@
+"""Testing the memory-mapped embedding index.
+"""
+
+import numpy as np
+import pytest
+
+from rag_evaluation import embeddings
+from rag_evaluation.embeddings import (EmbeddingIndex, HashingEncoder,
+                                       block_rows, normalize)
+
+
+def test_hashing_encoder_is_deterministic():
+    texts = ["Infant hearing screening", "the infant, hearing"]
+    vectors = HashingEncoder().encode(texts)
+    assert vectors.shape == (2, 384) and vectors.dtype == np.float32
+    assert np.array_equal(vectors, HashingEncoder().encode(texts))
+    # stop words and punctuation are dropped, so the second text is in the first
+    assert np.abs(vectors[1]).sum() == 2
+    assert normalize(vectors[1:]) @ normalize(vectors[:1]).T == pytest.approx(
+        np.sqrt(2 / 3)
+    )
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_blocked_search_matches_brute_force(policy_document, tmp_path, dtype):
+    rng = np.random.default_rng(0)
+    words = "infant hearing screen medication pharmacist desk visitor nurse".split()
+    texts = [" ".join(rng.choice(words, size=6)) for _ in range(50)]
+    encoder = HashingEncoder(dimension=32)
+    index = EmbeddingIndex.build(
+        [policy_document(text) for text in texts],
+        encoder,
+        tmp_path / "index",
+        dtype=dtype,
+        batch_size=7,
+    )
+    assert isinstance(index.vectors, np.memmap)
+    assert index.vectors.dtype == dtype
+
+    queries = ["infant hearing", "pharmacist nurse", "desk"]
+    top, scores = index.search(queries, k=4, block_size=9)
+    expected = (
+        normalize(encoder.encode(queries)) @ np.asarray(index.vectors, np.float32).T
+    )
+    assert np.allclose(np.take_along_axis(expected, top, axis=1), scores)
+    assert np.allclose(np.sort(expected, axis=1)[:, ::-1][:, :4], scores)
+    assert np.all(np.diff(scores, axis=1) <= 0)
+
+    # blocks sized from a memory budget, 2 rows here
+    assert block_rows(len(queries), 32, memory=400) == 2
+    budgeted_top, budgeted_scores = index.search(queries, k=4, memory=400)
+    assert np.array_equal(budgeted_top, top)
+    assert np.array_equal(budgeted_scores, scores)
+
+
+def test_block_rows_bound_the_memory():
+    # 1024 queries against 384 dimensions, about 64 MB per block
+    rows = block_rows(1024, 384)
+    assert 3000 < rows < 4000
+    assert block_rows(10**9, 384) == 1
+
+
+def test_feature_cache_is_per_encoder():
+    small, large = HashingEncoder(dimension=8), HashingEncoder(dimension=4096)
+    assert small.encode(["infant"]).shape == (1, 8)
+    assert large.encode(["infant"]).shape == (1, 4096)
+    assert small._feature.cache_info().currsize == 1
+
+
+def test_load_and_retrieve(policy_texts, policy_document, tmp_path):
+    EmbeddingIndex.build(
+        [policy_document(text) for text in policy_texts], HashingEncoder(), tmp_path
+    )
+    # the hashing encoder is loaded from the saved index
+    index = EmbeddingIndex(tmp_path)
+    (response,) = index.retrieve([policy_texts[3]], k=2)
+    assert response["query"] == policy_texts[3]
+    assert response["source_documents"][0] == {
+        **policy_document(policy_texts[3]),
+        "metadata": {"source": "policy.pdf", "score": pytest.approx(1.0)},
+    }
+    with pytest.raises(ValueError):
+        EmbeddingIndex(tmp_path, HashingEncoder(dimension=8)).search(["desk"])
+
+
+class ModelEncoder:
+    """Stands in for a SentenceTransformer model."""
+
+    def encode(self, texts, **kwargs):
+        return HashingEncoder(dimension=384).encode(texts) + 1
+
+
+def test_model_encoder_is_reloaded_by_name(
+    policy_texts, policy_document, tmp_path, monkeypatch
+):
+    documents = [policy_document(text) for text in policy_texts]
+    with pytest.raises(ValueError):
+        EmbeddingIndex.build(documents, ModelEncoder(), tmp_path)
+
+    EmbeddingIndex.build(documents, ModelEncoder(), tmp_path, "path/to/model")
+    loaded = []
+    monkeypatch.setattr(
+        embeddings, "load_encoder", lambda *args: loaded.append(args) or ModelEncoder()
+    )
+    index = EmbeddingIndex(tmp_path)
+    assert index.info["encoder"] == "path/to/model"
+    assert loaded == [("path/to/model", 384)]
+    assert index.search([policy_texts[1]], k=1)[0].tolist() == [[1]]
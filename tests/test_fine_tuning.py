@@ -0,0 +1,138 @@
+"""Testing the pairs read to fine tune the model.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fine_tuning.fine_tuning import (PairDataset, _shuffled, encode_texts,
+                                     evaluate_model, load_and_preprocess_data,
+                                     long_pairs)
+
+ROWS = [
+    ["What is X?", "Doc A", "Doc B", 4, 2],
+    ["what is x? ", "doc a", "Doc C", 4, -1],
+    ["Why Y?", "Doc A", "Doc D", None, 0],
+]
+
+
+def pair(texts, label):
+    return (*texts, label)
+
+
+class Example:
+    def __init__(self, texts, label):
+        self.texts = texts
+        self.label = label
+
+
+class StubModel:
+    """Embeds a text as (length, vowels, 1), recording the texts it encodes."""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, batch_size, convert_to_numpy):
+        self.encoded.append(list(texts))
+        return np.array([[len(t), sum(c in "aeiou" for c in t), 1] for t in texts])
+
+
+@pytest.fixture
+def pairs_csv(tmp_path):
+    """A csv of judged pairs with a repeated pair and unrated (-1, empty) labels."""
+    rows = ROWS + [[f"question {i}", f"doc {i}", "", 3, None] for i in range(200)]
+    path = tmp_path / "pairs.csv"
+    columns = ["question", "source1", "source2", "relevance1", "relevance2"]
+    frame = pd.DataFrame(rows, columns=columns).set_index("question")
+    frame.index.name = None
+    frame.to_csv(path)
+    return path
+
+
+def test_long_pairs_drop_unrated_and_repeated_pairs(pairs_csv):
+    pairs = long_pairs(load_and_preprocess_data(pairs_csv).head(3), k=2)
+    assert pairs.values.tolist() == [
+        ["what is x?", "doc a", 1.0],
+        ["what is x?", "doc b", 0.5],
+        ["why y?", "doc d", 0.0],
+    ]
+
+
+@pytest.mark.parametrize("chunksize", [1, 2, 1000])
+def test_pair_dataset_yields_every_rated_pair_once(pairs_csv, chunksize):
+    dataset = PairDataset(pairs_csv, k=2, chunksize=chunksize, example=pair)
+    examples = list(dataset)
+    assert len(examples) == len(set(examples)) == 203
+    assert ("what is x?", "doc a", 1.0) in examples
+    assert not any(label < 0 or label != label for *_, label in examples)
+
+
+def test_pair_dataset_split_is_stable_and_disjoint(pairs_csv):
+    def split(name, chunksize):
+        dataset = PairDataset(
+            pairs_csv, split=name, k=2, chunksize=chunksize, example=pair
+        )
+        return set(dataset)
+
+    train, test = split("train", 7), split("test", 7)
+    assert not train & test
+    assert train | test == set(PairDataset(pairs_csv, k=2, example=pair))
+    assert 10 < len(test) < 80
+    assert split("train", 50) == train and split("test", 1000) == test
+
+
+def test_pair_dataset_rejects_unknown_split(pairs_csv):
+    with pytest.raises(ValueError, match="unknown split"):
+        PairDataset(pairs_csv, split="validation")
+
+
+def test_pair_dataset_shuffles_in_a_new_order_every_epoch(pairs_csv):
+    dataset = PairDataset(pairs_csv, k=2, shuffle_buffer=64, example=pair)
+    first, second = list(dataset), list(dataset)
+    unshuffled = list(PairDataset(pairs_csv, k=2, example=pair))
+    assert first != second and first != unshuffled
+    assert sorted(first) == sorted(second) == sorted(unshuffled)
+    again = PairDataset(pairs_csv, k=2, shuffle_buffer=64, example=pair)
+    assert list(again) == first
+
+
+def test_shuffled_keeps_every_example():
+    rng = np.random.default_rng(0)
+    assert sorted(_shuffled(range(100), 10, rng)) == list(range(100))
+    assert list(_shuffled([], 10, rng)) == []
+
+
+def test_encode_texts_encodes_each_distinct_text_once():
+    model, cache = StubModel(), {}
+    embeddings = encode_texts(model, ["a", "bb", "a", ""], cache)
+    assert model.encoded == [["a", "bb", ""]]
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1)
+    assert np.array_equal(embeddings[0], embeddings[2])
+    again = encode_texts(model, ["bb", "ccc"], cache)
+    assert model.encoded[1:] == [["ccc"]]
+    assert np.array_equal(again[0], embeddings[1])
+
+
+def test_evaluate_model_shares_one_cache_per_model():
+    examples = [Example(["a", "aa"], 1.0), Example(["a", "xyz"], 0.0)]
+    examples.append(Example(["xyz", "aaab"], 0.5))
+    base, tuned, cache = StubModel(), StubModel(), {}
+    correlation, mse, true_scores, pred_scores = evaluate_model(base, examples, cache)
+    assert base.encoded == [["a", "xyz", "aa", "aaab"]]
+    assert np.array_equal(true_scores, [1.0, 0.0, 0.5])
+    vectors = {"a": [1, 1, 1], "aa": [2, 2, 1], "xyz": [3, 0, 1], "aaab": [4, 3, 1]}
+    cosines = [
+        np.dot(vectors[q], vectors[s])
+        / np.linalg.norm(vectors[q])
+        / np.linalg.norm(vectors[s])
+        for q, s in (example.texts for example in examples)
+    ]
+    assert np.allclose(pred_scores, cosines)
+    assert np.isclose(mse, np.mean((true_scores - pred_scores) ** 2))
+    assert -1 <= correlation <= 1
+
+    evaluate_model(tuned, examples, cache, model_key="tuned")
+    assert tuned.encoded == base.encoded and set(cache) == {base, "tuned"}
+    again = evaluate_model(base, examples, cache)
+    assert len(base.encoded) == 1
+    assert np.array_equal(again[3], pred_scores)
@@ -0,0 +1,271 @@
+"""Testing generating the LLM responses.
+"""
+
+import asyncio
+import csv
+import re
+import time
+
+import pytest
+from conftest import StandInServer, chat_completion
+from mistralai import models
+
+from rag_evaluation.cache import CacheMissError
+from rag_evaluation.generate_llm_responses import (TokenBucket, build_prompt,
+                                                   completion_cache_key,
+                                                   estimate_tokens,
+                                                   generate_llm_responses,
+                                                   get_client,
+                                                   get_llm_response,
+                                                   open_completion_cache,
+                                                   pack_prompt)
+from rag_evaluation.jsonl import read_jsonl
+from rag_evaluation.retrieve_documents import open_retrieval_cache, retrieve
+
+SOURCES = ["source 1", "source 2", "source 3", "source 4", "source 5"]
+
+
+def test_build_prompt():
+    prompt = build_prompt("what is the policy", SOURCES)
+    assert 'query = "what is the policy"' in prompt
+    assert "source 5: source 5" in prompt
+
+
+def test_pack_prompt_any_k():
+    prompt, tokens = pack_prompt("query", SOURCES[:2] + [""], k=5)
+    assert "source 2: source 2" in prompt and "source 3:" not in prompt
+    assert tokens == estimate_tokens(prompt)
+    assert "source 2:" not in build_prompt("query", SOURCES, k=1)
+
+
+def test_pack_prompt_token_budget():
+    sources = ["first " * 400, "second " * 400, "third " * 400]
+    _, unbounded_tokens = pack_prompt("query", sources)
+    prompt, tokens = pack_prompt("query", sources, max_tokens=300)
+    assert tokens <= 300 < unbounded_tokens
+    # the sources are packed in rank order and cut on whole words
+    assert "source 1: first first" in prompt and "third" not in prompt
+    assert re.search(r"source \d: (\w+ )+\.\.\.\n", prompt)
+
+    prompt, _ = pack_prompt("query", sources, max_source_tokens=10)
+    assert prompt.count(" ...") == 3
+
+
+def test_pack_prompt_skips_sources_over_their_cap():
+    # not one word of the first source fits its cap, the next sources still do
+    sources = ["x" * 200, "short source", "second short source"]
+    prompt, _ = pack_prompt("query", sources, max_source_tokens=10)
+    assert "xxxx" not in prompt
+    assert "source 1: short source\n" in prompt
+    assert "source 2: second short source\n" in prompt
+
+
+def test_pack_prompt_cuts_on_any_whitespace():
+    source = "alpha\tbeta\ngamma delta"
+    limit = len("alpha\tbeta\ngam ...")
+    prompt, _ = pack_prompt("query", [source], max_source_tokens=limit, estimator=len)
+    assert "source 1: alpha\tbeta ...\n" in prompt
+    assert all(len(line) < 80 for line in prompt.splitlines()[6:])
+
+
+def test_get_llm_response(chat_server):
+    client = get_client("test", chat_server.url)
+    assert get_llm_response("query", SOURCES, client=client) == "answer toquery"
+
+
+def test_token_bucket_requests_per_second():
+    async def acquire_all():
+        limiter = TokenBucket(requests_per_second=20)
+        for _ in range(30):
+            await limiter.acquire()
+
+    start = time.monotonic()
+    asyncio.run(acquire_all())
+    assert time.monotonic() - start >= 0.45
+
+
+def test_token_bucket_tokens_per_minute():
+    async def acquire_all():
+        limiter = TokenBucket(requests_per_second=100, tokens_per_minute=6000)
+        await limiter.acquire(6000)
+        await limiter.acquire(30)
+
+    start = time.monotonic()
+    asyncio.run(acquire_all())
+    assert time.monotonic() - start >= 0.25
+
+
+def test_generate_llm_responses_in_order_with_retries(chat_server, tmp_path):
+    chat_server.failures = [429, 503, 500]
+    rows = [(f"query {i}", SOURCES) for i in range(12)]
+    output = generate_llm_responses(
+        rows,
+        tmp_path / "llm_responses.csv",
+        client=get_client("test", chat_server.url),
+        concurrency=4,
+        requests_per_second=1000,
+        backoff=0.01,
+    )
+    with open(output, newline="") as f_in:
+        written = list(csv.reader(f_in))
+    assert written[0] == ["query", "response"]
+    assert written[1:] == [[query, f"answer to{query}", ""] for query, _ in rows]
+    assert len(chat_server.requests) == len(rows) + 3
+
+
+def test_generate_llm_responses_does_not_retry_client_errors(chat_server, tmp_path):
+    chat_server.failures = [401]
+    with pytest.raises(models.SDKError):
+        generate_llm_responses(
+            [("query", SOURCES)],
+            tmp_path / "llm_responses.csv",
+            client=get_client("test", chat_server.url),
+            backoff=0.01,
+        )
+    assert len(chat_server.requests) == 1
+
+
+def test_completion_cache_and_replay(chat_server, tmp_path):
+    rows = [(f"query {i}", SOURCES) for i in range(3)]
+    client = get_client("test", chat_server.url)
+    with open_completion_cache(tmp_path / "completions.sqlite") as completion_cache:
+        first = generate_llm_responses(
+            rows,
+            tmp_path / "first.csv",
+            client=client,
+            requests_per_second=1000,
+            completion_cache=completion_cache,
+        )
+        # replaying never calls the API
+        replayed = generate_llm_responses(
+            rows,
+            tmp_path / "replayed.csv",
+            completion_cache=completion_cache,
+            replay=True,
+        )
+        assert len(chat_server.requests) == len(rows)
+        assert completion_cache.stats()["hits"] == len(rows)
+        assert first.read_bytes() == replayed.read_bytes()
+
+        # other sampling parameters are a different completion
+        with pytest.raises(CacheMissError):
+            generate_llm_responses(
+                rows[:1],
+                tmp_path / "missed.csv",
+                completion_cache=completion_cache,
+                replay=True,
+                sampling={"temperature": 0},
+            )
+        response = get_llm_response(
+            "query 0",
+            SOURCES,
+            client=client,
+            completion_cache=completion_cache,
+            sampling={"temperature": 0},
+        )
+        assert response == "answer toquery 0"
+        assert chat_server.requests[-1][1]["temperature"] == 0
+
+
+def test_offline_sources(chat_server, policy_chat_server, retrieved_fixture, tmp_path):
+    query = next(iter(retrieved_fixture))
+    client = get_client("test", chat_server.url)
+    with open_retrieval_cache(tmp_path / "retrieval.sqlite") as cache:
+        with pytest.raises(CacheMissError):
+            get_llm_response(query, cache=cache, client=client, offline=True)
+        with pytest.raises(CacheMissError):
+            generate_llm_responses(
+                [(query, None)],
+                tmp_path / "missed.csv",
+                client=client,
+                cache=cache,
+                offline=True,
+            )
+        retrieve([query], policy_chat_server.url + "/ask", cache=cache)
+
+        # the sources are read from the retrieval cache only
+        response = get_llm_response(query, cache=cache, client=client, offline=True)
+        output = generate_llm_responses(
+            [(query, None)],
+            tmp_path / "offline.csv",
+            client=client,
+            requests_per_second=1000,
+            cache=cache,
+            offline=True,
+        )
+    assert response == f"answer to{query}"
+    with open(output, newline="") as f_in:
+        assert list(csv.reader(f_in))[1][:2] == [query, response]
+    assert len(policy_chat_server.requests) == 1
+
+
+def test_completion_cache_key():
+    prompt = build_prompt("query", SOURCES)
+    assert completion_cache_key("model", prompt) == completion_cache_key(
+        "model", prompt, {}
+    )
+    assert completion_cache_key("model", prompt) != completion_cache_key(
+        "other", prompt
+    )
+    assert completion_cache_key("model", prompt) != completion_cache_key(
+        "model", prompt + " "
+    )
+
+
+def test_resume_after_failure(tmp_path):
+    rows = [(f"query {i}", SOURCES) for i in range(6)]
+    failing = {"query 2"}
+
+    def respond(path, body):
+        query = re.search(r'query = "(.*)"', body["messages"][-1]["content"]).group(1)
+        if query in failing:
+            return 401, {"detail": "unauthorized"}
+        return 200, chat_completion(f"answer to {query}")
+
+    output = tmp_path / "llm_responses.csv"
+    with StandInServer(respond) as server:
+        # each run makes its own client for its event loop
+        options = {"api_key": "test", "server_url": server.url}
+        with pytest.raises(models.SDKError):
+            generate_llm_responses(rows, output, requests_per_second=1000, **options)
+        with open(output, newline="") as f_in:
+            assert len(list(csv.reader(f_in))) == 3  # the header and two rows
+
+        # a row written after the last manifest record is dropped on resume
+        with open(output, mode="a", newline="") as f_out:
+            f_out.write("partial row")
+
+        failing.clear()
+        requests_before = len(server.requests)
+        generate_llm_responses(
+            rows, output, resume=True, requests_per_second=1000, **options
+        )
+        resumed_queries = [
+            body["messages"][-1]["content"] for _, body in server.requests
+        ][requests_before:]
+
+    with open(output, newline="") as f_in:
+        written = list(csv.reader(f_in))
+    assert written == [["query", "response"]] + [
+        [query, f"answer to {query}", ""] for query, _ in rows
+    ]
+    assert len(resumed_queries) == 4
+    assert not any('"query 0"' in prompt for prompt in resumed_queries)
+    manifest = list(read_jsonl(f"{output}.manifest.jsonl"))
+    assert len(manifest) == len(rows)
+    assert all(record["prompt tokens"] > 0 for record in manifest)
+
+
+def test_resume_without_manifest_starts_over(chat_server, tmp_path):
+    rows = [("query", SOURCES)]
+    output = generate_llm_responses(
+        rows,
+        tmp_path / "llm_responses.csv",
+        resume=True,
+        client=get_client("test", chat_server.url),
+    )
+    with open(output, newline="") as f_in:
+        assert list(csv.reader(f_in)) == [
+            ["query", "response"],
+            ["query", "answer toquery", ""],
+        ]
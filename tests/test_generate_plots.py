@@ -0,0 +1,66 @@
+"""Testing building and writing the report figures.
+"""
+
+import pandas as pd
+import pytest
+
+from rag_evaluation.generate_plots import (build_figures, confusion_matrices,
+                                           long_relevances, write_figures)
+
+
+@pytest.fixture
+def retrieved_df():
+    return pd.DataFrame(
+        {
+            "source 1 human relevance": [4, 0, 2],
+            "source 2 human relevance": [1, 3, None],
+            "source 1 human binary relevance": [1, 0, 1],
+            "source 2 human binary relevance": [0, 1, 0],
+            "source 1 generated binary relevance": [1, 1, 1],
+            "source 2 generated binary relevance": [0, 0, 1],
+        }
+    )
+
+
+def test_long_relevances(retrieved_df):
+    long_df = long_relevances(retrieved_df)
+    assert len(long_df) == retrieved_df.size - 1  # the missing relevance is dropped
+    assert set(long_df["kind"]) == {
+        "human relevance",
+        "human binary relevance",
+        "generated binary relevance",
+    }
+    first = long_df.loc[long_df["relevance"] == "source 2 human relevance"]
+    assert first["source"].tolist() == [2, 2]
+    assert first["value"].tolist() == [1, 3]
+
+
+def test_confusion_matrices(retrieved_df):
+    cms = confusion_matrices(retrieved_df)
+    assert sorted(cms) == [1, 2]
+    # generated in the rows, human in the columns, 1 before 0
+    assert cms[1].values.tolist() == [[2, 1], [0, 0]]
+    assert cms[2].values.tolist() == [[0, 1], [1, 1]]
+
+
+def test_write_figures(retrieved_df, tmp_path):
+    metrics_df = pd.DataFrame({"precision at k": [0.2, 0.8]})
+    llm_df = pd.DataFrame({"good_answer": [1, 0], "hallucinated": [0, 0]})
+    figures = build_figures(retrieved_df, metrics_df, llm_df)
+    assert sorted(figures) == [
+        "human_relevance",
+        "llm_response",
+        "retrieval_metrics",
+        "source_1",
+        "source_1_confusion",
+        "source_2",
+        "source_2_confusion",
+    ]
+
+    paths = write_figures(figures, tmp_path / "report")
+    assert sorted(path.rsplit("/", 1)[1] for path in paths) == sorted(
+        f"{name}.html" for name in figures
+    )
+    assert (tmp_path / "report" / "plotly.min.js").exists()
+    with pytest.raises(ValueError):
+        write_figures(figures, tmp_path / "report", formats=["gif"])
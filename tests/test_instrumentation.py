@@ -0,0 +1,80 @@
+"""Testing the opt-in instrumentation of the pipeline stages.
+"""
+
+import json
+
+from rag_evaluation import instrumentation
+from rag_evaluation.calculate_retrieval_metrics import generate_metrics
+from rag_evaluation.retrieve_documents import generate_responses, headers
+from rag_evaluation.tokenizers import get_tokenizer, regex_tokenize
+
+ROWS = [
+    ["what is the hearing policy"]
+    + ["the hearing screening policy for every infant"] * 5
+    + ["1"] * 6
+] * 4
+
+
+def test_disabled_costs_nothing():
+    assert not instrumentation.enabled()
+    assert instrumentation.stage("a") is instrumentation.latency("b")
+    assert get_tokenizer("regex") is regex_tokenize
+    instrumentation.count("ignored")
+
+
+def test_recording():
+    with instrumentation.recording() as recorder:
+        with instrumentation.stage("stage"):
+            instrumentation.count("calls", 2)
+            for _ in range(3):
+                with instrumentation.latency("request"):
+                    pass
+        tokenize = get_tokenizer(get_tokenizer("regex"))
+        tokenize("a b")
+    assert not instrumentation.enabled()
+
+    report = recorder.report()
+    assert report["stages"]["stage"]["calls"] == 1
+    assert report["counters"] == {"calls": 2, "tokenizations": 1}
+    latencies = report["latencies"]["request"]
+    assert latencies["count"] == 3
+    assert sum(latencies["buckets"].values()) == 3
+
+
+def test_generate_metrics_report(write_retrieved_sources, tmp_path):
+    input_f = write_retrieved_sources(tmp_path / "retrieved_sources.csv", rows=ROWS)
+    output_f = tmp_path / "metrics.csv"
+    report_f = instrumentation.report_path(output_f)
+    assert report_f == str(tmp_path / "metrics.report.json")
+
+    for workers in (1, 2):
+        generate_metrics(
+            input_f, output_f, 5, workers, 1, tokenizer="regex", report_f=report_f
+        )
+        with open(report_f) as f_in:
+            report = json.load(f_in)
+        assert report["stages"]["metrics"]["calls"] == 1
+        # every query, and the one distinct source once per process that scored it,
+        # also counted in the workers
+        interned = report["counters"]["chunks interned"]
+        assert 1 <= interned <= workers
+        assert report["counters"]["tokenizations"] == len(ROWS) + interned
+        assert report["counters"]["rows scored"] == len(ROWS)
+
+
+def test_generate_responses_report(policy_chat_server, retrieved_fixture, tmp_path):
+    queries_f = tmp_path / "queries.csv"
+    queries_f.write_text("\n".join(retrieved_fixture) + "\n")
+    report_f = tmp_path / "report.json"
+    generate_responses(
+        headers(5),
+        queries_f,
+        tmp_path / "sources.csv",
+        url=policy_chat_server.url + "/ask",
+        responses_f=tmp_path / "responses.jsonl",
+        report_f=report_f,
+    )
+    report = json.loads(report_f.read_text())
+    assert report["counters"]["policy-chat requests"] == len(retrieved_fixture)
+    assert report["latencies"]["policy-chat"]["count"] == len(retrieved_fixture)
+    assert report["stages"]["retrieval"]["wall seconds"] > 0
@@ -0,0 +1,36 @@
+"""Testing the streaming JSON Lines writer and reader.
+"""
+
+import pytest
+
+from rag_evaluation.jsonl import JsonlWriter, read_jsonl
+
+
+def test_round_trip(tmp_path):
+    records = [{"query": "a", "response": {"text": "•"}}, {"query": "b"}]
+    with JsonlWriter(tmp_path / "records.jsonl") as writer:
+        for record in records:
+            writer.write(record)
+    assert list(read_jsonl(tmp_path / "records.jsonl")) == records
+    assert len((tmp_path / "records.jsonl").read_text().splitlines()) == 2
+
+
+def test_append(tmp_path):
+    with JsonlWriter(tmp_path / "records.jsonl") as writer:
+        writer.write({"n": 1})
+    with JsonlWriter(tmp_path / "records.jsonl", mode="a") as writer:
+        writer.write({"n": 2})
+    assert list(read_jsonl(tmp_path / "records.jsonl")) == [{"n": 1}, {"n": 2}]
+
+
+def test_skips_interrupted_last_line(tmp_path):
+    path = tmp_path / "records.jsonl"
+    path.write_text('{"n": 1}\n{"n": 2}\n{"n": ')
+    assert list(read_jsonl(path)) == [{"n": 1}, {"n": 2}]
+
+
+def test_raises_on_corrupt_line(tmp_path):
+    path = tmp_path / "records.jsonl"
+    path.write_text('{"n": \n{"n": 2}\n')
+    with pytest.raises(ValueError):
+        list(read_jsonl(path))
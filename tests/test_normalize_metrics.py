@@ -0,0 +1,87 @@
+"""Testing the streaming min-max normalization of the metrics.
+"""
+
+import csv
+
+from rag_evaluation.calculate_retrieval_metrics import generate_metrics
+from rag_evaluation.normalize_metrics import (METRICS, SENTINEL_PROMPT,
+                                              metric_bounds, normalize_metrics,
+                                              scan_ranges)
+
+HEADER = ["prompt", "group", "precision at k", "cumulative gain"]
+
+
+def write_metrics(path, rows):
+    with open(path, mode="w", newline="") as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+    return path
+
+
+def read_metrics(path):
+    with open(path, newline="") as f_in:
+        return list(csv.reader(f_in))
+
+
+def test_observed_ranges_ignore_the_sentinel(tmp_path):
+    input_f = write_metrics(
+        tmp_path / "metrics.csv",
+        [
+            [SENTINEL_PROMPT, "", 1.0, 0.2],
+            ["a", "x", 0.2, 4],
+            ["b", "x", 0.6, 4],
+            ["c", "y", 0.4, 4],
+            ["d", "y", "", 4],
+        ],
+    )
+    metrics = ["precision at k", "cumulative gain"]
+    assert scan_ranges(input_f, metrics) == {
+        None: {"precision at k": (0.2, 0.6), "cumulative gain": (4.0, 4.0)}
+    }
+
+    rows = read_metrics(normalize_metrics(input_f, tmp_path / "out.csv", metrics))
+    assert rows[0] == HEADER
+    assert [row[0] for row in rows[1:]] == ["a", "b", "c", "d"]
+    assert [row[2] for row in rows[1:4]] == ["0.0", "1.0", "0.5000000000000001"]
+    assert rows[4][2] == ""
+    assert [row[3] for row in rows[1:]] == ["0.0"] * 4  # constant like MinMaxScaler
+
+
+def test_theoretical_bounds_and_groups(tmp_path):
+    input_f = write_metrics(
+        tmp_path / "metrics.csv",
+        [["a", "x", 0.2, 6], ["b", "x", 0.6, 12], ["c", "y", 0.4, 3]],
+    )
+    bounds = metric_bounds(k=5, max_relevance=4)
+    assert bounds["cumulative gain"] == (0.0, 24.0)
+
+    output_f = normalize_metrics(
+        input_f,
+        tmp_path / "out.csv",
+        ["precision at k", "cumulative gain"],
+        bounds={"cumulative gain": bounds["cumulative gain"]},
+        group_by="group",
+    )
+    rows = read_metrics(output_f)[1:]
+    assert [row[2] for row in rows] == ["0.0", "1.0", "0.0"]
+    assert [float(row[3]) for row in rows] == [0.25, 0.5, 0.125]
+
+
+def test_normalize_generate_metrics_output(write_retrieved_sources, tmp_path):
+    metrics_f = generate_metrics(
+        write_retrieved_sources(tmp_path / "retrieved_sources.csv", n_rows=4),
+        tmp_path / "metrics.csv",
+        5,
+        tokenizer="regex",
+    )
+    header = read_metrics(metrics_f)[0]
+    assert header[1] == " precision at k"
+
+    ranges = scan_ranges(metrics_f, METRICS)
+    assert set(ranges[None]) == set(METRICS)
+    rows = read_metrics(
+        normalize_metrics(metrics_f, tmp_path / "out.csv", bounds=metric_bounds())
+    )
+    assert rows[0] == header
+    assert len(rows) == 5
@@ -0,0 +1,163 @@
+"""Testing retrieving the sources from policy-chat.
+"""
+
+import asyncio
+import csv
+
+import httpx
+import pytest
+from conftest import StandInServer
+
+from rag_evaluation.cache import CacheMissError, DiskCache
+from rag_evaluation.jsonl import read_jsonl
+from rag_evaluation.retrieve_documents import (ask_policy_chat, format_query,
+                                               generate_responses,
+                                               get_source_texts, headers,
+                                               normalize_query,
+                                               open_retrieval_cache, retrieve,
+                                               stream_policy_chat)
+
+
+def test_format_query():
+    assert format_query(" What is the MYRs' policy? ") == "What is the MYRs policy"
+
+
+def test_ask_policy_chat_keeps_order(policy_chat_server, retrieved_fixture):
+    queries = list(retrieved_fixture) * 4
+    responses = asyncio.run(
+        ask_policy_chat(queries, policy_chat_server.url + "/ask", concurrency=3)
+    )
+    assert [response["query"] for response in responses] == queries
+    assert responses[0] == retrieved_fixture[queries[0]]
+    assert len(policy_chat_server.requests) == len(queries)
+
+
+def test_ask_policy_chat_retries_server_errors(retrieved_fixture):
+    query = next(iter(retrieved_fixture))
+    failures = [503, 429]
+
+    def respond(path, body):
+        if failures:
+            return failures.pop(0), {"detail": "unavailable"}
+        return 200, retrieved_fixture[body["query"]]
+
+    with StandInServer(respond) as server:
+        (response,) = asyncio.run(
+            ask_policy_chat([query], server.url + "/ask", backoff=0.01)
+        )
+    assert response == retrieved_fixture[query]
+    assert len(server.requests) == 3
+
+
+def test_ask_policy_chat_does_not_retry_client_errors():
+    with StandInServer(lambda path, body: (400, {"detail": "bad"})) as server:
+        with pytest.raises(httpx.HTTPStatusError):
+            asyncio.run(ask_policy_chat(["query"], server.url + "/ask", backoff=0.01))
+        assert len(server.requests) == 1
+
+
+def test_generate_responses(
+    policy_chat_server, retrieved_fixture, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    with open("queries.csv", mode="w", newline="") as f_out:
+        writer = csv.writer(f_out)
+        for query in retrieved_fixture:
+            writer.writerow([query + "?", ""])
+        writer.writerow([])
+
+    generate_responses(
+        headers(5), "queries.csv", "sources.csv", url=policy_chat_server.url + "/ask"
+    )
+
+    with open("sources.csv", newline="") as f_in:
+        rows = list(csv.reader(f_in))
+    assert rows[0] == ["prompt", "source1", "source2", "source3", "source4", "source5"]
+    for row, (query, response) in zip(rows[1:], retrieved_fixture.items()):
+        assert row[0] == query
+        assert row[1:6] == get_source_texts(response)
+    records = list(read_jsonl("responses.jsonl"))
+    assert [record["query"] for record in records] == list(retrieved_fixture)
+    assert records[0]["response"] == next(iter(retrieved_fixture.values()))
+
+
+def test_generate_responses_keeps_progress(retrieved_fixture, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    queries = list(retrieved_fixture)
+
+    def respond(path, body):
+        if body["query"] == queries[2]:
+            return 400, {"detail": "bad query"}
+        return 200, retrieved_fixture[body["query"]]
+
+    with open("queries.csv", mode="w", newline="") as f_out:
+        csv.writer(f_out).writerows([query] for query in queries)
+    with StandInServer(respond) as server:
+        with pytest.raises(httpx.HTTPStatusError):
+            generate_responses(
+                headers(5), "queries.csv", "sources.csv", url=server.url + "/ask"
+            )
+
+    records = list(read_jsonl("responses.jsonl"))
+    assert [record["query"] for record in records] == queries[:2]
+
+
+def test_normalize_query():
+    assert (
+        normalize_query("  What is   the MYRs' POLICY? ") == "what is the myrs policy"
+    )
+
+
+def test_ask_policy_chat_serves_from_cache(
+    policy_chat_server, retrieved_fixture, tmp_path
+):
+    queries = list(retrieved_fixture)
+    url = policy_chat_server.url + "/ask"
+    with open_retrieval_cache(tmp_path / "retrieval.sqlite") as cache:
+        first = retrieve(queries, url, cache=cache)
+        # same queries up to case and punctuation, served without any request
+        second = retrieve([query.upper() + "?" for query in queries], url, cache=cache)
+        assert len(policy_chat_server.requests) == len(queries)
+        # only the source documents are cached
+        assert second == [
+            {"source_documents": response["source_documents"]} for response in first
+        ]
+        assert cache.stats()["hits"] == len(queries)
+
+    # a new retriever version does not reuse the old responses
+    with open_retrieval_cache(tmp_path / "retrieval.sqlite") as cache:
+        retrieve(queries[:1], url, cache=cache, retriever_version="bm25")
+    assert len(policy_chat_server.requests) == len(queries) + 1
+
+
+def test_ask_policy_chat_offline(policy_chat_server, retrieved_fixture, tmp_path):
+    query = next(iter(retrieved_fixture))
+    url = policy_chat_server.url + "/ask"
+    with open_retrieval_cache(tmp_path / "retrieval.sqlite") as cache:
+        with pytest.raises(CacheMissError):
+            retrieve([query], url, cache=cache, offline=True)
+        retrieve([query], url, cache=cache)
+        (response,) = retrieve([query], url, cache=cache, offline=True)
+    assert response["source_documents"] == retrieved_fixture[query]["source_documents"]
+    assert len(policy_chat_server.requests) == 1
+
+
+def test_retrieval_cache_is_committed_while_streaming(
+    policy_chat_server, retrieved_fixture, tmp_path
+):
+    path = tmp_path / "retrieval.sqlite"
+    url = policy_chat_server.url + "/ask"
+
+    async def first_response(cache):
+        responses = stream_policy_chat(
+            list(retrieved_fixture), url, concurrency=1, cache=cache, commit_every=1
+        )
+        async for _ in responses:
+            # as if the run was killed now, another connection sees the response
+            with DiskCache(path) as other:
+                committed = len(other)
+            await responses.aclose()
+            return committed
+
+    with open_retrieval_cache(path) as cache:
+        assert asyncio.run(first_response(cache)) >= 1
@@ -0,0 +1,81 @@
+"""Testing the tokenizer backends against the reference NLTK tokenizer.
+"""
+
+import csv
+import json
+import os
+
+import pytest
+
+from rag_evaluation.calculate_retrieval_metrics import (get_keywords,
+                                                        get_source_relevance,
+                                                        string_format)
+from rag_evaluation.tokenizers import (get_tokenizer, nltk_tokenize,
+                                       regex_tokenize)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+def load_queries() -> list:
+    """Returns the queries in queries.csv."""
+    with open(os.path.join(DATA_DIR, "queries.csv"), newline="") as f_in:
+        return [row[0] for row in csv.reader(f_in) if row]
+
+
+def load_retrieved() -> list:
+    """Returns (query, source texts) pairs from retrieved_sources.json."""
+    with open(os.path.join(DATA_DIR, "retrieved_sources.json")) as f_in:
+        responses = json.load(f_in)
+    return [
+        (
+            response["query"],
+            [
+                json.loads(source["page_content"]).get("text", "")
+                for source in response["response"]["source_documents"]
+            ],
+        )
+        for response in responses
+    ]
+
+
+def test_get_tokenizer():
+    assert get_tokenizer("regex") is regex_tokenize
+    assert get_tokenizer(str.split) is str.split
+    with pytest.raises(ValueError):
+        get_tokenizer("unknown")
+
+
+def test_regex_contractions_and_quotes():
+    assert regex_tokenize("i cannot “wanna” go") == [
+        "i",
+        "can",
+        "not",
+        "“",
+        "wan",
+        "na",
+        "”",
+        "go",
+    ]
+
+
+def test_regex_matches_nltk_tokens():
+    texts = load_queries()
+    for query, sources in load_retrieved():
+        texts += [query] + sources
+    for text in texts:
+        formatted = string_format(text)
+        assert regex_tokenize(formatted) == nltk_tokenize(formatted)
+
+
+def test_regex_matches_nltk_keywords():
+    for query in load_queries():
+        assert get_keywords(query, "regex") == get_keywords(query, "nltk")
+
+
+def test_regex_matches_nltk_relevance():
+    for query, sources in load_retrieved():
+        keywords = get_keywords(query)
+        for source in sources:
+            assert get_source_relevance(
+                source, keywords, "regex"
+            ) == get_source_relevance(source, keywords, "nltk")